@@ -0,0 +1,179 @@
+import os
+import sys
+import json
+import bisect
+import itertools
+import threading
+
+from storage import atomic_write_json, create_backend
+
+CUBE_VERSION = 1
+
+
+class HistoryAnalytics:
+    """Готовые итоги по истории заказов для детальной статистики
+
+    Хранит свёртки по дням (клиентов, товаров), по позициям и по клиентам
+    плюс общие счётчики. Обновляется приращениями по дням (replace_day),
+    поэтому статистика не перебирает всю историю на каждое нажатие кнопки. Файл
+    analytics.json можно в любой момент пересобрать из сырой истории —
+    rebuild или запуск модуля из командной строки.
+    """
+
+    def __init__(self, path, flusher=None):
+        self.path = path
+        self.flusher = flusher
+        self._lock = threading.Lock()
+        self._mtime = None
+        # Растёт при каждом изменении свёрток (и перечитывании файла) — ключ кэша отчётов
+        self._versions = itertools.count(1)
+        self.version = 0
+        self._reset()
+        if flusher:
+            flusher.register(path, self.save)
+
+    def _reset(self):
+        self.days = {}
+        self.positions = {}
+        self.clients = {}
+        self.orders = 0
+        self.items = 0
+        self._dates = []
+        self._top_cache = {}
+
+    # --- Загрузка и запись ---
+
+    def load(self):
+        """Прочитать свёртки с диска; False — файла нет или он другой версии"""
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            mtime = os.path.getmtime(self.path)
+        except Exception as e:
+            print(f"Ошибка загрузки аналитики: {e}")
+            return False
+        if data.get('version') != CUBE_VERSION:
+            return False
+        with self._lock:
+            self._reset()
+            self.days = data['days']
+            self.positions = data['positions']
+            self.clients = data['clients']
+            self.orders = data['orders']
+            self.items = data['items']
+            self._dates = sorted(self.days)
+            self._mtime = mtime
+            self.version = next(self._versions)
+        return True
+
+    def reload_if_changed(self):
+        """Перечитать файл, если его обновил другой процесс"""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self.load()
+
+    def save(self):
+        with self._lock:
+            data = {'version': CUBE_VERSION, 'orders': self.orders, 'items': self.items,
+                    'days': self.days, 'positions': self.positions, 'clients': self.clients}
+            atomic_write_json(self.path, data)
+            self._mtime = os.path.getmtime(self.path)
+
+    def _changed(self):
+        self.version = next(self._versions)
+        if self.flusher:
+            self.flusher.mark_dirty(self.path)
+        else:
+            self.save()
+
+    # --- Обновление ---
+
+    def _apply(self, date_str, entry, sign=1):
+        day = self.days.get(date_str)
+        if day is None:
+            day = self.days[date_str] = {'orders': 0, 'items': 0}
+            bisect.insort(self._dates, date_str)
+        day['orders'] += sign
+        day['items'] += sign * entry['total_items']
+        if not day['orders']:
+            del self.days[date_str]
+            self._dates.remove(date_str)
+        self.orders += sign
+        self.items += sign * entry['total_items']
+        self._bump(self.clients, entry['location_name'], sign)
+        for pos, qty in entry['orders'].items():
+            self._bump(self.positions, pos, sign * qty)
+        self._top_cache = {}
+
+    @staticmethod
+    def _bump(counts, key, delta):
+        value = counts.get(key, 0) + delta
+        if value:
+            counts[key] = value
+        else:
+            counts.pop(key, None)
+
+    def replace_day(self, date_str, old_entries, new_entries):
+        """Заменить записи дня: вычесть прежние, добавить новые"""
+        with self._lock:
+            for entry in old_entries or []:
+                self._apply(date_str, entry, sign=-1)
+            for entry in new_entries:
+                self._apply(date_str, entry)
+        self._changed()
+
+    def rebuild(self, history):
+        """Пересобрать свёртки из истории {дата: [записи]}"""
+        with self._lock:
+            self._reset()
+            for date_str, date_orders in history.items():
+                for entry in date_orders:
+                    self._apply(date_str, entry)
+            self.version = next(self._versions)
+        self.save()
+
+    # --- Запросы ---
+
+    def days_count(self):
+        return len(self._dates)
+
+    def last_days(self, limit=7):
+        """Список (дата, клиентов, товаров) от новых к старым"""
+        with self._lock:
+            dates = self._dates[-limit:][::-1] if limit else self._dates[::-1]
+            return [(d, self.days[d]['orders'], self.days[d]['items']) for d in dates]
+
+    def _top(self, name, counts, limit):
+        # Сортировка один раз после изменения, дальше — готовый список
+        ranked = self._top_cache.get(name)
+        if ranked is None:
+            ranked = self._top_cache[name] = sorted(counts.items(), key=lambda x: x[1], reverse=True)
+        return ranked[:limit]
+
+    def top_positions(self, limit=5):
+        with self._lock:
+            return self._top('positions', self.positions, limit)
+
+    def top_clients(self, limit=5):
+        with self._lock:
+            return self._top('clients', self.clients, limit)
+
+
+def rebuild_from_storage(data_dir, backend_kind):
+    """Офлайн-пересборка analytics.json из истории выбранного бэкенда"""
+    backend = create_backend(backend_kind, data_dir)
+    backend.load_users()
+    analytics = HistoryAnalytics(os.path.join(data_dir, 'analytics.json'))
+    analytics.rebuild(backend.export_history())
+    print(f"Аналитика пересобрана: {analytics.days_count()} дней, {analytics.orders} заказов")
+
+
+if __name__ == '__main__':
+    # python analytics.py [DATA_DIR] [json|sqlite]
+    rebuild_from_storage(sys.argv[1] if len(sys.argv) > 1 else os.environ.get('DATA_DIR', '/data'),
+                         sys.argv[2] if len(sys.argv) > 2 else os.environ.get('STORAGE_BACKEND', 'json'))
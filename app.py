@@ -7,9 +7,24 @@ from flask import Flask, request, abort
 import threading
 import io
 import json
-from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment, Border, Side
-from openpyxl.utils import get_column_letter
+import atexit
+from storage import Flusher, atomic_write_json, create_backend, make_history_entry
+from state import ClientDirectory, StateManager
+from shared_state import LeaderLock, create_conversation_store
+from update_queue import UpdateDispatcher, update_chat_id
+from broadcast import BroadcastEngine, format_broadcast_report
+from excel_report import build_orders_workbook
+from analytics import HistoryAnalytics
+from scheduling import Job, JobRunStore, Scheduler
+from metrics import Registry, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from tracing import Tracer, slow_log, format_trace
+from routing import CallbackRouter, pack_callback
+from catalog import Catalog
+from keyboards import KeyboardCache
+from telegram_api import CircuitBreaker, TelegramApiClient
+from outbox import ResponseBuffer
+from pagination import Paginator, Report
+from reports import ReportService, excel_summary_job, json_export_job
  
 TOKEN = os.environ.get('BOT_TOKEN')
 BOT_URL = '/webhook'
@@ -18,123 +33,309 @@ ADMIN_CHAT_ID = os.environ.get('ADMIN_CHAT_ID')
 if not TOKEN or not ADMIN_CHAT_ID:
     raise ValueError("Не установлены BOT_TOKEN или ADMIN_CHAT_ID")
 
-bot = telebot.TeleBot(TOKEN)
+# Обработчики вызываются из воркеров UpdateDispatcher, собственный пул telebot не нужен
+bot = telebot.TeleBot(TOKEN, threaded=False)
+# Ответы обработчика копятся и уходят одним проходом в конце обновления
+responses = ResponseBuffer(bot)
 
-positions = {
-    'Ватрушка': 200, 'Капуста': 130, 'Яблоко': 120, 'Картофель': 130,
-    'Мак': 190, 'Плюшка': 150, 'Чечевица': 140, 'Повидло': 130,
-    'Корица': 150, 'Сосиск в тесте': 150, 'Брусника': 130,
-    'Вишня': 130, 'Черная смородина': 130, 'Творог с зеленью': 130
-}
+# Адрес Bot API (например, локальная заглушка для нагрузочных тестов)
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL.rstrip('/') + '/bot{0}/{1}'
+    telebot.apihelper.FILE_URL = TELEGRAM_API_URL.rstrip('/') + '/file/bot{0}/{1}'
+# Пустой WEBHOOK_URL — не трогать webhook при запуске
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', 'https://web-production-d7a9d.up.railway.app/webhook')
+
+# Товары и цены; в кнопках товары передаются по id из каталога
+catalog = Catalog()
+positions = catalog.prices()
+
+# === МЕТРИКИ ===
+
+# Метрики процесса в формате Prometheus (/metrics). При нескольких воркерах
+# gunicorn у каждого свои значения — Prometheus собирает их по отдельности
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+metrics_registry = Registry()
+WEBHOOK_SECONDS = metrics_registry.histogram(
+    'bot_webhook_request_seconds', 'Время ответа вебхука', ['status'])
+HANDLER_SECONDS = metrics_registry.histogram(
+    'bot_handler_seconds', 'Время обработки обновления по обработчикам', ['kind', 'name'])
+TELEGRAM_API_SECONDS = metrics_registry.histogram(
+    'bot_telegram_api_seconds', 'Длительность вызовов Bot API', ['method'])
+TELEGRAM_API_ERRORS = metrics_registry.counter(
+    'bot_telegram_api_errors_total', 'Ошибки вызовов Bot API', ['method', 'error'])
+TELEGRAM_API_RETRIES = metrics_registry.counter(
+    'bot_telegram_api_retries_total', 'Повторы запросов к Bot API', ['method', 'reason'])
+metrics_registry.gauge('bot_telegram_api_circuit_open', 'Размыкатель Bot API разомкнут (1) или нет (0)',
+                       fn=lambda: int(telegram_client is not None and telegram_client.breaker.state == 'open'))
+PERSISTENCE_SECONDS = metrics_registry.histogram(
+    'bot_persistence_seconds', 'Длительность записи в хранилище', ['operation'])
+JOB_SECONDS = metrics_registry.histogram(
+    'bot_scheduler_job_seconds', 'Длительность задач планировщика', ['job', 'outcome'],
+    buckets=(0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600))
+REPORTS = metrics_registry.counter(
+    'bot_reports_total', 'Запросы отчётов: собран заново, из кэша, присоединён к сборке', ['report', 'result'])
+REPORT_BUILD_SECONDS = metrics_registry.histogram(
+    'bot_report_build_seconds', 'Длительность сборки отчётов', ['report', 'outcome'],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 15, 60, 300))
+metrics_registry.gauge('bot_update_queue_depth', 'Обновлений в очереди', fn=lambda: update_dispatcher.depth())
+metrics_registry.counter('bot_update_queue_events_total', 'События очереди обновлений с запуска', ['event'],
+                         fn=lambda: {(name,): value for name, value in update_dispatcher.stats().items()
+                                     if name in ('accepted', 'rejected', 'processed', 'failed')})
+metrics_registry.gauge('bot_update_queue_max_depth', 'Наибольшая глубина очереди с запуска',
+                       fn=lambda: update_dispatcher.stats()['max_depth'])
+
+# Замер всех исходящих вызовов Bot API в одной точке
+_make_request = telebot.apihelper._make_request
+
+def _timed_make_request(token, method_name, method='get', params=None, files=None):
+    started = time.perf_counter()
+    error = None
+    try:
+        with tracer.span(f"api:{method_name}"):
+            return _make_request(token, method_name, method=method, params=params, files=files)
+    except telebot.apihelper.ApiTelegramException as e:
+        error = str(e.error_code)
+        raise
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        TELEGRAM_API_SECONDS.observe(time.perf_counter() - started, method=method_name)
+        if error:
+            TELEGRAM_API_ERRORS.inc(method=method_name, error=error)
+
+telebot.apihelper._make_request = _timed_make_request
 
 # Файлы для хранения данных
-DATA_DIR = '/data'
+DATA_DIR = os.environ.get('DATA_DIR', '/data')
 if not os.path.exists(DATA_DIR):
     os.makedirs(DATA_DIR)
 
-USERS_DB_FILE = os.path.join(DATA_DIR, 'users_data.json')
-ORDERS_DB_FILE = os.path.join(DATA_DIR, 'orders_history.json')
 STATE_FILE = os.path.join(DATA_DIR, 'scheduler_state.json')
 
-# Временные данные (в оперативной памяти)
-current_orders = {}
-registration_steps = {}
+# Выборочная трассировка обновлений: доля TRACE_SAMPLE_RATE (0 — выключена),
+# трассы дольше TRACE_SLOW_MS пишутся в ротируемый DATA_DIR/traces.log
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0'))
+TRACE_SLOW_MS = float(os.environ.get('TRACE_SLOW_MS', '500'))
+tracer = Tracer(sample_rate=TRACE_SAMPLE_RATE)
+if tracer.enabled:
+    tracer.add_hook(slow_log(os.path.join(DATA_DIR, 'traces.log'), TRACE_SLOW_MS))
+
+# Бэкенд хранения: json (файлы, клиенты — снапшот + журнал) или sqlite
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'json')
+# Журнал клиентов (json) сжимается в снапшот каждые N записей
+USERS_LOG_COMPACT_EVERY = int(os.environ.get('USERS_LOG_COMPACT_EVERY', '1000'))
+
+# Изменения копятся в памяти и пишутся на диск фоновым потоком: после паузы
+# FLUSH_DEBOUNCE секунд, но не реже чем раз в FLUSH_INTERVAL. 0 — писать сразу.
+FLUSH_INTERVAL = float(os.environ.get('FLUSH_INTERVAL', '1.0'))
+FLUSH_DEBOUNCE = float(os.environ.get('FLUSH_DEBOUNCE', '0.2'))
+flusher = Flusher(interval=FLUSH_INTERVAL, debounce=FLUSH_DEBOUNCE,
+                  on_flush=lambda name, seconds: PERSISTENCE_SECONDS.observe(
+                      seconds, operation=f"flush:{os.path.basename(name)}")) if FLUSH_INTERVAL > 0 else None
+
+# История (json) лежит по месяцам; месяцы старше N сжимаются в архив. 0 — не архивировать
+HISTORY_RETENTION_MONTHS = int(os.environ.get('HISTORY_RETENTION_MONTHS', '0'))
+
+storage_backend = create_backend(STORAGE_BACKEND, DATA_DIR, users_compact_every=USERS_LOG_COMPACT_EVERY,
+                                 flusher=flusher, history_retention_months=HISTORY_RETENTION_MONTHS)
+
+# Состояние диалогов (выбранная позиция, шаг регистрации): memory — в памяти
+# процесса, sqlite — общий файл для нескольких воркеров gunicorn
+SHARED_STATE = os.environ.get('SHARED_STATE', 'memory')
+CONVERSATION_TTL = int(os.environ.get('CONVERSATION_TTL', '3600'))
+if SHARED_STATE != 'memory' and STORAGE_BACKEND != 'sqlite':
+    raise ValueError("Для нескольких воркеров (SHARED_STATE=sqlite) нужен STORAGE_BACKEND=sqlite")
+conversation_store = create_conversation_store(SHARED_STATE, DATA_DIR, ttl=CONVERSATION_TTL)
+
+# Планировщик и установку webhook выполняет только ведущий процесс
+leader_lock = LeaderLock(os.path.join(DATA_DIR, 'scheduler.lock'))
 
 app = Flask(__name__)
 
 # === ФУНКЦИИ РАБОТЫ С ДАННЫМИ ===
 
 def load_users_data():
-    """Загрузка базы клиентов из файла"""
+    """Загрузка базы клиентов из хранилища"""
     try:
-        if os.path.exists(USERS_DB_FILE):
-            with open(USERS_DB_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
+        return storage_backend.load_users()
     except Exception as e:
         print(f"Ошибка загрузки users_data: {e}")
     return {}
 
-def save_users_data():
-    """Сохранение базы клиентов в файл"""
+@tracer.traced()
+def save_user_data(user_id_str):
+    """Сохранение одного клиента"""
     try:
-        with open(USERS_DB_FILE, 'w', encoding='utf-8') as f:
-            json.dump(users_data, f, ensure_ascii=False, indent=2)
+        user_data = state.copy_user(user_id_str)
+        if user_data is not None:
+            with PERSISTENCE_SECONDS.time(operation='save_user'):
+                storage_backend.save_user(user_id_str, user_data)
     except Exception as e:
-        print(f"Ошибка сохранения users_data: {e}")
+        print(f"Ошибка сохранения клиента {user_id_str}: {e}")
 
-def load_orders_history():
-    """Загрузка истории заказов из файла"""
+@tracer.traced()
+def delete_user_data(user_id_str):
+    """Удаление клиента из хранилища"""
     try:
-        if os.path.exists(ORDERS_DB_FILE):
-            with open(ORDERS_DB_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
+        with PERSISTENCE_SECONDS.time(operation='delete_user'):
+            storage_backend.delete_user(user_id_str)
     except Exception as e:
-        print(f"Ошибка загрузки orders_history: {e}")
-    return {}
+        print(f"Ошибка удаления клиента {user_id_str}: {e}")
 
-def save_orders_history():
-    """Сохранение истории заказов в файл"""
+@tracer.traced()
+def save_cleared_orders():
+    """Сохранение очистки заказов у всех клиентов"""
     try:
-        with open(ORDERS_DB_FILE, 'w', encoding='utf-8') as f:
-            json.dump(orders_history, f, ensure_ascii=False, indent=2)
+        with PERSISTENCE_SECONDS.time(operation='clear_all_orders'):
+            storage_backend.clear_all_orders()
     except Exception as e:
-        print(f"Ошибка сохранения orders_history: {e}")
+        print(f"Ошибка сохранения users_data: {e}")
 
-def add_order_to_history(user_data, date_str):
-    """Добавление заказа в историю"""
+@tracer.traced()
+def commit_orders_to_history(date_str):
+    """Запись всех текущих заказов в историю за date_str одним коммитом
+
+    Повторный вызов за ту же дату заменяет записи дня, а не дублирует их.
+    Возвращает замеры времени (мс) или None при ошибке.
+    """
     try:
-        if date_str not in orders_history:
-            orders_history[date_str] = []
-        
-        order_entry = {
-            'user_id': user_data.get('user_id'),
-            'location_name': user_data['location_name'],
-            'address': user_data['address'],
-            'orders': user_data['orders'].copy(),
-            'total_items': sum(user_data['orders'].values()),
-            'timestamp': datetime.now().strftime('%H:%M')
+        started = time.perf_counter()
+        timestamp = datetime.now().strftime('%H:%M')
+        entries = [make_history_entry(user_data, timestamp) for user_data in get_active_users()]
+        previous = storage_backend.history_for_date(date_str)
+        snapshot_done = time.perf_counter()
+        storage_backend.commit_history_day(date_str, entries)
+        commit_done = time.perf_counter()
+        PERSISTENCE_SECONDS.observe(commit_done - snapshot_done, operation='commit_history_day')
+        analytics.replace_day(date_str, previous, entries)
+        finished = time.perf_counter()
+        return {
+            'entries': len(entries),
+            'replaced': len(previous or []),
+            'snapshot_ms': (snapshot_done - started) * 1000,
+            'commit_ms': (commit_done - snapshot_done) * 1000,
+            'analytics_ms': (finished - commit_done) * 1000,
+            'total_ms': (finished - started) * 1000
         }
-        
-        orders_history[date_str].append(order_entry)
-        save_orders_history()
     except Exception as e:
-        print(f"Ошибка добавления в историю: {e}")
+        print(f"Ошибка записи истории за {date_str}: {e}")
+        return None
+
+# Состояние планировщика читается с диска один раз, дальше живёт в памяти
+scheduler_state = None
 
 def load_scheduler_state():
     """Загрузка состояния планировщика"""
+    global scheduler_state
+    if scheduler_state is not None:
+        return scheduler_state
+    scheduler_state = {"target_send_minute": None, "target_clear_minute": None, "last_triggered_minute": None}
     if os.path.exists(STATE_FILE):
         try:
             with open(STATE_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
+                scheduler_state = json.load(f)
         except Exception as e:
             print(f"Ошибка загрузки состояния: {e}")
-    return {"target_send_minute": None, "target_clear_minute": None, "last_triggered_minute": None}
+    return scheduler_state
+
+def write_scheduler_state():
+    """Атомарная запись состояния планировщика на диск"""
+    atomic_write_json(STATE_FILE, scheduler_state)
 
 def save_scheduler_state(state):
     """Сохранение состояния планировщика"""
+    global scheduler_state
+    scheduler_state = state
     try:
-        with open(STATE_FILE, "w", encoding="utf-8") as f:
-            json.dump(state, f)
+        if flusher:
+            flusher.mark_dirty(STATE_FILE)
+        else:
+            write_scheduler_state()
     except Exception as e:
         print(f"Ошибка сохранения состояния: {e}")
 
-# Загрузка данных при запуске
-users_data = load_users_data()
-orders_history = load_orders_history()
+# Загрузка данных при запуске. Клиенты, выбранные позиции и шаги регистрации
+# живут в StateManager с блокировками по пользователям: их одновременно
+# меняют потоки вебхука и поток планировщика
+state = StateManager(load_users_data(), conversation_store)
+storage_backend.set_snapshot_source(state.snapshot_dict)
+
+def load_history_analytics():
+    """Свёртки истории для статистики; пересобираются, если отстали от истории"""
+    history_analytics = HistoryAnalytics(os.path.join(DATA_DIR, 'analytics.json'), flusher=flusher)
+    try:
+        if not history_analytics.load() or history_analytics.orders != storage_backend.history_orders_count():
+            print("Пересборка аналитики из истории...")
+            history_analytics.rebuild(storage_backend.export_history())
+    except Exception as e:
+        print(f"Ошибка загрузки аналитики: {e}")
+    return history_analytics
+
+analytics = load_history_analytics()
+
+if flusher:
+    flusher.register(STATE_FILE, write_scheduler_state)
+    flusher.start()
+    # Финальная запись накопленных изменений при остановке воркера
+    atexit.register(flusher.stop)
 
-print(f"Загружено пользователей: {len(users_data)}")
-print(f"Загружено дней в истории: {len(orders_history)}")
+print(f"Хранилище: {STORAGE_BACKEND}")
+print(f"Загружено пользователей: {state.user_count()}")
+print(f"Загружено дней в истории: {storage_backend.history_days_count()}")
 
 # === FLASK WEBHOOK ===
 
+# Входящие обновления: ограниченная очередь и пул воркеров с порядком по чатам
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', '4'))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', '1000'))
+# Маршруты callback_data, заполняются в разделе МАРШРУТЫ CALLBACK
+callback_router = CallbackRouter()
+# Коды упакованных действий (pack_callback); коды не переиспользуются
+CB_SELECT_PRODUCT = 1
+CB_EDIT_PRODUCT = 2
+CB_REPORT_PAGE = 3
+CB_CLIENT_PAGE = 4
+
+def update_handler_name(update):
+    """Тип и имя обработчика обновления для метрик"""
+    if update.callback_query:
+        return 'callback', callback_router.route_name(update.callback_query.data)
+    if update.message:
+        text = update.message.text or ''
+        if text.startswith('/'):
+            command = text.split()[0].split('@')[0]
+            return 'message', command if command in ('/start', '/admin') else 'command'
+        return 'message', 'text'
+    return 'other', 'other'
+
+def process_update(update):
+    kind, name = update_handler_name(update)
+    with HANDLER_SECONDS.time(kind=kind, name=name), tracer.trace(f"{kind}:{name}", update_id=update.update_id):
+        with responses.collect():
+            bot.process_new_updates([update])
+
+update_dispatcher = UpdateDispatcher(process_update, workers=WEBHOOK_WORKERS, max_size=WEBHOOK_QUEUE_SIZE)
+
 @app.route(BOT_URL, methods=['POST'])
 def webhook():
+    started = time.perf_counter()
+    response = receive_update()
+    status = response[1] if isinstance(response, tuple) else 200
+    WEBHOOK_SECONDS.observe(time.perf_counter() - started, status=status)
+    return response
+
+def receive_update():
     print(f"ПОЛУЧЕН POST на {BOT_URL}")
     try:
         if request.headers.get('content-type') == 'application/json':
             json_string = request.get_data().decode('utf-8')
             update = telebot.types.Update.de_json(json_string)
-            bot.process_new_updates([update])
+            # Обработка идёт в фоне, Telegram сразу получает ответ
+            if not update_dispatcher.submit(update_chat_id(update), update):
+                print(f"ОЧЕРЕДЬ ПЕРЕПОЛНЕНА: {update_dispatcher.stats()}")
+                return 'Busy', 503
             return '', 200
         else:
             print("ОТКЛОНЁН: не JSON")
@@ -143,28 +344,147 @@ def webhook():
         print(f"ОШИБКА В WEBHOOK: {e}")
         return 'Error', 500
 
+@app.route('/metrics')
+def metrics():
+    if METRICS_TOKEN and request.args.get('token') != METRICS_TOKEN \
+            and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+        abort(403)
+    return metrics_registry.render(), 200, {'Content-Type': METRICS_CONTENT_TYPE}
+
 @app.route('/')
 def index():
     return "Бот работает на Railway!"
 
+# === КЛАВИАТУРЫ И ШАБЛОНЫ ===
+
+MAIN_MENU_TEXT = "{location_name}\n{address}\n\nВыберите действие:"
+REMINDER_TEXT = (
+    "⏰ **Напоминание!**\n\n"
+    "Через 1 час заказ на следующий день будет закрыт.\n\n"
+    "У вас в корзине пусто. Не хотите сделать заказ?\n\n"
+    "📍 {location_name}\n"
+    "📮 {address}"
+)
+
+def build_main_menu():
+    markup = InlineKeyboardMarkup(row_width=2)
+    markup.add(
+        InlineKeyboardButton('Добавить заказ', callback_data='add_order'),
+        InlineKeyboardButton('Мой заказ', callback_data='my_order'),
+        InlineKeyboardButton('Изменить заказ', callback_data='edit_order'),
+        InlineKeyboardButton('Мои данные', callback_data='my_data'),
+    )
+    return markup
+
+def build_positions_menu():
+    markup = InlineKeyboardMarkup(row_width=2)
+    for product in catalog:
+        markup.add(InlineKeyboardButton(product.name, callback_data=pack_callback(CB_SELECT_PRODUCT, product.id)))
+    markup.add(InlineKeyboardButton('Назад', callback_data='back_to_main'))
+    return markup
+
+def build_edit_menu(*product_ids):
+    markup = InlineKeyboardMarkup(row_width=2)
+    for product_id in product_ids:
+        markup.add(InlineKeyboardButton(catalog.get(product_id).name,
+                                        callback_data=pack_callback(CB_EDIT_PRODUCT, product_id)))
+    markup.add(InlineKeyboardButton('Добавить еще', callback_data='add_order'))
+    markup.add(InlineKeyboardButton('Очистить все', callback_data='clear_order'))
+    markup.add(InlineKeyboardButton('Назад', callback_data='back_to_main'))
+    return markup
+
+def build_reminder_menu():
+    markup = InlineKeyboardMarkup(row_width=2)
+    markup.add(
+        InlineKeyboardButton('🛒 Сделать заказ', callback_data='add_order'),
+        InlineKeyboardButton('📋 Мой заказ', callback_data='my_order'),
+    )
+    return markup
+
+def build_admin_panel():
+    markup = InlineKeyboardMarkup(row_width=2)
+    markup.add(
+        InlineKeyboardButton('Excel Сводка', callback_data='admin_excel'),
+        InlineKeyboardButton('Текстовая сводка', callback_data='admin_summary'),
+        InlineKeyboardButton('База клиентов', callback_data='admin_clients'),
+        InlineKeyboardButton('Удалить клиентов', callback_data='admin_delete_clients'),
+        InlineKeyboardButton('История заказов', callback_data='admin_history'),
+        InlineKeyboardButton('Обнулить заказы', callback_data='admin_clear'),
+        InlineKeyboardButton('⏰ Отправить напоминания', callback_data='admin_send_reminders'),
+        InlineKeyboardButton('Экспорт данных', callback_data='admin_export'),
+    )
+    return markup
+
+# Статичные клавиатуры сериализуются один раз, сбрасываются при смене каталога
+keyboards = KeyboardCache(version=lambda: catalog.version)
+keyboards.register('main_menu', build_main_menu)
+keyboards.register('positions', build_positions_menu)
+keyboards.register('edit_menu', build_edit_menu)
+keyboards.register('reminder', build_reminder_menu)
+keyboards.register('admin_panel', build_admin_panel)
+
 # === ФУНКЦИИ БОТА ===
 
+def get_active_users():
+    """Клиенты с заказами, отсортированные по названию точки"""
+    if SHARED_STATE != 'memory':
+        # Заказы могли прийти через другие воркеры — читаем общую базу
+        active_users = storage_backend.active_users()
+        active_users.sort(key=lambda x: x['location_name'])
+        return active_users
+    return state.active_users_sorted()
+
+def get_reminder_recipients():
+    """Зарегистрированные клиенты без заказов: user_id -> копия данных"""
+    if SHARED_STATE != 'memory':
+        # Заказы и регистрации могли прийти через другие воркеры — читаем общую базу
+        return {data['user_id']: data for data in storage_backend.users_without_orders()}
+    return state.snapshot_dict(lambda data: data.get('registered') and not data.get('orders'))
+
+def get_all_users():
+    """Копия всей базы клиентов user_id -> данные"""
+    if SHARED_STATE != 'memory':
+        return storage_backend.all_users()
+    return state.snapshot_dict()
+
+def get_user_count():
+    if SHARED_STATE != 'memory':
+        return storage_backend.user_count()
+    return state.user_count()
+
+def get_position_totals(active_users):
+    """Суммы по позициям за сегодня в порядке меню"""
+    if SHARED_STATE != 'memory':
+        totals = {}
+        for user_data in active_users:
+            for pos, qty in user_data['orders'].items():
+                totals[pos] = totals.get(pos, 0) + qty
+    else:
+        totals = state.aggregates.totals()
+    ordered = list(positions) + sorted(pos for pos in totals if pos not in positions)
+    return [(pos, totals[pos]) for pos in ordered if totals.get(pos)]
+
+@tracer.traced()
 def get_user_data(user_id):
     """Получить данные пользователя"""
     user_id_str = str(user_id)
-    if user_id_str not in users_data:
-        users_data[user_id_str] = {
-            'user_id': user_id_str,
-            'address': '',
-            'location_name': '', 
-            'orders': {},
-            'registered': False,
-            'registration_date': datetime.now().strftime('%d.%m.%Y %H:%M')
-        }
-        save_users_data()
-    return users_data[user_id_str]
+    if SHARED_STATE != 'memory':
+        # Клиента могли изменить другие воркеры — берём свежую версию из базы
+        state.refresh_user(user_id_str, storage_backend.load_user(user_id_str))
+    user_data, created = state.get_or_create_user(user_id_str, lambda: {
+        'user_id': user_id_str,
+        'address': '',
+        'location_name': '', 
+        'orders': {},
+        'registered': False,
+        'registration_date': datetime.now().strftime('%d.%m.%Y %H:%M')
+    })
+    if created:
+        save_user_data(user_id_str)
+    return user_data
 
 @bot.message_handler(commands=['start'])
+@tracer.traced()
 def start(message: Message):
     user_id = message.from_user.id
     user_data = get_user_data(user_id)
@@ -177,7 +497,7 @@ def start(message: Message):
 def start_registration(message):
     """Начать процесс регистрации"""
     user_id = message.from_user.id
-    registration_steps[user_id] = 'waiting_location'
+    state.set_step(user_id, 'waiting_location')
     
     bot.send_message(
         message.chat.id,
@@ -187,54 +507,84 @@ def start_registration(message):
     )
 
 @bot.message_handler(commands=['admin'])
+@tracer.traced()
 def admin_panel(message: Message):
     """Панель администратора"""
     if str(message.chat.id) != ADMIN_CHAT_ID:
         bot.reply_to(message, "Доступ запрещен")
         return
     
-    markup = InlineKeyboardMarkup(row_width=2)
-    buttons = [
-        InlineKeyboardButton('Excel Сводка', callback_data='admin_excel'),
-        InlineKeyboardButton('Текстовая сводка', callback_data='admin_summary'),
-        InlineKeyboardButton('База клиентов', callback_data='admin_clients'),
-        InlineKeyboardButton('Удалить клиентов', callback_data='admin_delete_clients'),
-        InlineKeyboardButton('История заказов', callback_data='admin_history'),
-        InlineKeyboardButton('Обнулить заказы', callback_data='admin_clear'),
-        InlineKeyboardButton('⏰ Отправить напоминания', callback_data='admin_send_reminders'),
-        InlineKeyboardButton('Экспорт данных', callback_data='admin_export'),
-    ]
-    markup.add(*buttons)
-    
-    stats_text = f"**Статистика:**\nКлиентов: {len(users_data)}\nДней в истории: {len(orders_history)}"
+    if SHARED_STATE != 'memory':
+        active_users = get_active_users()
+        active_count = len(active_users)
+        total_items = sum(qty for _, qty in get_position_totals(active_users))
+    else:
+        active_count = state.aggregates.active_count()
+        total_items = state.aggregates.total_items()
+    stats_text = (
+        f"**Статистика:**\nКлиентов: {get_user_count()}\n"
+        f"С заказом сегодня: {active_count} ({total_items} шт.)\n"
+        f"Дней в истории: {storage_backend.history_days_count()}"
+    )
     
-    bot.send_message(message.chat.id, f"**Панель администратора**\n\n{stats_text}", reply_markup=markup)
+    responses.send(message.chat.id, f"**Панель администратора**\n\n{stats_text}",
+                   reply_markup=keyboards.get('admin_panel'))
+
+@bot.message_handler(commands=['traces'])
+def show_slow_traces(message: Message):
+    """Самые медленные из последних трассированных операций: /traces [N]"""
+    if str(message.chat.id) != ADMIN_CHAT_ID:
+        bot.reply_to(message, "Доступ запрещен")
+        return
+    if not tracer.enabled:
+        bot.send_message(message.chat.id, "Трассировка выключена (TRACE_SAMPLE_RATE=0)")
+        return
+    parts = message.text.split()
+    limit = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 10
+    traces = tracer.slowest(min(limit, 30))
+    if not traces:
+        bot.send_message(message.chat.id, "Трасс пока нет")
+        return
+    lines = [f"Самые медленные операции (выборка {TRACE_SAMPLE_RATE:.0%}):", ""]
+    for i, trace in enumerate(traces, 1):
+        trace_lines = format_trace(trace)
+        lines.append(f"{i}. {trace_lines[0]}")
+        lines.extend(trace_lines[1:])
+    bot.send_message(message.chat.id, "\n".join(lines)[:4000])
 
 @bot.message_handler(func=lambda message: True)
+@tracer.traced()
 def handle_messages(message: Message):
     user_id = message.from_user.id
     
+    # Поисковый запрос в выборе клиента (только администратор)
+    if str(message.chat.id) == ADMIN_CHAT_ID and (state.get_client_search(user_id) or {}).get('awaiting'):
+        handle_client_search(message)
+        return
+    
     # Обработка регистрации
-    if user_id in registration_steps:
+    if state.get_step(user_id):
         handle_registration(message)
         return
     
     # Обработка количества для заказов
-    if user_id in current_orders:
+    if state.get_pending_order(user_id):
         handle_quantity(message)
         return
     
     bot.reply_to(message, "Используйте меню для навигации")
 
+@tracer.traced()
 def handle_registration(message: Message):
     """Обработка шагов регистрации"""
     user_id = message.from_user.id
-    step = registration_steps.get(user_id)
+    step = state.get_step(user_id)
     user_data = get_user_data(user_id)
     
     if step == 'waiting_location':
-        user_data['location_name'] = message.text.strip()
-        registration_steps[user_id] = 'waiting_address'
+        state.update_user(str(user_id), location_name=message.text.strip())
+        save_user_data(str(user_id))
+        state.set_step(user_id, 'waiting_address')
         
         bot.send_message(
             message.chat.id,
@@ -243,14 +593,13 @@ def handle_registration(message: Message):
         )
         
     elif step == 'waiting_address':
-        user_data['address'] = message.text.strip()
-        user_data['registered'] = True
-        user_data['registration_date'] = datetime.now().strftime('%d.%m.%Y %H:%M')
-        del registration_steps[user_id]
+        state.update_user(str(user_id), address=message.text.strip(), registered=True,
+                          registration_date=datetime.now().strftime('%d.%m.%Y %H:%M'))
+        state.clear_step(user_id)
         
-        save_users_data()
+        save_user_data(str(user_id))
         
-        bot.send_message(
+        responses.send(
             message.chat.id,
             f"**Регистрация завершена!**\n\n"
             f"Точка: {user_data['location_name']}\n"
@@ -262,88 +611,58 @@ def handle_registration(message: Message):
 
 def show_main_menu(chat_id, user_data):
     """Показать главное меню"""
-    markup = InlineKeyboardMarkup(row_width=2)
-    buttons = [
-        InlineKeyboardButton('Добавить заказ', callback_data='add_order'),
-        InlineKeyboardButton('Мой заказ', callback_data='my_order'),
-        InlineKeyboardButton('Изменить заказ', callback_data='edit_order'),
-        InlineKeyboardButton('Мои данные', callback_data='my_data'),
-    ]
-    markup.add(*buttons)
-    
-    welcome_text = f"{user_data['location_name']}\n{user_data['address']}\n\nВыберите действие:"
-    bot.send_message(chat_id, welcome_text, reply_markup=markup)
+    responses.send(chat_id, MAIN_MENU_TEXT.format_map(user_data), reply_markup=keyboards.get('main_menu'))
 
 @bot.callback_query_handler(func=lambda call: True)
+@tracer.traced()
 def handle_callback(call):
-    user_id = call.from_user.id
-    chat_id = call.message.chat.id
-    user_data = get_user_data(user_id)
-    
-    if call.data == 'add_order':
-        show_positions_menu(chat_id)
-    elif call.data == 'my_order':
-        show_user_order(call, user_data)
-    elif call.data == 'edit_order':
-        show_edit_menu(call, user_data)
-    elif call.data == 'my_data':
-        show_user_data(call, user_data)
-    elif call.data == 'admin_excel':
-        send_excel_summary(call)
-    elif call.data == 'admin_summary':
-        send_text_summary(call)
-    elif call.data == 'admin_clients':
-        show_clients_database(call)
-    elif call.data == 'admin_delete_clients':
-        show_delete_clients_menu(call)
-    elif call.data == 'admin_history':
-        show_orders_history(call)
-    elif call.data == 'admin_stats':
-        show_detailed_statistics(call)
-    elif call.data == 'admin_history_dates':
-        show_history_by_dates(call)
-    elif call.data.startswith('history_date_'):
-        date_str = call.data.replace('history_date_', '')
-        show_history_for_date(call, date_str)
-    elif call.data == 'admin_clear':
-        clear_all_orders(call)
-    elif call.data == 'admin_send_reminders':
-        send_reminders_manually(call)
-    elif call.data == 'admin_export':
-        export_all_data(call)
-    elif call.data in positions:
-        current_orders[user_id] = {'position': call.data}
-        bot.answer_callback_query(call.id, f"Выбрано: {call.data}")
-        bot.send_message(chat_id, f"Сколько штук {call.data}?")
-    elif call.data.startswith('edit_'):
-        position = call.data[5:]
-        current_orders[user_id] = {'position': position, 'editing': True}
-        bot.answer_callback_query(call.id, f"Изменяем: {position}")
-        bot.send_message(chat_id, f"Введите новое количество для {position}:")
-    elif call.data == 'back_to_main':
-        bot.answer_callback_query(call.id, "Возврат в меню")
-        bot.delete_message(chat_id, call.message.message_id)
-        show_main_menu(chat_id, user_data)
-    elif call.data == 'clear_order':
-        user_data['orders'] = {}
-        save_users_data()
-        bot.answer_callback_query(call.id, "Заказ очищен")
-        bot.delete_message(chat_id, call.message.message_id)
-        show_main_menu(chat_id, user_data)
-    elif call.data.startswith('delete_user_'):
-        delete_user(call)
-    elif call.data == 'back_to_admin':
+    if not callback_router.dispatch(call):
+        # Устаревшая или чужая кнопка: клиента не создаём, только снимаем «часики»
+        print(f"Неизвестный callback от {call.from_user.id}: {call.data}")
         bot.answer_callback_query(call.id)
-        bot.delete_message(chat_id, call.message.message_id)
-        admin_panel(call.message)
+
+def open_positions_menu(call):
+    show_positions_menu(call.message.chat.id)
+
+def select_position(call, product_id):
+    product = catalog.get(product_id)
+    if product is None:
+        bot.answer_callback_query(call.id, "Позиция больше недоступна")
+        return
+    state.set_pending_order(call.from_user.id, {'position': product.name})
+    bot.answer_callback_query(call.id, f"Выбрано: {product.name}")
+    bot.send_message(call.message.chat.id, f"Сколько штук {product.name}?")
+
+def edit_position(call, product_id):
+    product = catalog.get(product_id)
+    if product is None:
+        bot.answer_callback_query(call.id, "Позиция больше недоступна")
+        return
+    state.set_pending_order(call.from_user.id, {'position': product.name, 'editing': True})
+    bot.answer_callback_query(call.id, f"Изменяем: {product.name}")
+    bot.send_message(call.message.chat.id, f"Введите новое количество для {product.name}:")
+
+def back_to_main(call, user_data):
+    bot.answer_callback_query(call.id, "Возврат в меню")
+    # Меню встанет на место сообщения с нажатой кнопкой
+    responses.replace(call.message.chat.id, call.message.message_id)
+    show_main_menu(call.message.chat.id, user_data)
+
+def clear_order(call, user_data):
+    user_id_str = str(call.from_user.id)
+    state.clear_user_orders(user_id_str)
+    save_user_data(user_id_str)
+    bot.answer_callback_query(call.id, "Заказ очищен")
+    responses.replace(call.message.chat.id, call.message.message_id)
+    show_main_menu(call.message.chat.id, user_data)
+
+def back_to_admin(call):
+    bot.answer_callback_query(call.id)
+    responses.replace(call.message.chat.id, call.message.message_id)
+    admin_panel(call.message)
 
 def show_positions_menu(chat_id):
-    markup = InlineKeyboardMarkup(row_width=2)
-    for pos in positions.keys():
-        markup.add(InlineKeyboardButton(pos, callback_data=pos))
-    markup.add(InlineKeyboardButton('Назад', callback_data='back_to_main'))
-    
-    bot.send_message(chat_id, "Выберите позицию для заказа:", reply_markup=markup)
+    bot.send_message(chat_id, "Выберите позицию для заказа:", reply_markup=keyboards.get('positions'))
 
 def show_user_order(call, user_data):
     user_orders = user_data['orders']
@@ -388,24 +707,22 @@ def show_edit_menu(call, user_data):
         bot.answer_callback_query(call.id, "Нет заказов для редактирования")
         return
     
-    markup = InlineKeyboardMarkup(row_width=2)
-    
-    for pos in user_orders.keys():
-        markup.add(InlineKeyboardButton(f"{pos}", callback_data=f'edit_{pos}'))
-    
-    markup.add(InlineKeyboardButton('Добавить еще', callback_data='add_order'))
-    markup.add(InlineKeyboardButton('Очистить все', callback_data='clear_order'))
-    markup.add(InlineKeyboardButton('Назад', callback_data='back_to_main'))
+    # Клавиатура зависит только от набора позиций — кэшируется по их id
+    products = [catalog.by_name(pos) for pos in user_orders]
+    markup = keyboards.get('edit_menu', *(product.id for product in products if product))
     
     bot.answer_callback_query(call.id)
     bot.send_message(call.message.chat.id, "Выберите позицию для изменения:", reply_markup=markup)
 
+@tracer.traced()
 def handle_quantity(message: Message):
     user_id = message.from_user.id
     chat_id = message.chat.id
     user_data = get_user_data(user_id)
     
-    position_data = current_orders[user_id]
+    position_data = state.get_pending_order(user_id)
+    if not position_data:
+        return
     position = position_data['position']
     is_editing = position_data.get('editing', False)
     
@@ -414,134 +731,120 @@ def handle_quantity(message: Message):
         if quantity < 0:
             raise ValueError
         
+        state.set_order_quantity(str(user_id), position, quantity)
         if quantity == 0:
-            if position in user_data['orders']:
-                del user_data['orders'][position]
             action_text = f"Удалено: {position}"
         else:
-            user_data['orders'][position] = quantity
             action_text = f"{'Обновлено' if is_editing else 'Добавлено'} {quantity} шт. {position}"
         
-        save_users_data()
+        save_user_data(str(user_id))
         
-        bot.reply_to(message, f"{action_text} для {user_data['location_name']}!")
-        del current_orders[user_id]
+        # Подтверждение и меню уходят одним сообщением
+        responses.send(chat_id, f"{action_text} для {user_data['location_name']}!", reply_to=message.message_id)
+        state.clear_pending_order(user_id)
         
         show_main_menu(chat_id, user_data)
         
     except ValueError:
         bot.reply_to(message, "Введите целое число (0 для удаления позиции):")
 
+# === ФОНОВЫЕ ОТЧЁТЫ ===
+
+# Excel-сводка, бэкап и статистика для админа собираются вне потоков вебхука:
+# в REPORT_WORKERS процессах (0 — в потоках). Готовые файлы кэшируются по
+# версии данных, повторный запрос без изменений отдаётся сразу. О сборке
+# дольше REPORT_PROGRESS_INTERVAL секунд админу пишется сообщение с ходом.
+REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS', '2'))
+REPORT_CACHE_SIZE = int(os.environ.get('REPORT_CACHE_SIZE', '8'))
+REPORT_PROGRESS_INTERVAL = float(os.environ.get('REPORT_PROGRESS_INTERVAL', '5'))
+REPORT_TIMEOUT = float(os.environ.get('REPORT_TIMEOUT', '600'))
+REPORT_THREADS = max(2, REPORT_WORKERS * 2)
+report_service = ReportService(
+    workers=REPORT_WORKERS,
+    threads=REPORT_THREADS,
+    cache_size=REPORT_CACHE_SIZE,
+    progress_interval=REPORT_PROGRESS_INTERVAL,
+    timeout=REPORT_TIMEOUT,
+    on_build=lambda name, seconds, ok: REPORT_BUILD_SECONDS.observe(
+        seconds, report=name, outcome='ok' if ok else 'error'),
+)
+
+REPORT_ANSWERS = {
+    'started': "Формирую отчёт...",
+    'joined': "Отчёт уже формируется, пришлю, когда будет готов",
+    'cached': "Данные не менялись, отправляю готовый отчёт",
+}
+
+def users_data_version():
+    """Версия базы клиентов для кэша отчётов; None — базу меняют и другие воркеры"""
+    return state.version if SHARED_STATE == 'memory' else None
+
+def start_report(call, name, title, key, prepare, build, send, in_pool=True):
+    """Запустить отчёт для админа в фоне; готовый результат уходит в send(chat_id, artifact)"""
+    chat_id = call.message.chat.id
+    status = {}
+
+    def show_status(text):
+        if status.get('text') == text:
+            return
+        if 'message_id' in status:
+            bot.edit_message_text(text, chat_id, status['message_id'])
+        else:
+            status['message_id'] = bot.send_message(chat_id, text).message_id
+        status['text'] = text
+
+    def progress(seconds):
+        show_status(f"⏳ {title}: собираю, прошло {seconds:.0f} с...")
+
+    def deliver(artifact, error):
+        if error is not None:
+            print(f"Ошибка отчёта {name}: {error}")
+            bot.send_message(chat_id, f"Ошибка при формировании отчёта «{title}»: {error}")
+            return
+        send(chat_id, artifact)
+        if 'message_id' in status:
+            show_status(f"✅ {title}: готово за {artifact.seconds:.1f} с")
+
+    result = report_service.run(name, key, prepare, build, deliver, progress=progress, in_pool=in_pool)
+    REPORTS.inc(report=name, result=result)
+    bot.answer_callback_query(call.id, REPORT_ANSWERS[result])
+
+def report_time(artifact, fmt='%d.%m.%Y %H:%M'):
+    """Время снимка данных, на которых собран отчёт"""
+    return datetime.fromtimestamp(artifact.created_at).strftime(fmt)
+
 # === ГЕНЕРАЦИЯ EXCEL ===
 
+@tracer.traced()
 def generate_excel_file():
     """Генерация Excel файла со сводкой"""
-    active_users = [data for data in users_data.values() if data.get('orders') and data.get('registered')]
-    
-    if not active_users:
-        return None
-    
-    active_users.sort(key=lambda x: x['location_name'])
-    
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Сводка заказов"
-    
-    # Стили
-    header_font = Font(bold=True, size=14)
-    title_font = Font(bold=True, size=12)
-    bold_font = Font(bold=True)
-    center_align = Alignment(horizontal='center', vertical='center')
-    border = Border(left=Side(style='thin'), right=Side(style='thin'), 
-                   top=Side(style='thin'), bottom=Side(style='thin'))
-    
-    # Заголовок
-    num_positions = len(positions)
-    header_end_col = get_column_letter(3 + num_positions + 1)
-    ws.merge_cells(f'A1:{header_end_col}1')
-    ws['A1'] = f"Сводка заказов от {datetime.now().strftime('%d.%m.%Y')}"
-    ws['A1'].font = header_font
-    ws['A1'].alignment = center_align
-    
-    ws.append([])
-    
-    headers = ['№', 'Точка', 'Адрес'] + list(positions.keys()) + ['ИТОГО']
-    ws.append(headers)
-    
-    header_row = 3
-    for col in range(1, len(headers) + 1):
-        cell = ws.cell(row=header_row, column=col)
-        cell.font = title_font
-        cell.alignment = center_align
-        cell.border = border
-    
-    row_num = 4
-    for i, user_data in enumerate(active_users, 1):
-        row = [i, user_data['location_name'], user_data['address']]
-        total = 0
-        
-        for pos in positions.keys():
-            qty = user_data['orders'].get(pos, 0)
-            row.append(qty)
-            total += qty
-        
-        row.append(total)
-        ws.append(row)
-        
-        for col in range(1, len(headers) + 1):
-            cell = ws.cell(row=row_num, column=col)
-            cell.border = border
-            if col in [1, len(headers)]:
-                cell.font = bold_font
-        row_num += 1
-    
-    ws.append([])
-    row_num += 1
-    total_row = ['ВСЕГО', '', '']
-    
-    for pos_idx in range(len(positions)):
-        col_idx = 4 + pos_idx
-        pos_total = sum(ws.cell(row=r, column=col_idx).value or 0 for r in range(4, row_num))
-        total_row.append(pos_total)
-    
-    grand_total = sum(total_row[3:])
-    total_row.append(grand_total)
-    ws.append(total_row)
-    
-    for col in range(1, len(headers) + 1):
-        cell = ws.cell(row=row_num + 1, column=col)
-        cell.font = bold_font
-        cell.border = border
-        if col >= 4:
-            cell.alignment = center_align
-    
-    column_widths = {'A': 5, 'B': 25, 'C': 30}
-    for i, pos in enumerate(positions.keys(), 4):
-        col_letter = get_column_letter(i)
-        column_widths[col_letter] = 8
-    column_widths[get_column_letter(len(headers))] = 10
-    
-    for col, width in column_widths.items():
-        ws.column_dimensions[col].width = width
-    
-    excel_buffer = io.BytesIO()
-    wb.save(excel_buffer)
-    excel_buffer.seek(0)
-    
-    return excel_buffer
+    active_users = get_active_users()
+    return build_orders_workbook(active_users, list(positions.keys()), datetime.now().strftime('%d.%m.%Y'))
+
+@tracer.traced()
+def send_excel_summary(call=None, run_date=None):
+    """Отправка Excel сводки
 
-def send_excel_summary(call=None):
-    """Отправка Excel сводки"""
+    По кнопке админа сводка собирается в фоне (report_service). Без call —
+    плановая сводка за run_date: заказы записываются в историю, ошибки
+    пробрасываются, чтобы планировщик повторил задачу.
+    """
+    if call:
+        date_formatted = datetime.now().strftime('%d.%m.%Y')
+        version = users_data_version()
+        start_report(
+            call, 'excel', 'Excel-сводка',
+            key=(version, catalog.version, date_formatted) if version is not None else None,
+            prepare=lambda: (get_active_users(), list(positions.keys()), date_formatted),
+            build=excel_summary_job,
+            send=lambda chat_id, artifact: send_excel_artifact(chat_id, artifact, date_formatted),
+        )
+        return
     try:
         excel_buffer = generate_excel_file()
         
         if not excel_buffer:
-            message = "Нет заказов за сегодня."
-            if call:
-                bot.answer_callback_query(call.id, "Нет заказов")
-                bot.send_message(call.message.chat.id, message)
-            else:
-                bot.send_message(ADMIN_CHAT_ID, message)
+            bot.send_message(ADMIN_CHAT_ID, "Нет заказов за сегодня.")
             return
         
         filename = f"заказы_{datetime.now().strftime('%d.%m.%Y')}.xlsx"
@@ -549,116 +852,223 @@ def send_excel_summary(call=None):
         
         input_file = telebot.types.InputFile(excel_buffer)
         
-        if call:
-            bot.answer_callback_query(call.id)
-            bot.send_document(
-                call.message.chat.id,
-                document=input_file,
-                caption=f"Сводка заказов от {datetime.now().strftime('%d.%m.%Y')}"
-            )
-        else:
-            # Сохраняем в историю
-            current_date = datetime.now().strftime('%Y-%m-%d')
-            for user_data in users_data.values():
-                if user_data.get('orders') and user_data.get('registered'):
-                    add_order_to_history(user_data, current_date)
-            
-            bot.send_document(
-                ADMIN_CHAT_ID,
-                document=input_file,
-                caption=f"Автоматическая сводка заказов от {datetime.now().strftime('%d.%m.%Y')}"
-            )
-            
+        # Сохраняем в историю до отправки: повтор после сбоя перезапишет тот же день
+        current_date = run_date or datetime.now().strftime('%Y-%m-%d')
+        metrics = commit_orders_to_history(current_date)
+        if not metrics:
+            raise RuntimeError(f"Ошибка записи истории за {current_date}")
+        storage_backend.apply_history_retention()
+        
+        bot.send_document(
+            ADMIN_CHAT_ID,
+            document=input_file,
+            caption=f"Автоматическая сводка заказов от {datetime.now().strftime('%d.%m.%Y')}"
+        )
+        history_text = f"История за {current_date}: {metrics['entries']} заказов записано\n"
+        if metrics['replaced']:
+            history_text += f"Заменено прежних записей дня: {metrics['replaced']}\n"
+        history_text += (
+            f"Снимок: {metrics['snapshot_ms']:.1f} мс, запись: {metrics['commit_ms']:.1f} мс, "
+            f"аналитика: {metrics['analytics_ms']:.1f} мс"
+        )
+        bot.send_message(ADMIN_CHAT_ID, history_text)
+        
     except Exception as e:
         print(f"Ошибка при отправке сводки: {e}")
-        error_message = f"Ошибка при генерации Excel: {e}"
-        if call:
-            bot.send_message(call.message.chat.id, error_message)
-        else:
-            bot.send_message(ADMIN_CHAT_ID, error_message)
+        # Планировщик повторит задачу и сообщит админу об окончательной ошибке
+        raise
+
+def send_excel_artifact(chat_id, artifact, date_formatted):
+    """Отправка готовой Excel-сводки из report_service"""
+    if artifact.data is None:
+        bot.send_message(chat_id, "Нет заказов за сегодня.")
+        return
+    excel_buffer = io.BytesIO(artifact.data)
+    excel_buffer.name = f"заказы_{date_formatted}.xlsx"
+    bot.send_document(
+        chat_id,
+        document=telebot.types.InputFile(excel_buffer),
+        caption=f"Сводка заказов от {date_formatted} (данные на {report_time(artifact, '%H:%M')})"
+    )
 
 # === АДМИНИСТРАТИВНЫЕ ФУНКЦИИ ===
 
+# Длинные отчёты листаются по страницам; страницы лежат в хранилище диалогов,
+# поэтому листать можно на любом воркере
+reports = Paginator(conversation_store)
+
+def report_markup(buttons, report_id, number, has_next):
+    nav = []
+    if number > 0:
+        nav.append(InlineKeyboardButton('◀️ Назад', callback_data=pack_callback(CB_REPORT_PAGE, report_id, number - 1)))
+    if has_next:
+        nav.append(InlineKeyboardButton('Далее ▶️', callback_data=pack_callback(CB_REPORT_PAGE, report_id, number + 1)))
+    if not nav and not buttons:
+        return None
+    markup = InlineKeyboardMarkup()
+    if nav:
+        markup.row(*nav)
+    for text, callback_data in buttons:
+        markup.add(InlineKeyboardButton(text, callback_data=callback_data))
+    return markup
+
+def show_report_page(call, report_id, number, replace=True):
+    """Страница отчёта; при листании заменяет предыдущую"""
+    result = reports.page(report_id, number)
+    if result is None:
+        bot.answer_callback_query(call.id, "Отчёт устарел, откройте его заново")
+        return
+    text, has_next, buttons = result
+    bot.answer_callback_query(call.id)
+    if replace:
+        responses.replace(call.message.chat.id, call.message.message_id)
+    responses.send(call.message.chat.id, text, reply_markup=report_markup(buttons, report_id, number, has_next))
+
+def send_report(call, report):
+    show_report_page(call, reports.open(report), 0, replace=False)
+
+@reports.renderer
+def render_summary_record(index, user_data):
+    total_items = sum(user_data['orders'].values())
+    details_str = ", ".join(f"{pos}:{qty}" for pos, qty in user_data['orders'].items() if qty > 0)
+    return (f"• **{user_data['location_name']}** - {total_items} шт.\n"
+            f"  {details_str}\n"
+            f"  {user_data['address']}\n\n")
+
+@tracer.traced()
 def send_text_summary(call):
     """Текстовая сводка"""
-    active_users = [data for data in users_data.values() if data.get('orders') and data.get('registered')]
+    active_users = get_active_users()
     
     if not active_users:
         bot.answer_callback_query(call.id, "Нет заказов")
         bot.send_message(call.message.chat.id, "Нет заказов за сегодня.")
         return
     
-    active_users.sort(key=lambda x: x['location_name'])
+    position_totals = get_position_totals(active_users)
     
-    summary_text = f"**Сводка заказов от {datetime.now().strftime('%d.%m.%Y')}**\n"
-    summary_text += f"Клиентов: {len(active_users)}\n\n"
+    title = f"**Сводка заказов от {datetime.now().strftime('%d.%m.%Y')}**"
+    header = f"{title}\n"
+    header += f"Клиентов: {len(active_users)}\n"
+    header += f"Всего: {sum(qty for _, qty in position_totals)} шт.\n\n"
+    header += "**По позициям:**\n"
+    header += "\n".join(f"• {pos}: {qty} шт." for pos, qty in position_totals)
     
-    for user_data in active_users:
-        total_items = sum(user_data['orders'].values())
-        order_details = [f"{pos}:{qty}" for pos, qty in user_data['orders'].items() if qty > 0]
-        
-        details_str = ", ".join(order_details)
-        summary_text += f"• **{user_data['location_name']}** - {total_items} шт.\n"
-        summary_text += f"  {details_str}\n"
-        summary_text += f"  {user_data['address']}\n\n"
-    
-    bot.answer_callback_query(call.id)
-    bot.send_message(call.message.chat.id, summary_text)
+    send_report(call, Report(title, active_users, render_summary_record, header=header))
+
+@reports.renderer
+def render_client_record(index, user_data):
+    order_count = sum(user_data['orders'].values())
+    last_order = "Сегодня" if order_count > 0 else "Нет заказов"
+    return (f"{index + 1}. **{user_data['location_name']}**\n"
+            f"   {user_data['address']}\n"
+            f"   Регистрация: {user_data.get('registration_date', 'неизвестно')}\n"
+            f"   {last_order} ({order_count} шт.)\n\n")
 
 def show_clients_database(call):
     """Показать базу клиентов"""
-    registered_users = [data for data in users_data.values() if data['registered']]
+    registered_users = storage_backend.registered_users()
     
     if not registered_users:
         bot.answer_callback_query(call.id, "База клиентов пуста")
         bot.send_message(call.message.chat.id, "База клиентов пуста.")
         return
     
-    clients_text = f"**БАЗА КЛИЕНТОВ**\nВсего: {len(registered_users)}\n\n"
+    title = "**БАЗА КЛИЕНТОВ**"
+    send_report(call, Report(title, registered_users, render_client_record,
+                             header=f"{title}\nВсего: {len(registered_users)}"))
+
+CLIENT_PICKER_PAGE = 10
+
+# Индекс клиентов воркера при общем хранилище и отметка журнала изменений в базе
+shared_directory = ClientDirectory()
+shared_directory_mark = None
+shared_directory_lock = threading.Lock()
+
+def get_client_directory():
+    """Поисковый индекс клиентов; при общем хранилище — догоняется по журналу изменений в базе"""
+    if SHARED_STATE == 'memory':
+        return state.directory
+    global shared_directory_mark
+    with shared_directory_lock:
+        mark, changed = storage_backend.user_changes(shared_directory_mark)
+        if changed is None:
+            shared_directory.rebuild({data['user_id']: data for data in storage_backend.registered_users()})
+        else:
+            for user_id_str, user_data in changed.items():
+                shared_directory.update(user_id_str, None, user_data)
+        shared_directory_mark = mark
+    return shared_directory
+
+def client_picker(admin_id, page):
+    """Текст и клавиатура страницы выбора клиента с учётом текущего поиска"""
+    query = (state.get_client_search(admin_id) or {}).get('query', '')
+    total, clients = get_client_directory().search(query, page * CLIENT_PICKER_PAGE, CLIENT_PICKER_PAGE)
+    pages = max(1, -(-total // CLIENT_PICKER_PAGE))
     
-    for i, user_data in enumerate(registered_users, 1):
-        order_count = sum(user_data['orders'].values())
-        last_order = "Сегодня" if order_count > 0 else "Нет заказов"
-        clients_text += f"{i}. **{user_data['location_name']}**\n"
-        clients_text += f"   {user_data['address']}\n"
-        clients_text += f"   Регистрация: {user_data.get('registration_date', 'неизвестно')}\n"
-        clients_text += f"   {last_order} ({order_count} шт.)\n\n"
+    text = "Выберите клиента для удаления:\n"
+    text += f"Найдено по запросу «{query}»: {total}" if query else f"Всего клиентов: {total}"
     
-    bot.answer_callback_query(call.id)
-    bot.send_message(call.message.chat.id, clients_text)
+    markup = InlineKeyboardMarkup(row_width=1)
+    for user_id_str, location_name, address in clients:
+        markup.add(InlineKeyboardButton(f"Удалить {location_name}", callback_data=f"delete_user_{user_id_str}"))
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton('◀️', callback_data=pack_callback(CB_CLIENT_PAGE, page - 1)))
+    if pages > 1:
+        nav.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=pack_callback(CB_CLIENT_PAGE, page)))
+    if page + 1 < pages:
+        nav.append(InlineKeyboardButton('▶️', callback_data=pack_callback(CB_CLIENT_PAGE, page + 1)))
+    if nav:
+        markup.row(*nav)
+    search_row = [InlineKeyboardButton('🔍 Поиск', callback_data='clients_search')]
+    if query:
+        search_row.append(InlineKeyboardButton('✖️ Сбросить поиск', callback_data='clients_search_reset'))
+    markup.row(*search_row)
+    markup.add(InlineKeyboardButton('Назад в админ', callback_data='back_to_admin'))
+    return text, markup
 
 def show_delete_clients_menu(call):
-    if str(call.message.chat.id) != ADMIN_CHAT_ID:
-        bot.answer_callback_query(call.id, "Доступ запрещен")
-        return
-    
-    registered_users = [data for data in users_data.values() if data['registered']]
-    
-    if not registered_users:
+    if not len(get_client_directory()):
         bot.answer_callback_query(call.id, "Нет клиентов")
         bot.send_message(call.message.chat.id, "Нет клиентов для удаления.")
         return
     
-    markup = InlineKeyboardMarkup(row_width=1)
-    for user_data in registered_users:
-        button_text = f"Удалить {user_data['location_name']}"
-        markup.add(InlineKeyboardButton(button_text, callback_data=f"delete_user_{user_data['user_id']}"))
-    
-    markup.add(InlineKeyboardButton('Назад в админ', callback_data='back_to_admin'))
-    
+    state.clear_client_search(call.from_user.id)
+    text, markup = client_picker(call.from_user.id, 0)
     bot.answer_callback_query(call.id)
-    bot.send_message(call.message.chat.id, "Выберите клиента для удаления:", reply_markup=markup)
+    responses.send(call.message.chat.id, text, reply_markup=markup)
 
-def delete_user(call):
-    if str(call.message.chat.id) != ADMIN_CHAT_ID:
-        bot.answer_callback_query(call.id, "Доступ запрещен")
-        return
-    
-    user_id_str = call.data.split('_')[-1]
-    if user_id_str in users_data:
-        location_name = users_data[user_id_str]['location_name']
-        del users_data[user_id_str]
-        save_users_data()
+def show_client_page(call, page):
+    text, markup = client_picker(call.from_user.id, page)
+    bot.answer_callback_query(call.id)
+    responses.replace(call.message.chat.id, call.message.message_id)
+    responses.send(call.message.chat.id, text, reply_markup=markup)
+
+def start_client_search(call):
+    """Следующее сообщение администратора станет поисковым запросом"""
+    state.set_client_search(call.from_user.id, {'awaiting': True})
+    bot.answer_callback_query(call.id)
+    bot.send_message(call.message.chat.id, "Введите часть названия точки или адреса:")
+
+def reset_client_search(call):
+    state.clear_client_search(call.from_user.id)
+    show_client_page(call, 0)
+
+def handle_client_search(message: Message):
+    state.set_client_search(message.from_user.id, {'query': message.text.strip()[:100]})
+    text, markup = client_picker(message.from_user.id, 0)
+    responses.send(message.chat.id, text, reply_markup=markup)
+
+@tracer.traced()
+def delete_user(call, user_id_str):
+    removed = state.delete_user(user_id_str)
+    if removed is None and SHARED_STATE != 'memory':
+        # Клиента мог зарегистрировать другой воркер — в кеше этого процесса его нет
+        removed = storage_backend.load_user(user_id_str)
+    if removed is not None:
+        location_name = removed['location_name']
+        delete_user_data(user_id_str)
         bot.answer_callback_query(call.id, f"Клиент {location_name} удален")
         bot.delete_message(call.message.chat.id, call.message.message_id)
         bot.send_message(call.message.chat.id, f"Клиент {location_name} удален из базы.")
@@ -667,20 +1077,15 @@ def delete_user(call):
 
 def show_orders_history(call):
     """Показать историю заказов"""
-    if not orders_history:
+    total_days = storage_backend.history_days_count()
+    if not total_days:
         bot.answer_callback_query(call.id, "История пуста")
         bot.send_message(call.message.chat.id, "История заказов пуста.")
         return
     
-    history_text = f"**ИСТОРИЯ ЗАКАЗОВ**\nДней в истории: {len(orders_history)}\n\n"
-    
-    sorted_dates = sorted(orders_history.keys(), reverse=True)[:7]
+    history_text = f"**ИСТОРИЯ ЗАКАЗОВ**\nДней в истории: {total_days}\n\n"
     
-    for date_str in sorted_dates:
-        date_orders = orders_history[date_str]
-        total_orders = len(date_orders)
-        total_items = sum(order['total_items'] for order in date_orders)
-        
+    for date_str, total_orders, total_items in storage_backend.history_days(limit=7):
         history_text += f"**{datetime.strptime(date_str, '%Y-%m-%d').strftime('%d.%m.%Y')}**\n"
         history_text += f"   Клиентов: {total_orders}\n"
         history_text += f"   Товаров: {total_items} шт.\n\n"
@@ -694,36 +1099,25 @@ def show_orders_history(call):
     bot.answer_callback_query(call.id)
     bot.send_message(call.message.chat.id, history_text, reply_markup=markup)
 
+@tracer.traced()
 def show_detailed_statistics(call):
     """Детальная статистика по всей истории"""
-    if not orders_history:
-        bot.answer_callback_query(call.id, "Нет данных")
-        bot.send_message(call.message.chat.id, "Нет данных для статистики.")
-        return
+    if SHARED_STATE != 'memory':
+        analytics.reload_if_changed()
+    # Итоги заранее посчитаны в аналитике — текст собирается в потоке, без процесса
+    start_report(call, 'stats', 'Статистика', key=analytics.version, prepare=tuple,
+                 build=render_detailed_statistics, send=send_detailed_statistics, in_pool=False)
+
+def render_detailed_statistics():
+    """Текст детальной статистики или None, если истории нет"""
+    # Итоги заранее посчитаны в аналитике, история здесь не перебирается
+    if not analytics.days_count():
+        return None
     
     # Общая статистика
-    total_days = len(orders_history)
-    total_clients_all = 0
-    total_items_all = 0
-    position_stats = {pos: 0 for pos in positions.keys()}
-    client_frequency = {}
-    
-    for date_str, date_orders in orders_history.items():
-        total_clients_all += len(date_orders)
-        
-        for order in date_orders:
-            total_items_all += order['total_items']
-            location_name = order['location_name']
-            
-            # Частота заказов по клиентам
-            if location_name not in client_frequency:
-                client_frequency[location_name] = 0
-            client_frequency[location_name] += 1
-            
-            # Статистика по позициям
-            for pos, qty in order['orders'].items():
-                if pos in position_stats:
-                    position_stats[pos] += qty
+    total_days = analytics.days_count()
+    total_clients_all = analytics.orders
+    total_items_all = analytics.items
     
     # Формируем отчёт
     stats_text = "**📊 ДЕТАЛЬНАЯ СТАТИСТИКА**\n\n"
@@ -734,51 +1128,49 @@ def show_detailed_statistics(call):
     stats_text += f"• Среднее товаров в день: {total_items_all // total_days if total_days > 0 else 0} шт.\n\n"
     
     # ТОП-5 популярных позиций
-    sorted_positions = sorted(position_stats.items(), key=lambda x: x[1], reverse=True)
     stats_text += "**🔥 ТОП-5 популярных позиций:**\n"
-    for i, (pos, qty) in enumerate(sorted_positions[:5], 1):
+    for i, (pos, qty) in enumerate(analytics.top_positions(5), 1):
         if qty > 0:
             stats_text += f"{i}. {pos}: {qty} шт.\n"
     stats_text += "\n"
     
     # ТОП-5 активных клиентов
-    sorted_clients = sorted(client_frequency.items(), key=lambda x: x[1], reverse=True)
     stats_text += "**👥 ТОП-5 активных клиентов:**\n"
-    for i, (client, count) in enumerate(sorted_clients[:5], 1):
+    for i, (client, count) in enumerate(analytics.top_clients(5), 1):
         stats_text += f"{i}. {client}: {count} заказ(ов)\n"
     stats_text += "\n"
     
     # Статистика за последние 7 дней
-    sorted_dates = sorted(orders_history.keys(), reverse=True)[:7]
     stats_text += "**📅 Последние 7 дней:**\n"
-    for date_str in sorted_dates:
-        date_orders = orders_history[date_str]
+    for date_str, orders_count, total_items in analytics.last_days(7):
         date_formatted = datetime.strptime(date_str, '%Y-%m-%d').strftime('%d.%m')
-        total_items = sum(order['total_items'] for order in date_orders)
-        stats_text += f"• {date_formatted}: {len(date_orders)} клиент(ов), {total_items} шт.\n"
-    
-    bot.answer_callback_query(call.id)
+        stats_text += f"• {date_formatted}: {orders_count} клиент(ов), {total_items} шт.\n"
+    return stats_text
+
+def send_detailed_statistics(chat_id, artifact):
+    stats_text = artifact.data
+    if stats_text is None:
+        bot.send_message(chat_id, "Нет данных для статистики.")
+        return
     
     # Если текст слишком длинный, разбиваем на части
     if len(stats_text) > 4000:
         parts = [stats_text[i:i+4000] for i in range(0, len(stats_text), 4000)]
         for part in parts:
-            bot.send_message(call.message.chat.id, part)
+            bot.send_message(chat_id, part)
     else:
-        bot.send_message(call.message.chat.id, stats_text)
+        bot.send_message(chat_id, stats_text)
 
 def show_history_by_dates(call):
     """Показать список дат для детального просмотра"""
-    if not orders_history:
+    recent_days = storage_backend.history_days(limit=14)  # Последние 14 дней
+    if not recent_days:
         bot.answer_callback_query(call.id, "Нет данных")
         return
     
-    sorted_dates = sorted(orders_history.keys(), reverse=True)[:14]  # Последние 14 дней
-    
     markup = InlineKeyboardMarkup(row_width=2)
-    for date_str in sorted_dates:
+    for date_str, orders_count, _ in recent_days:
         date_formatted = datetime.strptime(date_str, '%Y-%m-%d').strftime('%d.%m.%Y')
-        orders_count = len(orders_history[date_str])
         button_text = f"{date_formatted} ({orders_count})"
         markup.add(InlineKeyboardButton(button_text, callback_data=f'history_date_{date_str}'))
     
@@ -787,36 +1179,29 @@ def show_history_by_dates(call):
     bot.answer_callback_query(call.id)
     bot.send_message(call.message.chat.id, "Выберите дату для детального просмотра:", reply_markup=markup)
 
+@reports.renderer
+def render_history_record(index, order):
+    order_items = [f"{pos}:{qty}" for pos, qty in order['orders'].items() if qty > 0]
+    return (f"**{index + 1}. {order['location_name']}** ({order.get('timestamp', '??:??')})\n"
+            f"   {order['address']}\n"
+            f"   {', '.join(order_items)}\n"
+            f"   **Итого: {order['total_items']} шт.**\n\n")
+
+@tracer.traced()
 def show_history_for_date(call, date_str):
     """Показать детальную информацию за конкретную дату"""
-    if date_str not in orders_history:
+    date_orders = storage_backend.history_for_date(date_str)
+    if not date_orders:
         bot.answer_callback_query(call.id, "Дата не найдена")
         return
     
-    date_orders = orders_history[date_str]
     date_formatted = datetime.strptime(date_str, '%Y-%m-%d').strftime('%d.%m.%Y')
-    
-    detail_text = f"**📅 Заказы за {date_formatted}**\n"
-    detail_text += f"Клиентов: {len(date_orders)}\n\n"
+    title = f"**📅 Заказы за {date_formatted}**"
     
     # Сортируем по времени
     sorted_orders = sorted(date_orders, key=lambda x: x.get('timestamp', '00:00'))
     
-    for i, order in enumerate(sorted_orders, 1):
-        time_str = order.get('timestamp', '??:??')
-        detail_text += f"**{i}. {order['location_name']}** ({time_str})\n"
-        detail_text += f"   {order['address']}\n"
-        
-        # Детали заказа
-        order_items = []
-        for pos, qty in order['orders'].items():
-            if qty > 0:
-                order_items.append(f"{pos}:{qty}")
-        
-        detail_text += f"   {', '.join(order_items)}\n"
-        detail_text += f"   **Итого: {order['total_items']} шт.**\n\n"
-    
-    # Общая статистика за день
+    # Общая статистика за день — последней записью отчёта
     total_items = sum(order['total_items'] for order in date_orders)
     position_totals = {}
     for order in date_orders:
@@ -825,279 +1210,317 @@ def show_history_for_date(call, date_str):
                 position_totals[pos] = 0
             position_totals[pos] += qty
     
-    detail_text += "**📊 Итого за день:**\n"
-    detail_text += f"Всего товаров: {total_items} шт.\n\n"
-    detail_text += "**По позициям:**\n"
-    
+    footer = "**📊 Итого за день:**\n"
+    footer += f"Всего товаров: {total_items} шт.\n\n"
+    footer += "**По позициям:**\n"
     for pos, qty in sorted(position_totals.items(), key=lambda x: x[1], reverse=True):
         if qty > 0:
-            detail_text += f"• {pos}: {qty} шт.\n"
-    
-    bot.answer_callback_query(call.id)
+            footer += f"• {pos}: {qty} шт.\n"
     
-    # Если текст слишком длинный, разбиваем
-    if len(detail_text) > 4000:
-        parts = [detail_text[i:i+4000] for i in range(0, len(detail_text), 4000)]
-        for part in parts:
-            bot.send_message(call.message.chat.id, part)
-    else:
-        bot.send_message(call.message.chat.id, detail_text)
-    
-    # Кнопка назад
-    markup = InlineKeyboardMarkup()
-    markup.add(InlineKeyboardButton('Назад к датам', callback_data='admin_history_dates'))
-    bot.send_message(call.message.chat.id, "Выберите действие:", reply_markup=markup)
+    send_report(call, Report(title, sorted_orders, render_history_record,
+                             header=f"{title}\nКлиентов: {len(date_orders)}", footer=footer,
+                             buttons=[InlineKeyboardButton('Назад к датам', callback_data='admin_history_dates')]))
 
 def clear_all_orders(call):
     """Очистить все заказы"""
-    cleared_count = 0
-    for user_data in users_data.values():
-        if user_data['orders']:
-            user_data['orders'] = {}
-            cleared_count += 1
+    cleared_count = state.clear_all_orders()
     
-    save_users_data()
+    save_cleared_orders()
     
     bot.answer_callback_query(call.id, f"Очищено {cleared_count}")
     bot.send_message(call.message.chat.id, f"Очищены заказы у {cleared_count} клиентов!")
 
 def clear_all_orders_auto():
     """Автоматическая очистка заказов"""
-    cleared_count = 0
-    for user_data in users_data.values():
-        if user_data['orders']:
-            user_data['orders'] = {}
-            cleared_count += 1
+    cleared_count = state.clear_all_orders()
     
     if cleared_count > 0:
-        save_users_data()
+        save_cleared_orders()
     
     print(f"Автоматически очищены заказы у {cleared_count} пользователей")
     return cleared_count
 
+@tracer.traced()
 def export_all_data(call):
-    """Экспорт всех данных в JSON"""
-    try:
-        export_data = {
-            'users': users_data,
-            'orders_history': orders_history,
-            'export_date': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        }
-        
-        export_json = json.dumps(export_data, ensure_ascii=False, indent=2).encode('utf-8')
-        json_buffer = io.BytesIO(export_json)
-        filename = f"backup_data_{datetime.now().strftime('%Y%m%d_%H%M')}.json"
-        json_buffer.name = filename
-        
-        input_file = telebot.types.InputFile(json_buffer)
-        
-        bot.answer_callback_query(call.id)
-        bot.send_document(
-            call.message.chat.id,
-            document=input_file,
-            caption="Полный бэкап данных системы"
-        )
-    except Exception as e:
-        bot.answer_callback_query(call.id, "Ошибка экспорта")
-        bot.send_message(call.message.chat.id, f"Ошибка при экспорте данных: {e}")
+    """Экспорт всех данных в JSON (собирается в фоне)"""
+    version = users_data_version()
+    start_report(call, 'export', 'Бэкап данных',
+                 key=(version, analytics.version) if version is not None else None,
+                 prepare=prepare_export, build=json_export_job, send=send_export)
+
+def prepare_export():
+    """Снимок клиентов и истории для бэкапа"""
+    return ({
+        'users': get_all_users(),
+        'orders_history': storage_backend.export_history(),
+        'export_date': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    },)
+
+def send_export(chat_id, artifact):
+    json_buffer = io.BytesIO(artifact.data)
+    json_buffer.name = f"backup_data_{report_time(artifact, '%Y%m%d_%H%M')}.json"
+    bot.send_document(
+        chat_id,
+        document=telebot.types.InputFile(json_buffer),
+        caption=f"Полный бэкап данных системы на {report_time(artifact)}"
+    )
+
+# Ручная рассылка идёт в своём потоке: иначе она на минуты заняла бы воркер
+# очереди обновлений вместе со всеми чатами, которые на него попадают
+manual_reminders_lock = threading.Lock()
 
 def send_reminders_manually(call):
     """Ручная отправка напоминаний через админ-панель"""
-    if str(call.message.chat.id) != ADMIN_CHAT_ID:
-        bot.answer_callback_query(call.id, "Доступ запрещен")
+    if not manual_reminders_lock.acquire(blocking=False):
+        bot.answer_callback_query(call.id, "Напоминания уже отправляются")
         return
-    
-    bot.answer_callback_query(call.id, "Отправляю напоминания...")
-    
     try:
-        reminded_count = send_reminder_to_clients()
+        threading.Thread(target=run_manual_reminders, args=(call.message.chat.id,), daemon=True).start()
+    except Exception:
+        manual_reminders_lock.release()
+        raise
+    bot.answer_callback_query(call.id, "Отправляю напоминания, отчёт придёт по завершении")
+
+def run_manual_reminders(chat_id):
+    try:
+        result = send_reminder_to_clients()
         bot.send_message(
-            call.message.chat.id,
+            chat_id,
             f"✅ Напоминания отправлены!\n"
-            f"Клиентов без заказов: {reminded_count}"
+            f"Клиентов без заказов: {result['total']}\n\n"
+            f"{format_broadcast_report(result)}"
         )
     except Exception as e:
-        bot.send_message(call.message.chat.id, f"❌ Ошибка отправки напоминаний: {e}")
+        bot.send_message(chat_id, f"❌ Ошибка отправки напоминаний: {e}")
+    finally:
+        manual_reminders_lock.release()
+
+# === МАРШРУТЫ CALLBACK ===
+
+def admin_only(next_handler, call, *args):
+    """Middleware: маршрут только для администратора"""
+    if str(call.message.chat.id) != ADMIN_CHAT_ID:
+        bot.answer_callback_query(call.id, "Доступ запрещен")
+        return
+    return next_handler(call, *args)
+
+def with_user(next_handler, call, *args):
+    """Middleware: загрузить данные клиента последним аргументом"""
+    return next_handler(call, *args, get_user_data(call.from_user.id))
+
+callback_router.add('add_order', open_positions_menu)
+callback_router.add('my_order', show_user_order, middleware=[with_user])
+callback_router.add('edit_order', show_edit_menu, middleware=[with_user])
+callback_router.add('my_data', show_user_data, middleware=[with_user])
+callback_router.add('back_to_main', back_to_main, middleware=[with_user])
+callback_router.add('clear_order', clear_order, middleware=[with_user])
+callback_router.add_packed(CB_SELECT_PRODUCT, select_position, name='position')
+callback_router.add_packed(CB_EDIT_PRODUCT, edit_position, name='edit_position')
+# Кнопки прежнего формата (название товара) в уже отправленных сообщениях
+for product in catalog:
+    callback_router.add(product.name, select_position, args=[product.id], name='position')
+    callback_router.add(f'edit_{product.name}', edit_position, args=[product.id], name='edit_position')
+
+ADMIN_ROUTES = {
+    'admin_excel': send_excel_summary,
+    'admin_summary': send_text_summary,
+    'admin_clients': show_clients_database,
+    'admin_delete_clients': show_delete_clients_menu,
+    'admin_history': show_orders_history,
+    'admin_stats': show_detailed_statistics,
+    'admin_history_dates': show_history_by_dates,
+    'admin_clear': clear_all_orders,
+    'admin_send_reminders': send_reminders_manually,
+    'admin_export': export_all_data,
+    'back_to_admin': back_to_admin,
+    'clients_search': start_client_search,
+    'clients_search_reset': reset_client_search,
+}
+for data, handler in ADMIN_ROUTES.items():
+    callback_router.add(data, handler, middleware=[admin_only])
+callback_router.add_prefix('history_date_', show_history_for_date, middleware=[admin_only])
+callback_router.add_prefix('delete_user_', delete_user, middleware=[admin_only])
+callback_router.add_packed(CB_REPORT_PAGE, show_report_page, middleware=[admin_only], name='report_page')
+callback_router.add_packed(CB_CLIENT_PAGE, show_client_page, middleware=[admin_only], name='client_page')
 
 # === ПЛАНИРОВЩИК ЗАДАЧ ===
 
+# Массовые рассылки: общий лимит в секунду, параллельные отправители,
+# прогресс в DATA_DIR/broadcasts для досылки после рестарта. Прерванная
+# рассылка старше BROADCAST_MAX_AGE секунд не досылается: напоминание
+# после очистки заказов уже неактуально
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', '25'))
+BROADCAST_WORKERS = int(os.environ.get('BROADCAST_WORKERS', '8'))
+BROADCAST_MAX_AGE = float(os.environ.get('BROADCAST_MAX_AGE', '900'))
+broadcaster = BroadcastEngine(
+    lambda chat_id, text, markup: bot.send_message(chat_id, text, reply_markup=markup),
+    os.path.join(DATA_DIR, 'broadcasts'),
+    rate=BROADCAST_RATE,
+    workers=BROADCAST_WORKERS,
+    max_age=BROADCAST_MAX_AGE
+)
+
+def resume_broadcasts():
+    """Досылка рассылок, прерванных рестартом, с отчётом админу"""
+    for result in broadcaster.resume_pending():
+        title = "⌛ Прерванная рассылка устарела и не досылалась" if result.get('expired') \
+            else "🔁 Рассылка возобновлена после рестарта"
+        try:
+            bot.send_message(ADMIN_CHAT_ID, f"{title}\n\n{format_broadcast_report(result)}")
+        except Exception as e:
+            print(f"Ошибка отправки отчёта о рассылке: {e}")
+
 # Настройки расписания (МСК)
+MSK_TZ = timezone(timedelta(hours=3))
 SCHEDULE_SEND_SUMMARY_TIME = "11:10"  # Время отправки сводки
 SCHEDULE_CLEAR_ORDERS_TIME = "11:13"  # Время очистки заказов
 SCHEDULE_REMINDER_TIME = "11:04"      # Напоминание за 1 час до очистки
+# Пропущенный запуск (рестарт, долгая задача) догоняется в течение N секунд
+SCHEDULER_GRACE = int(os.environ.get('SCHEDULER_GRACE', '900'))
+SCHEDULER_WORKERS = int(os.environ.get('SCHEDULER_WORKERS', '4'))
+# Повторы упавших задач: число попыток и начальная пауза (удваивается)
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '4'))
+JOB_RETRY_BACKOFF = float(os.environ.get('JOB_RETRY_BACKOFF', '30'))
 
 def send_reminder_to_clients():
-    """Отправка напоминаний клиентам без заказов"""
-    reminded_count = 0
-    
-    for user_id_str, user_data in users_data.items():
-        # Проверяем: зарегистрирован и нет заказов
-        if user_data.get('registered') and not user_data.get('orders'):
-            try:
-                # Создаём меню с кнопками
-                markup = InlineKeyboardMarkup(row_width=2)
-                buttons = [
-                    InlineKeyboardButton('🛒 Сделать заказ', callback_data='add_order'),
-                    InlineKeyboardButton('📋 Мой заказ', callback_data='my_order'),
-                ]
-                markup.add(*buttons)
-                
-                reminder_text = (
-                    f"⏰ **Напоминание!**\n\n"
-                    f"Через 1 час заказ на следующий день будет закрыт.\n\n"
-                    f"У вас в корзине пусто. Не хотите сделать заказ?\n\n"
-                    f"📍 {user_data['location_name']}\n"
-                    f"📮 {user_data['address']}"
-                )
-                
-                bot.send_message(
-                    chat_id=int(user_id_str),
-                    text=reminder_text,
-                    reply_markup=markup
-                )
-                reminded_count += 1
-                time.sleep(0.1)  # Небольшая задержка между отправками
-                
-            except Exception as e:
-                print(f"Ошибка отправки напоминания клиенту {user_id_str}: {e}")
-    
-    return reminded_count
-
-def check_scheduled_tasks():
-    """Проверка и выполнение запланированных задач"""
-    state = load_scheduler_state()
-    msk_tz = timezone(timedelta(hours=3))
-    now = datetime.now(msk_tz)
-    current_time = now.strftime('%H:%M')
-    current_date = now.strftime('%Y-%m-%d')
+    """Отправка напоминаний клиентам без заказов, вернуть отчёт рассылки"""
+    # Снимок, а не живой словарь: клиенты могут меняться во время рассылки
+    clients = get_reminder_recipients()
     
-    print(f"--- ПРОВЕРКА: {current_time}:{now.strftime('%S')} МСК ---")
-
-    # Инициализируем состояние при первом запуске
-    if "last_send_date" not in state:
-        state["last_send_date"] = None
-    if "last_clear_date" not in state:
-        state["last_clear_date"] = None
-    if "last_reminder_date" not in state:
-        state["last_reminder_date"] = None
-    
-    # === НАПОМИНАНИЕ КЛИЕНТАМ (за 1 час до очистки) ===
-    if current_time == SCHEDULE_REMINDER_TIME:
-        if state["last_reminder_date"] != current_date:
-            print("*** ТРИГГЕР: ОТПРАВКА НАПОМИНАНИЙ ***")
-            try:
-                reminded_count = send_reminder_to_clients()
-                state["last_reminder_date"] = current_date
-                save_scheduler_state(state)
-                
-                # Уведомляем админа
-                bot.send_message(
-                    ADMIN_CHAT_ID, 
-                    f"⏰ Напоминания отправлены!\n"
-                    f"Клиентов без заказов: {reminded_count}\n"
-                    f"Время: {current_time}"
-                )
-                print(f"✅ Напоминания отправлены: {reminded_count} клиентов")
-            except Exception as e:
-                print(f"❌ Ошибка отправки напоминаний: {e}")
-                try:
-                    bot.send_message(ADMIN_CHAT_ID, f"❌ Ошибка отправки напоминаний: {e}")
-                except:
-                    pass
-        else:
-            print(f"⏸ Напоминания уже отправлены сегодня ({current_date})")
-    
-    # === ОТПРАВКА СВОДКИ ===
-    if current_time == SCHEDULE_SEND_SUMMARY_TIME:
-        # Проверяем, что сегодня ещё не отправляли
-        if state["last_send_date"] != current_date:
-            print("*** ТРИГГЕР: ОТПРАВКА СВОДКИ ***")
-            try:
-                send_excel_summary()
-                state["last_send_date"] = current_date
-                save_scheduler_state(state)
-                print(f"✅ Сводка отправлена в {current_time}!")
-            except Exception as e:
-                print(f"❌ Ошибка сводки: {e}")
-                try:
-                    bot.send_message(ADMIN_CHAT_ID, f"❌ Ошибка отправки сводки: {e}")
-                except:
-                    pass
-        else:
-            print(f"⏸ Сводка уже отправлена сегодня ({current_date})")
-    
-    # === ОЧИСТКА ЗАКАЗОВ ===
-    if current_time == SCHEDULE_CLEAR_ORDERS_TIME:
-        # Проверяем, что сегодня ещё не очищали
-        if state["last_clear_date"] != current_date:
-            print("*** ТРИГГЕР: ОЧИСТКА ЗАКАЗОВ ***")
-            try:
-                cleared_count = clear_all_orders_auto()
-                state["last_clear_date"] = current_date
-                save_scheduler_state(state)
-                bot.send_message(ADMIN_CHAT_ID, f"✅ Заказы обнулены в {current_time}. Очищено: {cleared_count}")
-                print(f"✅ Очищено: {cleared_count}")
-            except Exception as e:
-                print(f"❌ Ошибка очистки: {e}")
-                try:
-                    bot.send_message(ADMIN_CHAT_ID, f"❌ Ошибка очистки заказов: {e}")
-                except:
-                    pass
-        else:
-            print(f"⏸ Заказы уже очищены сегодня ({current_date})")
-    
-    # Логирование раз в 10 проверок (каждые 5 минут при интервале 30 сек)
-    check_count = state.get("check_count", 0) + 1
-    state["check_count"] = check_count
-    
-    if check_count % 10 == 0:
-        print(f"💤 Ожидаем:")
-        print(f"   • Напоминание в {SCHEDULE_REMINDER_TIME} МСК")
-        print(f"   • Сводка в {SCHEDULE_SEND_SUMMARY_TIME} МСК")
-        print(f"   • Очистка в {SCHEDULE_CLEAR_ORDERS_TIME} МСК")
-        print(f"   Последнее напоминание: {state.get('last_reminder_date', 'никогда')}")
-        print(f"   Последняя сводка: {state.get('last_send_date', 'никогда')}")
-        print(f"   Последняя очистка: {state.get('last_clear_date', 'никогда')}")
-        save_scheduler_state(state)
+    messages = [(int(user_id_str), REMINDER_TEXT.format_map(user_data)) for user_id_str, user_data in clients.items()]
+    return broadcaster.run('Напоминания', messages, reply_markup=keyboards.get('reminder'))
+
+def job_send_reminders(run_date):
+    """Задача: напоминания клиентам без заказов"""
+    result = send_reminder_to_clients()
+    bot.send_message(
+        ADMIN_CHAT_ID,
+        f"⏰ Напоминания отправлены!\n"
+        f"Клиентов без заказов: {result['total']}\n"
+        f"Время: {datetime.now(MSK_TZ).strftime('%H:%M')}\n\n"
+        f"{format_broadcast_report(result)}"
+    )
+    print(f"✅ Напоминания отправлены: {result['sent']} клиентов")
+
+def job_send_summary(run_date):
+    """Задача: Excel-сводка админу и запись дня в историю"""
+    send_excel_summary(run_date=run_date)
+
+def job_clear_orders(run_date):
+    """Задача: обнуление заказов"""
+    cleared_count = clear_all_orders_auto()
+    bot.send_message(ADMIN_CHAT_ID, f"✅ Заказы обнулены в {datetime.now(MSK_TZ).strftime('%H:%M')}. Очищено: {cleared_count}")
+    print(f"✅ Очищено: {cleared_count}")
+
+def notify_job_failure(job_name, error):
+    bot.send_message(ADMIN_CHAT_ID, f"❌ Ошибка задачи «{JOB_TITLES.get(job_name, job_name)}»: {error}")
+
+# Таблица ежедневных задач: имя -> параметры Job. Новые задачи (в том числе
+# разовые через Job(run_at=...)) добавляются в job_scheduler.
+# Напоминания не повторяются: прерванную рассылку досылает BroadcastEngine.
+# Очистка ждёт успешной сводки за ту же дату, иначе заказы не обнуляются.
+SCHEDULED_JOBS = {
+    'reminder': dict(daily_at=SCHEDULE_REMINDER_TIME, action=job_send_reminders, max_attempts=1),
+    'summary': dict(daily_at=SCHEDULE_SEND_SUMMARY_TIME, action=job_send_summary, max_attempts=JOB_MAX_ATTEMPTS),
+    'clear': dict(daily_at=SCHEDULE_CLEAR_ORDERS_TIME, action=job_clear_orders, max_attempts=JOB_MAX_ATTEMPTS,
+                  depends_on=('summary',)),
+}
+JOB_TITLES = {'reminder': 'Напоминания', 'summary': 'Сводка', 'clear': 'Очистка заказов'}
+
+def load_job_state():
+    """Состояние задач из scheduler_state.json (с переносом старого формата)"""
+    saved = load_scheduler_state()
+    if 'jobs' in saved:
+        return saved['jobs']
+    return {
+        'reminder': {'last_date': saved.get('last_reminder_date')},
+        'summary': {'last_date': saved.get('last_send_date')},
+        'clear': {'last_date': saved.get('last_clear_date')},
+    }
+
+def save_job_state(jobs):
+    save_scheduler_state({'jobs': jobs})
+
+job_scheduler = Scheduler(MSK_TZ, JobRunStore(os.path.join(DATA_DIR, 'job_runs.json')),
+                          job_state=load_job_state(), on_change=save_job_state,
+                          on_failure=notify_job_failure, workers=SCHEDULER_WORKERS,
+                          on_finish=lambda name, outcome, seconds: JOB_SECONDS.observe(seconds, job=name, outcome=outcome))
 
 def scheduler():
     """Основной цикл планировщика"""
     print("🚀 ПЛАНИРОВЩИК ЗАПУЩЕН!")
-    
-    while True:
-        try:
-            check_scheduled_tasks()
-            time.sleep(30)  # Проверяем каждые 30 секунд
-        except Exception as e:
-            print(f"❌ КРИТИЧЕСКАЯ ОШИБКА ПЛАНИРОВЩИКА: {e}")
-            time.sleep(30)
+    for name, options in SCHEDULED_JOBS.items():
+        job_scheduler.add_job(Job(name, grace=SCHEDULER_GRACE, backoff=JOB_RETRY_BACKOFF, **options))
+    job_scheduler.recover()
+    for fire_at, name in job_scheduler.upcoming():
+        print(f"   • {JOB_TITLES.get(name, name)}: {fire_at.strftime('%d.%m %H:%M')} МСК")
+    job_scheduler.run_forever()
+
+# === КЛИЕНТ BOT API ===
+
+# Пул соединений на все потоки, которые ходят в API: воркеры вебхука,
+# рассылки, планировщика и отчётов. Заданный ранее CUSTOM_REQUEST_SENDER не подменяется.
+TELEGRAM_API_RETRIES_MAX = int(os.environ.get('TELEGRAM_API_RETRIES', '3'))
+TELEGRAM_MAX_RETRY_AFTER = float(os.environ.get('TELEGRAM_MAX_RETRY_AFTER', '5'))
+TELEGRAM_BREAKER_THRESHOLD = int(os.environ.get('TELEGRAM_BREAKER_THRESHOLD', '5'))
+TELEGRAM_BREAKER_COOLDOWN = float(os.environ.get('TELEGRAM_BREAKER_COOLDOWN', '30'))
+telegram_client = None
+if telebot.apihelper.CUSTOM_REQUEST_SENDER is None:
+    telegram_client = TelegramApiClient(
+        pool_size=WEBHOOK_WORKERS + BROADCAST_WORKERS + SCHEDULER_WORKERS + REPORT_THREADS + 2,
+        max_retries=TELEGRAM_API_RETRIES_MAX,
+        max_retry_after=TELEGRAM_MAX_RETRY_AFTER,
+        breaker=CircuitBreaker(TELEGRAM_BREAKER_THRESHOLD, TELEGRAM_BREAKER_COOLDOWN),
+        on_retry=lambda method, reason: TELEGRAM_API_RETRIES.inc(method=method, reason=reason),
+    )
+    telebot.apihelper.CUSTOM_REQUEST_SENDER = telegram_client.request
 
 # === ИНИЦИАЛИЗАЦИЯ БОТА ===
 
 def setup_webhook():
     """Установка webhook"""
+    if not WEBHOOK_URL:
+        print("WEBHOOK_URL не задан, webhook не устанавливаю")
+        return
     print("Удаляю старый webhook...")
     bot.remove_webhook()
     time.sleep(2)
 
-    webhook_url = "https://web-production-d7a9d.up.railway.app/webhook"
-    print(f"Устанавливаю webhook: {webhook_url}")
+    print(f"Устанавливаю webhook: {WEBHOOK_URL}")
 
-    result = bot.set_webhook(url=webhook_url)
+    result = bot.set_webhook(url=WEBHOOK_URL)
     if result:
         print("✅ WEBHOOK УСПЕШНО УСТАНОВЛЕН!")
     else:
         print("❌ ОШИБКА: Webhook НЕ установлен!")
 
+def run_scheduler_as_leader():
+    """Дождаться роли ведущего процесса и запустить планировщик"""
+    if not leader_lock.is_leader:
+        leader_lock.acquire(blocking=True)
+        print("👑 ПРОЦЕСС СТАЛ ВЕДУЩИМ, ЗАПУСКАЮ ПЛАНИРОВЩИК")
+    threading.Thread(target=resume_broadcasts, daemon=True).start()
+    scheduler()
+
 def start_bot():
     """Запуск бота и планировщика"""
     print("=== ИНИЦИАЛИЗАЦИЯ БОТА ===")
     
-    # Установка webhook
-    setup_webhook()
+    if leader_lock.acquire(blocking=False):
+        print("👑 ПРОЦЕСС ВЕДУЩИЙ")
+        # Установка webhook
+        setup_webhook()
+    else:
+        print("⏸ Процесс ведомый: планировщик запустится, если ведущий остановится")
+    
+    # Воркеры входящих обновлений; при остановке дообрабатывают очередь
+    # (atexit вызывает их раньше финальной записи хранилища и остановки пула отчётов)
+    atexit.register(report_service.stop)
+    update_dispatcher.start()
+    atexit.register(update_dispatcher.stop)
     
-    # Запуск планировщика в отдельном потоке
-    scheduler_thread = threading.Thread(target=scheduler, daemon=True)
+    # Запуск планировщика в отдельном потоке (ведомый ждёт освобождения блокировки)
+    scheduler_thread = threading.Thread(target=run_scheduler_as_leader, daemon=True)
     scheduler_thread.start()
     print("✅ ПЛАНИРОВЩИК ЗАПУЩЕН В ОТДЕЛЬНОМ ПОТОКЕ!")
     
@@ -0,0 +1,123 @@
+"""Сравнение прежней генерации Excel-сводки с потоковой (write-only)
+
+Запуск: python benchmarks/bench_excel.py [число_клиентов ...]
+"""
+import io
+import os
+import sys
+import time
+import random
+import tracemalloc
+
+from openpyxl import Workbook, load_workbook
+from openpyxl.styles import Font, Alignment, Border, Side
+from openpyxl.utils import get_column_letter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from excel_report import build_orders_workbook
+
+POSITIONS = [
+    'Ватрушка', 'Капуста', 'Яблоко', 'Картофель', 'Мак', 'Плюшка', 'Чечевица', 'Повидло',
+    'Корица', 'Сосиск в тесте', 'Брусника', 'Вишня', 'Черная смородина', 'Творог с зеленью'
+]
+
+
+def make_users(count, seed=1):
+    rnd = random.Random(seed)
+    users = []
+    for i in range(count):
+        orders = {pos: rnd.randint(1, 20) for pos in rnd.sample(POSITIONS, rnd.randint(1, 6))}
+        users.append({'user_id': str(i), 'location_name': f"Точка {i:06d}",
+                      'address': f"ул. Тестовая, {i}", 'orders': orders, 'registered': True})
+    return users
+
+
+def legacy_build(active_users, position_names, date_formatted):
+    """Прежняя реализация: обычная книга, стили на каждую ячейку, итоги чтением ячеек"""
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Сводка заказов"
+    header_font = Font(bold=True, size=14)
+    title_font = Font(bold=True, size=12)
+    bold_font = Font(bold=True)
+    center_align = Alignment(horizontal='center', vertical='center')
+    border = Border(left=Side(style='thin'), right=Side(style='thin'),
+                    top=Side(style='thin'), bottom=Side(style='thin'))
+    header_end_col = get_column_letter(3 + len(position_names) + 1)
+    ws.merge_cells(f'A1:{header_end_col}1')
+    ws['A1'] = f"Сводка заказов от {date_formatted}"
+    ws['A1'].font = header_font
+    ws['A1'].alignment = center_align
+    ws.append([])
+    headers = ['№', 'Точка', 'Адрес'] + list(position_names) + ['ИТОГО']
+    ws.append(headers)
+    for col in range(1, len(headers) + 1):
+        cell = ws.cell(row=3, column=col)
+        cell.font = title_font
+        cell.alignment = center_align
+        cell.border = border
+    row_num = 4
+    for i, user_data in enumerate(active_users, 1):
+        row = [i, user_data['location_name'], user_data['address']]
+        total = 0
+        for pos in position_names:
+            qty = user_data['orders'].get(pos, 0)
+            row.append(qty)
+            total += qty
+        row.append(total)
+        ws.append(row)
+        for col in range(1, len(headers) + 1):
+            cell = ws.cell(row=row_num, column=col)
+            cell.border = border
+            if col in [1, len(headers)]:
+                cell.font = bold_font
+        row_num += 1
+    ws.append([])
+    row_num += 1
+    total_row = ['ВСЕГО', '', '']
+    for pos_idx in range(len(position_names)):
+        col_idx = 4 + pos_idx
+        total_row.append(sum(ws.cell(row=r, column=col_idx).value or 0 for r in range(4, row_num)))
+    total_row.append(sum(total_row[3:]))
+    ws.append(total_row)
+    for col in range(1, len(headers) + 1):
+        cell = ws.cell(row=row_num + 1, column=col)
+        cell.font = bold_font
+        cell.border = border
+        if col >= 4:
+            cell.alignment = center_align
+    excel_buffer = io.BytesIO()
+    wb.save(excel_buffer)
+    excel_buffer.seek(0)
+    return excel_buffer
+
+
+def measure(build, users):
+    tracemalloc.start()
+    started = time.perf_counter()
+    buffer = build(users, POSITIONS, '01.01.2025')
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return buffer, elapsed, peak
+
+
+def total_row(buffer):
+    ws = load_workbook(buffer, read_only=True).active
+    return [row for row in ws.iter_rows(values_only=True) if row and row[0] == 'ВСЕГО'][0]
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000]
+    print(f"{'клиентов':>10} {'прежняя, с':>12} {'потоковая, с':>13} {'прежняя, МБ':>12} {'потоковая, МБ':>14}")
+    for count in sizes:
+        users = make_users(count)
+        legacy_buffer, legacy_time, legacy_peak = measure(legacy_build, users)
+        stream_buffer, stream_time, stream_peak = measure(build_orders_workbook, users)
+        assert total_row(legacy_buffer) == total_row(stream_buffer), "Итоги не совпадают"
+        print(f"{count:>10} {legacy_time:>12.3f} {stream_time:>13.3f} "
+              f"{legacy_peak / 2**20:>12.1f} {stream_peak / 2**20:>14.1f}")
+
+
+if __name__ == '__main__':
+    main()
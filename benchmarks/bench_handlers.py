@@ -0,0 +1,96 @@
+"""Время админских обработчиков в зависимости от числа клиентов
+
+Для каждого размера базы в отдельном процессе поднимается приложение
+с заглушкой Bot API и замеряются генерация Excel, текстовая сводка,
+детальная статистика, бэкап в JSON и рассылка напоминаний. Excel,
+статистика и бэкап по кнопке собираются в фоне (report_service), здесь
+замеряется сама сборка в текущем потоке. Печатается медиана времени
+и число вызовов Bot API на один запуск.
+
+Запуск: python benchmarks/bench_handlers.py [число_клиентов ...] [--days 90] [--repeat 5]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+from types import SimpleNamespace
+
+from support import ADMIN_ID, make_history, make_users, prepare_app
+from reports import json_export_job
+
+DEFAULT_SIZES = [100, 1000, 10000]
+
+
+def fake_call(chat_id):
+    """Минимальный CallbackQuery для вызова обработчика напрямую"""
+    return SimpleNamespace(id='bench', data='', from_user=SimpleNamespace(id=chat_id),
+                           message=SimpleNamespace(chat=SimpleNamespace(id=chat_id), message_id=1))
+
+
+def measure(api, fn, repeat):
+    timings, errors = [], 0
+    calls = api.total_calls()
+    for _ in range(repeat):
+        started = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            # Слишком длинное сообщение Telegram отклоняет — считаем, но продолжаем
+            print(f"Ошибка замера: {e}")
+            errors += 1
+        timings.append(time.perf_counter() - started)
+    return {'ms': statistics.median(timings) * 1000, 'calls': (api.total_calls() - calls) / repeat,
+            'errors': errors}
+
+
+def run_single(size, days, repeat):
+    users = make_users(size, with_orders=0.5)
+    history = make_history(users, days) if days else None
+    app, api, _ = prepare_app(users, history=history)
+    call = fake_call(ADMIN_ID)
+    results = {
+        'excel': measure(api, app.generate_excel_file, repeat),
+        'text_summary': measure(api, lambda: app.send_text_summary(call), repeat),
+        'statistics': measure(api, app.render_detailed_statistics, repeat),
+        'export': measure(api, lambda: json_export_job(*app.prepare_export()), repeat),
+        # Рассылка медленная на больших базах, хватает одного прогона
+        'reminders': measure(api, app.send_reminder_to_clients, 1),
+    }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('sizes', type=int, nargs='*', default=DEFAULT_SIZES)
+    parser.add_argument('--days', type=int, default=90, help='дней истории для статистики')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        # Вывод приложения идёт в stdout, результат — последней строкой
+        print(json.dumps(run_single(args.single, args.days, args.repeat)))
+        os._exit(0)
+
+    names = ['excel', 'text_summary', 'statistics', 'export', 'reminders']
+    print(f"{'клиентов':>9} " + ' '.join(f"{name:>22}" for name in names))
+    for size in args.sizes:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--single', str(size),
+                                 '--days', str(args.days), '--repeat', str(args.repeat)],
+                                capture_output=True, text=True)
+        if output.returncode != 0:
+            print(f"{size:>9} ошибка: {output.stderr.strip().splitlines()[-1:]}")
+            continue
+        results = json.loads(output.stdout.strip().splitlines()[-1])
+        cells = [f"{results[name]['ms']:>9.1f} мс {results[name]['calls']:>6.0f} выз." for name in names]
+        print(f"{size:>9} " + ' '.join(f"{cell:>22}" for cell in cells))
+        failed = {name: results[name]['errors'] for name in names if results[name]['errors']}
+        if failed:
+            print(f"{'':>9} ошибок Bot API (слишком длинные сообщения и т.п.): {failed}")
+
+
+if __name__ == '__main__':
+    main()
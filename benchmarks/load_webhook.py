@@ -0,0 +1,170 @@
+"""Нагрузочный тест вебхука синтетическими обновлениями Telegram
+
+Поднимает заглушку Bot API и Flask-приложение на локальном порту, засевает
+базу из --users клиентов и отправляет на /webhook смесь обновлений:
+выбор позиции + количество, «Мой заказ», новые регистрации и действия
+администратора. Печатает пропускную способность, перцентили задержек
+(ответ вебхука и полная обработка) и усиление записи на диск.
+
+Запуск: python benchmarks/load_webhook.py --users 1000 --updates 5000 [--rate 200] [--backend sqlite]
+"""
+import os
+import json
+import time
+import random
+import argparse
+import threading
+import http.client
+
+from support import (ADMIN_ID, UpdateFactory, io_write_bytes, make_users,
+                     percentile, prepare_app)
+
+ADMIN_ACTIONS = ['admin_summary', 'admin_stats', 'admin_history', 'admin_excel']
+
+
+def build_scripts(users, args, rnd):
+    """Последовательности обновлений по клиентским потокам
+
+    Все обновления одного пользователя попадают в один поток, поэтому
+    порядок внутри диалога сохраняется, как у настоящего Telegram.
+    """
+    from app import CB_SELECT_PRODUCT, catalog
+    from routing import pack_callback
+    product_buttons = [pack_callback(CB_SELECT_PRODUCT, product.id) for product in catalog]
+    factory = UpdateFactory()
+    user_ids = list(users)
+    scripts = [[] for _ in range(args.clients)]
+    mutating = 0
+    next_new_user = 900000000
+    produced = 0
+    while produced < args.updates:
+        roll = rnd.random()
+        if roll < args.admin_share:
+            session = [('admin', factory.callback(ADMIN_ID, rnd.choice(ADMIN_ACTIONS)))]
+            user_id = ADMIN_ID
+        elif roll < args.admin_share + args.new_share:
+            user_id = next_new_user
+            next_new_user += 1
+            session = [('register', factory.message(user_id, '/start')),
+                       ('register', factory.message(user_id, f"Новая точка {user_id}")),
+                       ('register', factory.message(user_id, 'ул. Новая, 1'))]
+            mutating += 2
+        elif roll < 0.85:
+            user_id = rnd.choice(user_ids)
+            session = [('order', factory.callback(user_id, rnd.choice(product_buttons))),
+                       ('order', factory.message(user_id, str(rnd.randint(0, 20))))]
+            mutating += 1
+        else:
+            user_id = rnd.choice(user_ids)
+            session = [('view', factory.callback(user_id, rnd.choice(['my_order', 'my_data', 'add_order'])))]
+        scripts[int(user_id) % args.clients].extend(session)
+        produced += len(session)
+    return scripts, mutating
+
+
+def run_client(port, script, bucket, latencies, errors):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    for kind, update in script:
+        if bucket:
+            bucket.acquire()
+        body = json.dumps(update)
+        started = time.perf_counter()
+        try:
+            conn.request('POST', '/webhook', body=body, headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors[response.status] = errors.get(response.status, 0) + 1
+        except Exception as e:
+            errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        latencies.append(time.perf_counter() - started)
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--rate', type=float, default=0, help='обновлений в секунду, 0 — без ограничения')
+    parser.add_argument('--clients', type=int, default=8, help='параллельных отправителей')
+    parser.add_argument('--backend', choices=['json', 'sqlite'], default='json')
+    parser.add_argument('--api-latency-ms', type=float, default=0, help='задержка ответа заглушки Bot API')
+    parser.add_argument('--api-error-rate', type=float, default=0, help='доля ответов 502 от заглушки')
+    parser.add_argument('--api-flood-rate', type=float, default=0, help='доля ответов 429 от заглушки')
+    parser.add_argument('--admin-share', type=float, default=0.005)
+    parser.add_argument('--new-share', type=float, default=0.02)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    users = make_users(args.users, with_orders=0.3, seed=args.seed)
+    app, api, data_dir = prepare_app(users, backend=args.backend, api_latency=args.api_latency_ms / 1000,
+                                     api_options={'error_rate': args.api_error_rate,
+                                                  'flood_rate': args.api_flood_rate})
+
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # Полное время обработки каждого обновления воркером
+    processing = []
+    handler = app.update_dispatcher.handler
+
+    def timed_handler(update):
+        started = time.perf_counter()
+        try:
+            handler(update)
+        finally:
+            processing.append(time.perf_counter() - started)
+    app.update_dispatcher.handler = timed_handler
+
+    scripts, mutating = build_scripts(users, args, rnd)
+    total = sum(len(script) for script in scripts)
+    from broadcast import TokenBucket
+    bucket = TokenBucket(args.rate) if args.rate > 0 else None
+    latencies, errors = [], {}
+    calls_before = api.total_calls()
+    written_before = io_write_bytes()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=run_client, args=(server.server_port, script, bucket, latencies, errors))
+               for script in scripts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    sent_at = time.perf_counter()
+    app.update_dispatcher.join()
+    if app.flusher:
+        app.flusher.flush()
+    finished = time.perf_counter()
+    written = io_write_bytes() - written_before if written_before is not None else None
+    server.shutdown()
+
+    record_size = sum(len(json.dumps(u, ensure_ascii=False).encode('utf-8')) for u in users.values()) / len(users)
+    logical = mutating * record_size
+
+    print(f"\nКлиентов в базе: {args.users}, хранилище: {args.backend}, обновлений: {total}")
+    print(f"Отправка: {sent_at - started:.2f} с, обработка до конца: {finished - started:.2f} с")
+    print(f"Обработано: {len(processing)}, пропускная способность: {len(processing) / (finished - started):.0f} обн./с")
+    for title, values in (('Ответ вебхука', latencies), ('Обработка', processing)):
+        print(f"{title}, мс: p50 {percentile(values, 50) * 1000:.2f}  p95 {percentile(values, 95) * 1000:.2f}  "
+              f"p99 {percentile(values, 99) * 1000:.2f}  max {max(values, default=0) * 1000:.2f}")
+    print(f"Вызовов Bot API: {api.total_calls() - calls_before} ({(api.total_calls() - calls_before) / total:.2f} на обновление)")
+    if api.faults:
+        print(f"Сбоев заглушки: {dict(api.faults)}, повторов клиента: {app.TELEGRAM_API_RETRIES.total()}, "
+              f"ошибок в обработчиках: {app.TELEGRAM_API_ERRORS.total()}")
+    if written is not None:
+        print(f"Записано на диск: {written / 2**20:.2f} МБ, изменений: {mutating}, "
+              f"усиление записи: {written / logical if logical else 0:.1f}x")
+    if errors:
+        print(f"Ошибки: {errors}")
+    print(f"Данные: {data_dir}")
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
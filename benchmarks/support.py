@@ -0,0 +1,209 @@
+"""Общие части бенчмарков: заглушка Bot API, подготовка данных, синтетические обновления"""
+import os
+import sys
+import json
+import random
+import tempfile
+import itertools
+import threading
+from collections import Counter
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+POSITIONS = [
+    'Ватрушка', 'Капуста', 'Яблоко', 'Картофель', 'Мак', 'Плюшка', 'Чечевица', 'Повидло',
+    'Корица', 'Сосиск в тесте', 'Брусника', 'Вишня', 'Черная смородина', 'Творог с зеленью'
+]
+ADMIN_ID = 999999
+TOKEN = '123456:BENCH'
+MESSAGE_LIMIT = 4096
+
+
+class FakeBotApi:
+    """Локальная заглушка api.telegram.org: отвечает успехом и считает вызовы
+
+    error_rate — доля ответов 502, flood_rate — доля ответов 429 с retry_after.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, flood_rate=0.0, retry_after=1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.rejected = Counter()
+        self.faults = Counter()
+        self._random = random.Random(3)
+        self.request_bytes = 0
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Иначе заголовки и тело уходят разными пакетами и keep-alive ждёт ~40 мс
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self.do_POST()
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                url = urlsplit(self.path)
+                method = url.path.rsplit('/', 1)[-1]
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                status, payload = api.handle(method, params, len(body) + len(url.query))
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def handle(self, method, params, size):
+        if self.latency:
+            threading.Event().wait(self.latency)
+        with self._lock:
+            self.calls[method] += 1
+            self.request_bytes += size
+            roll = self._random.random()
+        if roll < self.error_rate:
+            with self._lock:
+                self.faults['502'] += 1
+            return 502, {'ok': False, 'error_code': 502, 'description': 'Bad Gateway'}
+        if roll < self.error_rate + self.flood_rate:
+            with self._lock:
+                self.faults['429'] += 1
+            return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry later',
+                         'parameters': {'retry_after': self.retry_after}}
+        # Как настоящий Telegram: текст длиннее MESSAGE_LIMIT отклоняется
+        if len(params.get('text', '')) > MESSAGE_LIMIT:
+            with self._lock:
+                self.rejected[method] += 1
+            return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: message is too long'}
+        result = True
+        if method.startswith('send') or method.startswith('edit'):
+            chat_id = int(params.get('chat_id', 0) or 0)
+            result = {'message_id': next(self._message_ids), 'date': 0,
+                      'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', '')}
+        elif method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        return 200, {'ok': True, 'result': result}
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+
+def make_users(count, with_orders=0.5, seed=1):
+    """Зарегистрированные клиенты; доля with_orders — с заказом на сегодня"""
+    rnd = random.Random(seed)
+    users = {}
+    for i in range(count):
+        user_id = str(100000 + i)
+        orders = {}
+        if rnd.random() < with_orders:
+            orders = {pos: rnd.randint(1, 20) for pos in rnd.sample(POSITIONS, rnd.randint(1, 6))}
+        users[user_id] = {'user_id': user_id, 'location_name': f"Точка {i:06d}", 'address': f"ул. Тестовая, {i}",
+                          'orders': orders, 'registered': True, 'registration_date': '01.01.2025 10:00'}
+    return users
+
+
+def make_history(users, days, seed=2):
+    """История прежнего формата {дата: [записи]} за последние days дней"""
+    from datetime import date, timedelta
+    rnd = random.Random(seed)
+    user_list = list(users.values())
+    history = {}
+    for offset in range(days, 0, -1):
+        date_str = (date.today() - timedelta(days=offset)).strftime('%Y-%m-%d')
+        entries = []
+        for user_data in rnd.sample(user_list, max(1, len(user_list) // 3)):
+            orders = {pos: rnd.randint(1, 20) for pos in rnd.sample(POSITIONS, rnd.randint(1, 6))}
+            entries.append({'user_id': user_data['user_id'], 'location_name': user_data['location_name'],
+                            'address': user_data['address'], 'orders': orders,
+                            'total_items': sum(orders.values()), 'timestamp': '11:10'})
+        history[date_str] = entries
+    return history
+
+
+def prepare_app(users, history=None, backend='json', api_latency=0.0, extra_env=None, api_options=None):
+    """Записать данные в новый DATA_DIR, поднять заглушку API и импортировать app"""
+    data_dir = tempfile.mkdtemp(prefix='bench_', dir=os.environ.get('BENCH_TMP'))
+    with open(os.path.join(data_dir, 'users_data.json'), 'w', encoding='utf-8') as f:
+        json.dump(users, f, ensure_ascii=False)
+    if history:
+        with open(os.path.join(data_dir, 'orders_history.json'), 'w', encoding='utf-8') as f:
+            json.dump(history, f, ensure_ascii=False)
+    api = FakeBotApi(latency=api_latency, **(api_options or {})).start()
+    os.environ.update({
+        'BOT_TOKEN': TOKEN,
+        'ADMIN_CHAT_ID': str(ADMIN_ID),
+        'DATA_DIR': data_dir,
+        'STORAGE_BACKEND': backend,
+        'TELEGRAM_API_URL': api.url,
+        'WEBHOOK_URL': '',
+        'BROADCAST_RATE': os.environ.get('BROADCAST_RATE', '100000'),
+        **(extra_env or {}),
+    })
+    import app
+    return app, api, data_dir
+
+
+class UpdateFactory:
+    """Синтетические Update в формате Telegram"""
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return {'id': int(user_id), 'is_bot': False, 'first_name': 'Bench'}
+
+    def message(self, user_id, text):
+        update_id = next(self._ids)
+        message = {'message_id': update_id, 'date': 0, 'chat': {'id': int(user_id), 'type': 'private'},
+                   'from': self._user(user_id), 'text': text}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': update_id, 'message': message}
+
+    def callback(self, user_id, data):
+        update_id = next(self._ids)
+        return {'update_id': update_id, 'callback_query': {
+            'id': str(update_id), 'chat_instance': 'bench', 'data': data, 'from': self._user(user_id),
+            'message': {'message_id': update_id, 'date': 0, 'chat': {'id': int(user_id), 'type': 'private'},
+                        'text': 'menu'}}}
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def io_write_bytes():
+    """Байты, записанные процессом на диск (Linux /proc/self/io), или None"""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('write_bytes:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
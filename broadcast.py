@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from storage import atomic_write_json
+
+
+class TokenBucket:
+    """Ограничитель частоты: не больше rate событий в секунду"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Дождаться свободного токена"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Остановить выдачу токенов (ответ 429 с retry_after)"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+
+class PerChatLimiter:
+    """Не чаще одного сообщения в interval секунд в один чат"""
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._next_allowed = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, chat_id):
+        with self._lock:
+            now = time.monotonic()
+            send_at = max(now, self._next_allowed.get(chat_id, 0))
+            self._next_allowed[chat_id] = send_at + self.interval
+        if send_at > now:
+            time.sleep(send_at - now)
+
+
+class BroadcastEngine:
+    """Массовая рассылка с ограничением частоты и возобновлением после рестарта
+
+    Сообщения отправляются параллельно несколькими потоками через общий
+    TokenBucket (глобальный лимит Telegram ~30 сообщений/с) и PerChatLimiter.
+    На 429 рассылка приостанавливается на retry_after и повторяет отправку.
+    Ошибка с атрибутом retry_after (CircuitOpenError — Bot API недоступен,
+    запрос не отправлялся) попыток не расходует: рассылка ждёт и повторяет,
+    пока задание не старше max_age.
+    Задание пишется на диск целиком, а номера отправленных чатов дописываются
+    в файл прогресса — после рестарта resume_pending досылает остаток.
+    Пока рассылка идёт, процесс держит flock на файле задания .lock, поэтому
+    задания, которые ещё рассылает этот или другой процесс, не досылаются
+    повторно. Задания старше max_age секунд не досылаются: текст уже неактуален.
+    """
+
+    def __init__(self, send_fn, state_dir, rate=25, per_chat_interval=1.0, workers=8, max_retries=3,
+                 max_age=3600):
+        self.send_fn = send_fn
+        self.state_dir = state_dir
+        self.rate = rate
+        self.per_chat_interval = per_chat_interval
+        self.workers = workers
+        self.max_retries = max_retries
+        self.max_age = max_age
+        os.makedirs(state_dir, exist_ok=True)
+
+    def _paths(self, job_id):
+        base = os.path.join(self.state_dir, job_id)
+        return f"{base}.json", f"{base}.progress", f"{base}.lock"
+
+    def _lock(self, job_id, blocking=True):
+        """Открытый файл с flock задания или None, если задание рассылает кто-то ещё"""
+        lock_file = open(self._paths(job_id)[2], 'a')
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(lock_file.fileno(), flags)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def _unlock(self, job_id, lock_file):
+        try:
+            os.remove(self._paths(job_id)[2])
+        except FileNotFoundError:
+            pass
+        lock_file.close()
+
+    def run(self, name, messages, reply_markup=None):
+        """Разослать messages — список (chat_id, text); вернуть отчёт"""
+        job_id = f"{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+        job = {'name': name, 'messages': messages, 'reply_markup': reply_markup, 'created': time.time()}
+        job_path = self._paths(job_id)[0]
+        # Блокировка берётся до записи задания: resume_pending не увидит его свободным
+        lock_file = self._lock(job_id)
+        try:
+            atomic_write_json(job_path, job)
+            return self._execute(job_id, job, set())
+        finally:
+            self._unlock(job_id, lock_file)
+
+    def resume_pending(self):
+        """Досылка рассылок, прерванных рестартом; вернуть их отчёты"""
+        results = []
+        for filename in sorted(os.listdir(self.state_dir)):
+            if not filename.endswith('.json'):
+                continue
+            job_id = filename[:-len('.json')]
+            job_path, progress_path, _ = self._paths(job_id)
+            lock_file = self._lock(job_id, blocking=False)
+            if lock_file is None:
+                continue
+            try:
+                if not os.path.exists(job_path):
+                    # Рассылка закончилась, пока мы ждали блокировку
+                    continue
+                with open(job_path, 'r', encoding='utf-8') as f:
+                    job = json.load(f)
+                done = set()
+                if os.path.exists(progress_path):
+                    with open(progress_path, 'r', encoding='utf-8') as f:
+                        done = {line.strip() for line in f if line.strip()}
+                age = time.time() - job.get('created', os.path.getmtime(job_path))
+                if age > self.max_age:
+                    print(f"Рассылка {job['name']} устарела ({age / 60:.0f} мин), не досылаю: "
+                          f"отправлено {len(done)} из {len(job['messages'])}")
+                    results.append(self._expire(job_id, job, done))
+                    continue
+                print(f"Возобновляю рассылку {job['name']}: отправлено {len(done)} из {len(job['messages'])}")
+                results.append(self._execute(job_id, job, done))
+            except Exception as e:
+                print(f"Ошибка возобновления рассылки {job_id}: {e}")
+            finally:
+                self._unlock(job_id, lock_file)
+        return results
+
+    def _expire(self, job_id, job, done):
+        job_path, progress_path, _ = self._paths(job_id)
+        skipped = len([chat_id for chat_id, _ in job['messages'] if str(chat_id) in done])
+        os.remove(job_path)
+        if os.path.exists(progress_path):
+            os.remove(progress_path)
+        return {'name': job['name'], 'total': len(job['messages']), 'sent': 0, 'skipped': skipped,
+                'failed': 0, 'retries': 0, 'errors': {}, 'elapsed': 0, 'rate': 0,
+                'expired': len(job['messages']) - skipped}
+
+    def _execute(self, job_id, job, done):
+        job_path, progress_path, _ = self._paths(job_id)
+        pending = [(chat_id, text) for chat_id, text in job['messages'] if str(chat_id) not in done]
+        bucket = TokenBucket(self.rate)
+        per_chat = PerChatLimiter(self.per_chat_interval)
+        # Дольше ждать восстановления Bot API незачем: текст рассылки устареет
+        deadline = job.get('created', time.time()) + self.max_age
+        progress_lock = threading.Lock()
+        result = {'name': job['name'], 'total': len(job['messages']), 'sent': 0,
+                  'skipped': len(job['messages']) - len(pending), 'failed': 0, 'retries': 0, 'outage_waits': 0,
+                  'errors': {}}
+        started = time.monotonic()
+
+        with open(progress_path, 'a', encoding='utf-8') as progress:
+            def send_one(item):
+                chat_id, text = item
+                attempt = 0
+                while True:
+                    bucket.acquire()
+                    per_chat.acquire(chat_id)
+                    try:
+                        self.send_fn(chat_id, text, job['reply_markup'])
+                        outcome = 'sent'
+                        break
+                    except Exception as e:
+                        retry_after = _retry_after(e)
+                        if retry_after is not None and attempt < self.max_retries:
+                            attempt += 1
+                            bucket.pause(retry_after)
+                            with progress_lock:
+                                result['retries'] += 1
+                            continue
+                        unavailable = getattr(e, 'retry_after', None)
+                        if unavailable is not None and time.time() + unavailable < deadline:
+                            bucket.pause(unavailable)
+                            with progress_lock:
+                                result['outage_waits'] += 1
+                            continue
+                        outcome = 'failed'
+                        error = (getattr(e, 'description', None) or str(e))[:100]
+                        break
+                with progress_lock:
+                    result[outcome] += 1
+                    if outcome == 'failed':
+                        result['errors'][error] = result['errors'].get(error, 0) + 1
+                    # Неудачные тоже отмечаем: при возобновлении их не повторяем
+                    progress.write(f"{chat_id}\n")
+                    progress.flush()
+
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                list(executor.map(send_one, pending))
+
+        result['elapsed'] = time.monotonic() - started
+        result['rate'] = result['sent'] / result['elapsed'] if result['elapsed'] > 0 else 0
+        os.remove(job_path)
+        os.remove(progress_path)
+        return result
+
+
+def _retry_after(error):
+    """Секунды ожидания из ответа 429 или None для прочих ошибок"""
+    if getattr(error, 'error_code', None) != 429:
+        return None
+    parameters = (getattr(error, 'result_json', None) or {}).get('parameters') or {}
+    return parameters.get('retry_after', 1)
+
+
+def format_broadcast_report(result):
+    """Текст отчёта о рассылке для администратора"""
+    text = (
+        f"Рассылка «{result['name']}»\n"
+        f"Отправлено: {result['sent']} из {result['total']}\n"
+        f"Ошибок: {result['failed']}\n"
+        f"Время: {result['elapsed']:.1f} с ({result['rate']:.1f} сообщ./с)"
+    )
+    if result['skipped']:
+        text += f"\nОтправлено до рестарта: {result['skipped']}"
+    if result.get('expired'):
+        text += f"\nНе досланы — рассылка устарела: {result['expired']}"
+    if result['retries']:
+        text += f"\nПовторов после 429: {result['retries']}"
+    if result.get('outage_waits'):
+        text += f"\nОжиданий восстановления Bot API: {result['outage_waits']}"
+    for error, count in sorted(result['errors'].items(), key=lambda x: x[1], reverse=True)[:3]:
+        text += f"\n• {error}: {count}"
+    return text
@@ -0,0 +1,48 @@
+from collections import namedtuple
+
+Product = namedtuple('Product', 'id name price')
+
+# id закреплён за товаром навсегда: при переименовании меняется только name,
+# id удалённых товаров повторно не выдаются. На id ссылаются кнопки в чатах.
+PRODUCTS = [
+    Product(1, 'Ватрушка', 200),
+    Product(2, 'Капуста', 130),
+    Product(3, 'Яблоко', 120),
+    Product(4, 'Картофель', 130),
+    Product(5, 'Мак', 190),
+    Product(6, 'Плюшка', 150),
+    Product(7, 'Чечевица', 140),
+    Product(8, 'Повидло', 130),
+    Product(9, 'Корица', 150),
+    Product(10, 'Сосиск в тесте', 150),
+    Product(11, 'Брусника', 130),
+    Product(12, 'Вишня', 130),
+    Product(13, 'Черная смородина', 130),
+    Product(14, 'Творог с зеленью', 130),
+]
+
+
+class Catalog:
+    """Справочник товаров с постоянными числовыми id"""
+
+    def __init__(self, products=PRODUCTS):
+        self._products = list(products)
+        self._by_id = {product.id: product for product in self._products}
+        self._by_name = {product.name: product for product in self._products}
+        if len(self._by_id) != len(self._products) or len(self._by_name) != len(self._products):
+            raise ValueError("В каталоге повторяются id или названия товаров")
+        # Меняется при любой правке состава, названий или цен
+        self.version = hash(tuple(self._products))
+
+    def __iter__(self):
+        return iter(self._products)
+
+    def get(self, product_id):
+        return self._by_id.get(product_id)
+
+    def by_name(self, name):
+        return self._by_name.get(name)
+
+    def prices(self):
+        """{название: цена} в порядке каталога"""
+        return {product.name: product.price for product in self._products}
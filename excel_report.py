@@ -0,0 +1,90 @@
+import io
+from copy import copy
+
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, Alignment, Border, Side, NamedStyle
+from openpyxl.utils import get_column_letter
+
+
+def _named_styles():
+    """Именованные стили сводки — создаются один раз на книгу, а не на ячейку"""
+    border = Border(left=Side(style='thin'), right=Side(style='thin'),
+                    top=Side(style='thin'), bottom=Side(style='thin'))
+    center_align = Alignment(horizontal='center', vertical='center')
+    return [
+        NamedStyle(name='summary_title', font=Font(bold=True, size=14), alignment=center_align),
+        NamedStyle(name='summary_header', font=Font(bold=True, size=12), alignment=center_align, border=border),
+        NamedStyle(name='summary_cell', border=border),
+        NamedStyle(name='summary_bold', font=Font(bold=True), border=border),
+        NamedStyle(name='summary_total', font=Font(bold=True), border=border, alignment=center_align),
+    ]
+
+
+def build_orders_workbook(active_users, position_names, date_formatted):
+    """Excel-сводка заказов в потоковом (write-only) режиме
+
+    Строки пишутся сразу в поток и не хранятся в памяти, итоги по позициям
+    считаются за тот же проход. active_users — клиенты с заказами в нужном
+    порядке. Возвращает BytesIO или None, если заказов нет.
+    """
+    if not active_users:
+        return None
+
+    wb = Workbook(write_only=True)
+    for style in _named_styles():
+        wb.add_named_style(style)
+    ws = wb.create_sheet("Сводка заказов")
+
+    headers = ['№', 'Точка', 'Адрес'] + list(position_names) + ['ИТОГО']
+    last_col = len(headers)
+
+    # Ширина колонок и объединение задаются до записи строк
+    ws.column_dimensions['A'].width = 5
+    ws.column_dimensions['B'].width = 25
+    ws.column_dimensions['C'].width = 30
+    for col in range(4, last_col):
+        ws.column_dimensions[get_column_letter(col)].width = 8
+    ws.column_dimensions[get_column_letter(last_col)].width = 10
+    ws.merged_cells.add(f'A1:{get_column_letter(last_col)}1')
+
+    # Поиск именованного стиля делается один раз, дальше копируется готовый StyleArray
+    style_arrays = {}
+
+    def styled(value, style):
+        cell = WriteOnlyCell(ws, value=value)
+        if style in style_arrays:
+            cell._style = copy(style_arrays[style])
+        else:
+            cell.style = style
+            style_arrays[style] = copy(cell._style)
+        return cell
+
+    ws.append([styled(f"Сводка заказов от {date_formatted}", 'summary_title')])
+    ws.append([])
+    ws.append([styled(header, 'summary_header') for header in headers])
+
+    position_totals = [0] * len(position_names)
+    for i, user_data in enumerate(active_users, 1):
+        orders = user_data['orders']
+        quantities = [orders.get(pos, 0) for pos in position_names]
+        for idx, qty in enumerate(quantities):
+            position_totals[idx] += qty
+
+        row = [styled(i, 'summary_bold'),
+               styled(user_data['location_name'], 'summary_cell'),
+               styled(user_data['address'], 'summary_cell')]
+        row += [styled(qty, 'summary_cell') for qty in quantities]
+        row.append(styled(sum(quantities), 'summary_bold'))
+        ws.append(row)
+
+    ws.append([])
+    total_row = [styled('ВСЕГО', 'summary_bold'), styled('', 'summary_bold'), styled('', 'summary_bold')]
+    total_row += [styled(qty, 'summary_total') for qty in position_totals]
+    total_row.append(styled(sum(position_totals), 'summary_total'))
+    ws.append(total_row)
+
+    excel_buffer = io.BytesIO()
+    wb.save(excel_buffer)
+    excel_buffer.seek(0)
+    return excel_buffer
@@ -0,0 +1,53 @@
+import json
+import threading
+from collections import OrderedDict
+
+
+class KeyboardCache:
+    """Заранее собранные inline-клавиатуры в виде готового JSON
+
+    builder(*key) из register() возвращает InlineKeyboardMarkup; get()
+    собирает и сериализует его один раз на каждый key, дальше отдаёт ту же
+    строку — telebot передаёт строку в reply_markup как есть. Клавиатуры с
+    ключом (например, меню правки по набору позиций) хранятся в LRU из
+    max_variants штук. Когда version() меняется (правка каталога), кэш
+    сбрасывается целиком.
+    """
+
+    def __init__(self, version=lambda: None, max_variants=256):
+        self.version = version
+        self.max_variants = max_variants
+        self._builders = {}
+        self._cache = OrderedDict()
+        self._cache_version = None
+        self._lock = threading.Lock()
+
+    def register(self, name, builder):
+        self._builders[name] = builder
+        self.invalidate()
+
+    def invalidate(self):
+        with self._lock:
+            self._cache.clear()
+
+    def get(self, name, *key):
+        """JSON клавиатуры name для параметров key"""
+        cache_key = (name,) + key
+        version = self.version()
+        with self._lock:
+            if version != self._cache_version:
+                self._cache.clear()
+                self._cache_version = version
+            markup = self._cache.get(cache_key)
+            if markup is not None:
+                self._cache.move_to_end(cache_key)
+                return markup
+        # Компактнее to_json(): без пробелов и \u-экранирования кириллицы
+        markup = json.dumps(self._builders[name](*key).to_dict(), ensure_ascii=False, separators=(',', ':'))
+        with self._lock:
+            if self._cache_version != version:
+                return markup
+            self._cache[cache_key] = markup
+            while len(self._cache) > self.max_variants:
+                self._cache.popitem(last=False)
+        return markup
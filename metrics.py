@@ -0,0 +1,178 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# Границы гистограмм задержек, секунды
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name}: ожидаются метки {self.label_names}, получены {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _callback_samples(self, fn):
+        """Строки метрики по значениям, которые fn возвращает при чтении"""
+        try:
+            values = fn()
+        except Exception as e:
+            print(f"Ошибка чтения метрики {self.name}: {e}")
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        items = sorted((tuple(str(v) for v in key), value) for key, value in values.items())
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in items]
+
+
+class Counter(_Metric):
+    """Монотонно растущий счётчик; fn — функция, возвращающая {метки: значение} при каждом чтении"""
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=(), fn=None):
+        super().__init__(name, documentation, labels)
+        self.fn = fn
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def total(self):
+        """Сумма по всем наборам меток"""
+        with self._lock:
+            return sum(self._values.values())
+
+    def _samples(self):
+        if self.fn is not None:
+            return self._callback_samples(self.fn)
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(_Metric):
+    """Текущее значение; fn — функция, возвращающая {метки: значение} при каждом чтении"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), fn=None):
+        super().__init__(name, documentation, labels)
+        self.fn = fn
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self):
+        if self.fn is not None:
+            return self._callback_samples(self.fn)
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in items]
+
+
+class Histogram(_Metric):
+    """Распределение длительностей по корзинам"""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data['counts'][i] += 1
+                    break
+            data['sum'] += value
+            data['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((key, {'counts': list(data['counts']), 'sum': data['sum'], 'count': data['count']})
+                           for key, data in self._values.items())
+        lines = []
+        for key, data in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, data['counts']):
+                cumulative += count
+                labels = _format_labels(self.label_names, key, [('le', _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(data['sum'])}")
+            lines.append(f"{self.name}_count{labels} {data['count']}")
+        return lines
+
+
+class Registry:
+    """Набор метрик процесса в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=(), fn=None):
+        return self.register(Counter(name, documentation, labels, fn))
+
+    def gauge(self, name, documentation, labels=(), fn=None):
+        return self.register(Gauge(name, documentation, labels, fn))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
@@ -0,0 +1,87 @@
+import threading
+from contextlib import contextmanager
+
+from telebot.apihelper import ApiTelegramException
+
+MESSAGE_LIMIT = 4096
+
+
+class ResponseBuffer:
+    """Исходящие сообщения одного обновления, отправляемые разом в конце
+
+    Внутри collect() send() и replace() только копят ответы, а при выходе
+    они уходят минимальным числом вызовов: подряд идущие сообщения в один
+    чат склеиваются, пока у предыдущего нет клавиатуры и текст помещается
+    в limit; replace(chat, message_id) превращает первое следующее
+    сообщение в этот чат в edit_message_text вместо удаления и повторной
+    отправки. Вне collect() (задачи планировщика) всё отправляется сразу.
+    """
+
+    def __init__(self, bot, limit=MESSAGE_LIMIT):
+        self.bot = bot
+        self.limit = limit
+        self._local = threading.local()
+
+    @contextmanager
+    def collect(self):
+        if getattr(self._local, 'pending', None) is not None:
+            yield
+            return
+        self._local.pending = []
+        self._local.replace = {}
+        try:
+            yield
+        finally:
+            pending, replace = self._local.pending, self._local.replace
+            self._local.pending = self._local.replace = None
+            self._flush(pending, replace)
+
+    def send(self, chat_id, text, reply_markup=None, reply_to=None):
+        pending = getattr(self._local, 'pending', None)
+        if pending is None:
+            self.bot.send_message(chat_id, text, reply_markup=reply_markup, reply_to_message_id=reply_to)
+            return
+        last = pending[-1] if pending else None
+        if last and last['chat_id'] == chat_id and last['reply_markup'] is None \
+                and len(last['text']) + 2 + len(text) <= self.limit:
+            last['text'] += '\n\n' + text
+            last['reply_markup'] = reply_markup
+            return
+        pending.append({'chat_id': chat_id, 'text': text, 'reply_markup': reply_markup, 'reply_to': reply_to})
+
+    def replace(self, chat_id, message_id):
+        """Следующее сообщение в чат заменит message_id; без него сообщение удаляется"""
+        if getattr(self._local, 'pending', None) is None:
+            self.bot.delete_message(chat_id, message_id)
+            return
+        self._local.replace[chat_id] = message_id
+
+    def _flush(self, pending, replace):
+        for message in pending:
+            message_id = replace.pop(message['chat_id'], None)
+            if message_id is not None and self._edit(message_id, message):
+                continue
+            if message_id is not None:
+                self._delete(message['chat_id'], message_id)
+            self.bot.send_message(message['chat_id'], message['text'], reply_markup=message['reply_markup'],
+                                  reply_to_message_id=message['reply_to'])
+        for chat_id, message_id in replace.items():
+            self._delete(chat_id, message_id)
+
+    def _edit(self, message_id, message):
+        try:
+            self.bot.edit_message_text(message['text'], message['chat_id'], message_id,
+                                       reply_markup=message['reply_markup'])
+            return True
+        except ApiTelegramException as e:
+            # Тот же текст и клавиатура — сообщение уже в нужном виде
+            if 'message is not modified' in (e.description or ''):
+                return True
+            print(f"Не удалось изменить сообщение {message_id}, отправляю новое: {e.description}")
+            return False
+
+    def _delete(self, chat_id, message_id):
+        try:
+            self.bot.delete_message(chat_id, message_id)
+        except ApiTelegramException as e:
+            print(f"Не удалось удалить сообщение {message_id}: {e.description}")
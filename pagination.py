@@ -0,0 +1,152 @@
+import random
+import threading
+from collections import OrderedDict
+
+PAGE_LIMIT = 3800
+
+
+class Report:
+    """Отчёт из заголовка, записей и итога; страницы режутся только между записями
+
+    items — снимок данных на момент открытия, render(номер, запись) — текст
+    одной записи. Заголовок целиком выводится на первой странице, на
+    остальных — только title. Начала страниц запоминаются по мере
+    листания, поэтому страница собирается за O(её размера).
+    """
+
+    def __init__(self, title, items, render, header='', footer='', buttons=()):
+        self.title = title
+        self.header = header or title
+        self.items = items
+        self.render = render
+        self.footer = footer
+        self.buttons = list(buttons)
+        self.starts = [0]
+
+    def _record(self, index):
+        if index == len(self.items):
+            return self.footer
+        return self.render(index, self.items[index])
+
+    def _records_count(self):
+        return len(self.items) + (1 if self.footer else 0)
+
+    def page(self, number, limit=PAGE_LIMIT):
+        """(текст, есть_ли_следующая) страницы number или None, если до неё не долистали"""
+        if number >= len(self.starts):
+            return None
+        start = self.starts[number]
+        head = self.header if number == 0 else self.title
+        parts, size, index = [], len(head) + 64, start
+        while index < self._records_count():
+            text = self._record(index)
+            if parts and size + len(text) > limit:
+                break
+            if size + len(text) > limit:
+                # Запись сама длиннее страницы — обрезаем по границе строки
+                text = text[:max(0, limit - size)].rsplit('\n', 1)[0] + '\n…\n'
+            parts.append(text)
+            size += len(text)
+            index += 1
+        shown = min(index, len(self.items))
+        info = f"Стр. {number + 1} · записи {start + 1}–{shown} из {len(self.items)}" if self.items else ''
+        has_next = index < self._records_count()
+        if has_next and number + 1 == len(self.starts):
+            self.starts.append(index)
+        return (f"{head}\n{info}\n\n" + ''.join(parts)).rstrip(), has_next
+
+
+class StoredItems:
+    """Записи отчёта из store, загружаемые кусками по мере обращения"""
+
+    def __init__(self, store, report_id, count, chunk):
+        self.store = store
+        self.report_id = report_id
+        self.count = count
+        self.chunk = chunk
+        self._chunks = {}
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        number = index // self.chunk
+        if number not in self._chunks:
+            chunk = self.store.get(Paginator.KIND, f"{self.report_id}:{number}")
+            if chunk is None:
+                raise KeyError(f"кусок {number} отчёта {self.report_id} истёк")
+            self._chunks[number] = chunk
+        return self._chunks[number][index % self.chunk]
+
+
+class Paginator:
+    """Открытые отчёты для кнопок листания: снимок записей лежит в store
+
+    store — хранилище диалогов (shared_state): при общем SQLite страницу
+    отдаёт любой воркер gunicorn, а снимки отчётов не держатся в памяти.
+    Записи сохраняются кусками по chunk, рядом — заголовок и найденные
+    начала страниц; страница рендерится по запросу и читает только свои
+    куски. Функции render регистрируются по имени (renderer), чтобы их
+    находили и другие воркеры. Отчёты процесса сверх keep последних
+    удаляются, остальные истекают по ttl.
+    """
+
+    KIND = 'report_page'
+
+    def __init__(self, store, keep=50, limit=PAGE_LIMIT, chunk=50):
+        self.store = store
+        self.keep = keep
+        self.limit = limit
+        self.chunk = chunk
+        self.renderers = {}
+        self._opened = OrderedDict()
+        self._lock = threading.Lock()
+
+    def renderer(self, render):
+        """Декоратор: зарегистрировать функцию рендера записи отчёта"""
+        self.renderers[render.__name__] = render
+        return render
+
+    def open(self, report):
+        """Сохранить снимок отчёта, вернуть его id"""
+        if self.renderers.get(report.render.__name__) is not report.render:
+            raise ValueError(f"Функция {report.render.__name__} не зарегистрирована через renderer")
+        # Случайный id: отчёты открывают разные воркеры, номера не должны совпадать
+        report_id = random.getrandbits(31)
+        chunks = [(f"{report_id}:{number}", list(report.items[start:start + self.chunk]))
+                  for number, start in enumerate(range(0, len(report.items), self.chunk))]
+        meta = {'title': report.title, 'header': report.header, 'footer': report.footer,
+                'render': report.render.__name__, 'count': len(report.items), 'starts': [0],
+                'buttons': [[button.text, button.callback_data] for button in report.buttons]}
+        self.store.set_many(self.KIND, chunks + [(f"{report_id}", meta)])
+        evicted = []
+        with self._lock:
+            self._opened[report_id] = len(chunks)
+            while len(self._opened) > self.keep:
+                evicted.append(self._opened.popitem(last=False))
+        for old_id, count in evicted:
+            self.store.delete(self.KIND, f"{old_id}")
+            for number in range(count):
+                self.store.delete(self.KIND, f"{old_id}:{number}")
+        return report_id
+
+    def page(self, report_id, number):
+        """(текст, есть_ли_следующая, кнопки [(текст, callback_data)]) или None для устаревшего отчёта"""
+        meta = self.store.get(self.KIND, f"{report_id}")
+        if meta is None:
+            return None
+        report = Report(meta['title'], StoredItems(self.store, report_id, meta['count'], self.chunk),
+                        self.renderers[meta['render']], header=meta['header'], footer=meta['footer'])
+        report.starts = meta['starts']
+        known = len(report.starts)
+        try:
+            result = report.page(number, self.limit)
+        except KeyError:
+            # Куски снимка истекают по ttl раньше заголовка, который обновляется при листании
+            return None
+        if result is None:
+            return None
+        if len(report.starts) > known:
+            # Начало следующей страницы найдено — запоминаем для всех воркеров
+            self.store.set(self.KIND, f"{report_id}", meta)
+        return result + (meta['buttons'],)
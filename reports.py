@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import threading
+import multiprocessing
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from excel_report import build_orders_workbook
+
+# data — результат сборки (None — отчёт пуст), created_at — время снимка данных,
+# seconds — сколько заняла сборка
+Artifact = namedtuple('Artifact', 'data created_at seconds')
+
+
+# --- Задачи для процессов пула: только данные на входе и на выходе ---
+
+def excel_summary_job(active_users, position_names, date_formatted):
+    """Байты xlsx-сводки или None, если заказов нет"""
+    excel_buffer = build_orders_workbook(active_users, position_names, date_formatted)
+    return excel_buffer.getvalue() if excel_buffer else None
+
+
+def json_export_job(export_data):
+    """Полный бэкап в JSON с отступами"""
+    return json.dumps(export_data, ensure_ascii=False, indent=2).encode('utf-8')
+
+
+def _exit_with_parent(parent_pid):
+    """Процесс пула завершается вместе с родителем, даже если тот убит без atexit"""
+    def watch():
+        while os.getppid() == parent_pid:
+            time.sleep(1)
+        os._exit(0)
+    threading.Thread(target=watch, daemon=True).start()
+
+
+class ReportService:
+    """Фоновая сборка тяжёлых отчётов с кэшем готовых файлов
+
+    run() возвращается сразу: снимок данных (prepare) снимается в потоке
+    сервиса, сборка (build) идёт в пуле процессов и не держит GIL воркеров
+    вебхука, результат отдаётся в deliver(artifact, error). Пока сборка
+    идёт, раз в progress_interval секунд вызывается progress(секунды).
+    Готовый Artifact кэшируется по (name, key): key — версия данных, на
+    которых собран отчёт, поэтому повторный запрос без изменений отдаётся
+    сразу. Если такой же отчёт уже собирается, запрос ждёт его, а не
+    запускает вторую сборку. key=None — не кэшировать. workers=0 — собирать
+    в потоках сервиса, без отдельных процессов. Сборка дольше timeout
+    секунд завершается ошибкой. on_build(name, секунды, ok) вызывается
+    после каждой сборки.
+
+    Процессы пула запускаются через spawn и импортируют главный модуль
+    программы: скрипт, который импортирует бота и запускает отчёты,
+    должен держать свой код под if __name__ == '__main__'.
+    """
+
+    def __init__(self, workers=2, threads=None, cache_size=8, progress_interval=5.0, timeout=600,
+                 on_build=None):
+        self.workers = workers
+        self.cache_size = cache_size
+        self.progress_interval = progress_interval
+        self.timeout = timeout
+        self.on_build = on_build
+        self._cache = OrderedDict()
+        self._waiters = {}
+        self._lock = threading.Lock()
+        self._pool = None
+        self._threads = ThreadPoolExecutor(max_workers=threads or max(2, workers * 2), thread_name_prefix='report')
+
+    def _process_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # spawn: дочерний процесс не наследует блокировки потоков вебхука
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=_exit_with_parent, initargs=(os.getpid(),))
+            return self._pool
+
+    def run(self, name, key, prepare, build, deliver, progress=None, in_pool=True):
+        """Запустить отчёт; 'cached', 'joined' или 'started'
+
+        key вычисляется до снимка данных: если данные поменялись между
+        ними, отчёт просто не попадёт в кэш для новой версии.
+        """
+        cache_key = (name, key) if key is not None else (name, object())
+        with self._lock:
+            artifact = self._cache.get(cache_key)
+            if artifact is not None:
+                self._cache.move_to_end(cache_key)
+            elif cache_key in self._waiters:
+                self._waiters[cache_key].append(deliver)
+                return 'joined'
+            else:
+                self._waiters[cache_key] = [deliver]
+        if artifact is not None:
+            self._threads.submit(self._deliver, [deliver], artifact, None)
+            return 'cached'
+        self._threads.submit(self._build, cache_key, key is not None, prepare, build, progress, in_pool)
+        return 'started'
+
+    def _build(self, cache_key, cacheable, prepare, build, progress, in_pool):
+        started = time.monotonic()
+        artifact = error = None
+        try:
+            created_at = time.time()
+            args = prepare()
+            if in_pool and self.workers > 0:
+                data = self._wait(self._process_pool().submit(build, *args), started, progress)
+            else:
+                data = build(*args)
+            artifact = Artifact(data, created_at, time.monotonic() - started)
+        except BrokenProcessPool as e:
+            # Процесс пула упал (например, по памяти) — следующий запуск создаст новый пул
+            with self._lock:
+                self._pool = None
+            error = e
+        except Exception as e:
+            error = e
+        if self.on_build:
+            self.on_build(cache_key[0], time.monotonic() - started, error is None)
+        with self._lock:
+            waiters = self._waiters.pop(cache_key, [])
+            if artifact is not None and cacheable:
+                self._cache[cache_key] = artifact
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        self._deliver(waiters, artifact, error)
+
+    def _wait(self, future, started, progress):
+        while True:
+            try:
+                return future.result(timeout=self.progress_interval)
+            except TimeoutError:
+                if time.monotonic() - started > self.timeout:
+                    future.cancel()
+                    raise TimeoutError(f"отчёт не собран за {self.timeout:.0f} с")
+                if progress:
+                    try:
+                        progress(time.monotonic() - started)
+                    except Exception as e:
+                        print(f"Ошибка уведомления о ходе отчёта: {e}")
+
+    @staticmethod
+    def _deliver(waiters, artifact, error):
+        for deliver in waiters:
+            try:
+                deliver(artifact, error)
+            except Exception as e:
+                print(f"Ошибка отправки отчёта: {e}")
+
+    def invalidate(self, name=None):
+        """Сбросить кэш отчёта name (или весь)"""
+        with self._lock:
+            for cache_key in [k for k in self._cache if name is None or k[0] == name]:
+                del self._cache[cache_key]
+
+    def stop(self):
+        self._threads.shutdown(wait=False)
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
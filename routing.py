@@ -0,0 +1,126 @@
+import base64
+import binascii
+import functools
+
+_END = object()
+
+# Упакованный callback: PACKED_PREFIX + base64(версия, код действия, аргументы-varint)
+PACKED_PREFIX = '~'
+CALLBACK_VERSION = 1
+
+
+def pack_callback(code, *args):
+    """Компактная callback_data для действия code с целыми неотрицательными аргументами"""
+    raw = bytearray((CALLBACK_VERSION, code))
+    for value in args:
+        while value >= 0x80:
+            raw.append(value & 0x7f | 0x80)
+            value >>= 7
+        raw.append(value)
+    return PACKED_PREFIX + base64.urlsafe_b64encode(bytes(raw)).rstrip(b'=').decode('ascii')
+
+
+def unpack_callback(data):
+    """(код действия, [аргументы]) или None для чужой версии и битых данных"""
+    body = data[len(PACKED_PREFIX):]
+    try:
+        raw = base64.urlsafe_b64decode(body + '=' * (-len(body) % 4))
+    except (ValueError, binascii.Error):
+        return None
+    if len(raw) < 2 or raw[0] != CALLBACK_VERSION:
+        return None
+    args, value, shift = [], 0, 0
+    for byte in raw[2:]:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            args.append(value)
+            value, shift = 0, 0
+    if shift:
+        return None
+    return raw[1], args
+
+
+class CallbackRouter:
+    """Таблица маршрутов callback_data
+
+    Точные значения ищутся в словаре, значения с параметром (delete_user_<id>,
+    history_date_<дата>) — по префиксному дереву за один проход по строке,
+    упакованные (pack_callback) — по коду действия после декодирования.
+    Middleware оборачивают обработчик один раз при регистрации, поэтому
+    разбор callback стоит одинаково при любом числе маршрутов.
+
+    Обработчик вызывается как handler(call, *args), где args — параметры
+    маршрута (хвост после префикса или заданные при регистрации), к которым
+    middleware могут добавить свои значения. Middleware — функция
+    middleware(next_handler, call, *args): вызывает next_handler, чтобы
+    продолжить, или не вызывает, чтобы прервать обработку.
+    """
+
+    def __init__(self):
+        self._exact = {}
+        self._trie = {}
+        self._packed = {}
+
+    @staticmethod
+    def _wrap(handler, middleware):
+        for mw in reversed(middleware):
+            handler = functools.partial(mw, handler)
+        return handler
+
+    def add(self, data, handler, middleware=(), args=(), name=None):
+        """Маршрут для точного значения callback_data"""
+        self._exact[data] = (name or data, self._wrap(handler, middleware), tuple(args))
+
+    def add_prefix(self, prefix, handler, middleware=(), name=None):
+        """Маршрут для callback_data вида <prefix><параметр>"""
+        node = self._trie
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[_END] = (name or prefix + '*', self._wrap(handler, middleware))
+
+    def add_packed(self, code, handler, middleware=(), name=None):
+        """Маршрут для callback_data из pack_callback(code, ...)"""
+        if not 0 <= code <= 255:
+            raise ValueError(f"Код действия вне диапазона байта: {code}")
+        self._packed[code] = (name or f"packed_{code}", self._wrap(handler, middleware))
+
+    def resolve(self, data):
+        """(имя, обработчик, аргументы) или None для неизвестного callback"""
+        route = self._exact.get(data)
+        if route is not None:
+            return route
+        if data.startswith(PACKED_PREFIX):
+            unpacked = unpack_callback(data)
+            route = self._packed.get(unpacked[0]) if unpacked else None
+            if route is None:
+                return None
+            name, handler = route
+            return name, handler, tuple(unpacked[1])
+        # Самый длинный подходящий префикс
+        node, found = self._trie, None
+        for i, char in enumerate(data):
+            node = node.get(char)
+            if node is None:
+                break
+            if _END in node:
+                found = (node[_END], i + 1)
+        if found is None:
+            return None
+        (name, handler), length = found
+        return name, handler, (data[length:],)
+
+    def route_name(self, data):
+        """Имя маршрута для метрик; неизвестные — 'unknown'"""
+        route = self.resolve(data or '')
+        return route[0] if route else 'unknown'
+
+    def dispatch(self, call):
+        """Вызвать обработчик маршрута; False, если маршрут не найден"""
+        route = self.resolve(call.data or '')
+        if route is None:
+            return False
+        _, handler, args = route
+        handler(call, *args)
+        return True
@@ -0,0 +1,322 @@
+import os
+import json
+import heapq
+import random
+import itertools
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from storage import atomic_write_json
+
+
+class Job:
+    """Задача планировщика: ежедневно в daily_at (ЧЧ:ММ) или один раз в run_at
+
+    action получает дату запуска 'ГГГГ-ММ-ДД'. Пропущенный запуск
+    (процесс спал или был перезапущен) выполняется, если опоздание
+    не больше grace секунд. Неудачная попытка повторяется до max_attempts
+    раз с растущей паузой от backoff секунд, но не позже retry_window
+    секунд от первого запуска. depends_on — задачи, которые должны успешно
+    выполниться за ту же дату раньше этой.
+    """
+
+    def __init__(self, name, action, daily_at=None, run_at=None, grace=600, depends_on=(),
+                 max_attempts=3, backoff=30, lease=1800, retry_window=3 * 3600):
+        if (daily_at is None) == (run_at is None):
+            raise ValueError("Нужно указать daily_at или run_at")
+        self.name = name
+        self.action = action
+        self.daily_at = daily_at
+        self.run_at = run_at
+        self.grace = grace
+        self.depends_on = tuple(depends_on)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = lease
+        self.retry_window = retry_window
+
+    def retry_delay(self, attempt):
+        """Пауза перед повтором: экспонента с разбросом ±20%"""
+        return self.backoff * 2 ** (attempt - 1) * random.uniform(0.8, 1.2)
+
+    def next_fire(self, now, last_date):
+        """Ближайшее время запуска с учётом окна догоняния или None"""
+        if self.run_at is not None:
+            if last_date is not None or now - self.run_at > timedelta(seconds=self.grace):
+                return None
+            return self.run_at
+        hour, minute = map(int, self.daily_at.split(':'))
+        fire_at = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if last_date == fire_at.strftime('%Y-%m-%d') or now - fire_at > timedelta(seconds=self.grace):
+            fire_at += timedelta(days=1)
+        return fire_at
+
+
+class JobRunStore:
+    """Журнал запусков задач: одна запись на (задача, дата)
+
+    Статусы: pending (ждёт запуска, повтора или зависимости), running
+    (выполняется — с владельцем и сроком аренды), succeeded, failed
+    (окончательно). Файл перезаписывается атомарно при каждом переходе,
+    чтобы после падения процесса было видно, что успело выполниться.
+    """
+
+    KEEP_DAYS = 30
+
+    def __init__(self, path):
+        self.path = path
+        self.owner = f"{os.getpid()}-{random.getrandbits(32):08x}"
+        self._lock = threading.Lock()
+        self.runs = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.runs = json.load(f)
+            except Exception as e:
+                print(f"Ошибка загрузки журнала задач: {e}")
+
+    @staticmethod
+    def _key(job_name, run_date):
+        return f"{job_name}:{run_date}"
+
+    def get(self, job_name, run_date):
+        with self._lock:
+            run = self.runs.get(self._key(job_name, run_date))
+            return dict(run) if run else None
+
+    def update(self, job_name, run_date, **changes):
+        """Изменить запись запуска (создав её при необходимости) и сохранить"""
+        with self._lock:
+            run = self.runs.setdefault(self._key(job_name, run_date), {
+                'job': job_name, 'date': run_date, 'status': 'pending', 'attempts': 0,
+                'created_at': datetime.now().isoformat(timespec='seconds')})
+            run.update(changes)
+            cutoff = (datetime.now() - timedelta(days=self.KEEP_DAYS)).strftime('%Y-%m-%d')
+            self.runs = {key: value for key, value in self.runs.items() if value['date'] >= cutoff}
+            atomic_write_json(self.path, self.runs, indent=2)
+            return dict(run)
+
+    def unfinished(self):
+        """Запуски, не дошедшие до succeeded/failed"""
+        with self._lock:
+            return [dict(run) for run in self.runs.values() if run['status'] in ('pending', 'running')]
+
+
+class Scheduler:
+    """Планировщик на очереди с приоритетом по времени следующего запуска
+
+    Поток спит до ближайшего срока (или до добавления новой задачи), а не
+    опрашивает часы. Задачи выполняются в пуле потоков и не блокируют друг
+    друга; одна и та же задача одновременно не запускается. Расписание
+    (last_date, next_run) живёт в памяти и передаётся в on_change только при
+    переходах. Каждый запуск проходит через журнал JobRunStore: задача за
+    дату выполняется успешно не больше одного раза, повторяется после сбоев
+    и ждёт свои зависимости; после рестарта recover() подхватывает
+    незавершённые запуски.
+    """
+
+    DEPENDENCY_POLL = 30
+
+    def __init__(self, tz, runs, job_state=None, on_change=None, on_failure=None, on_finish=None, workers=4):
+        self.tz = tz
+        self.runs = runs
+        self.jobs = {}
+        self.job_state = job_state if job_state is not None else {}
+        self.on_change = on_change
+        self.on_failure = on_failure
+        # on_finish(job_name, outcome, seconds) — длительность каждой попытки
+        self.on_finish = on_finish
+        self._heap = []
+        self._seq = itertools.count()
+        self._running = set()
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._stopped = False
+
+    def now(self):
+        return datetime.now(self.tz)
+
+    def add_job(self, job):
+        with self._cond:
+            self.jobs[job.name] = job
+            self.job_state.setdefault(job.name, {'last_date': None})
+            self._schedule_locked(job)
+            self._cond.notify()
+
+    def _schedule_locked(self, job):
+        fire_at = job.next_fire(self.now(), self.job_state[job.name].get('last_date'))
+        if fire_at is not None:
+            self.job_state[job.name]['next_run'] = fire_at.isoformat()
+            heapq.heappush(self._heap, (fire_at, next(self._seq), job.name, None))
+        else:
+            self.job_state[job.name]['next_run'] = None
+
+    def _schedule_retry(self, job_name, run_date, delay):
+        """Поставить повторную попытку запуска за run_date через delay секунд"""
+        with self._cond:
+            heapq.heappush(self._heap, (self.now() + timedelta(seconds=delay), next(self._seq), job_name, run_date))
+            self._cond.notify()
+
+    def _state_changed(self):
+        with self._cond:
+            snapshot = {job_name: dict(data) for job_name, data in self.job_state.items()}
+        if self.on_change:
+            try:
+                self.on_change(snapshot)
+            except Exception as e:
+                print(f"Ошибка сохранения состояния планировщика: {e}")
+
+    def recover(self):
+        """Подхватить запуски, прерванные рестартом или ждущие повтора
+
+        Вызывается ведущим процессом: записи running чужого владельца
+        принадлежат упавшему процессу и считаются неудачной попыткой. Если
+        попытки исчерпаны (например, max_attempts=1), запуск помечается
+        failed и не повторяется.
+        """
+        now = self.now()
+        for run in self.runs.unfinished():
+            job = self.jobs.get(run['job'])
+            if job is None:
+                continue
+            if run['status'] == 'running':
+                lease_until = datetime.fromisoformat(run['lease_until'])
+                if run.get('owner') == self.runs.owner and lease_until > now:
+                    continue
+                if run['attempts'] >= job.max_attempts:
+                    self._fail(job, run['date'], f"Прервано рестартом на попытке {run['attempts']}, "
+                                                 f"повторов не будет")
+                    continue
+                print(f"🔁 {job.name} ({run['date']}): запуск прерван, попытка {run['attempts']}")
+                run = self.runs.update(job.name, run['date'], status='pending', error='Прервано рестартом')
+            next_attempt = run.get('next_attempt')
+            delay = (datetime.fromisoformat(next_attempt) - now).total_seconds() if next_attempt else 0
+            self._schedule_retry(job.name, run['date'], max(0, delay))
+
+    def run_forever(self):
+        """Основной цикл: ждать ближайший срок и запускать задачи"""
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if self._heap:
+                        delay = (self._heap[0][0] - self.now()).total_seconds()
+                        if delay <= 0:
+                            break
+                        # Просыпаемся не реже раза в минуту — на случай перевода часов
+                        self._cond.wait(timeout=min(delay, 60))
+                    else:
+                        self._cond.wait(timeout=60)
+                if self._stopped:
+                    return
+                fire_at, _, name, run_date = heapq.heappop(self._heap)
+                job = self.jobs.get(name)
+                if job is None:
+                    continue
+                if run_date is None:
+                    # Плановый запуск: сразу ставим следующий
+                    run_date = fire_at.strftime('%Y-%m-%d')
+                    self.job_state[name]['last_date'] = run_date
+                    self._schedule_locked(job)
+                    schedule_changed = True
+                else:
+                    schedule_changed = False
+                busy = name in self._running
+                if not busy:
+                    self._running.add(name)
+            if schedule_changed:
+                self._state_changed()
+            if busy:
+                print(f"⏸ {name}: предыдущий запуск ещё выполняется, {run_date} — позже")
+                self._schedule_retry(name, run_date, self.DEPENDENCY_POLL)
+                continue
+            lateness = (self.now() - fire_at).total_seconds()
+            if lateness > 60:
+                print(f"⏩ {name}: догоняем запуск за {run_date}, опоздание {lateness:.0f} с")
+            self._executor.submit(self._execute, job, run_date)
+
+    def _fail(self, job, run_date, error):
+        self.runs.update(job.name, run_date, status='failed', error=error,
+                         finished_at=self.now().isoformat(), next_attempt=None)
+        print(f"❌ {job.name} ({run_date}): {error}")
+        if self.on_failure:
+            try:
+                self.on_failure(job.name, error)
+            except Exception as notify_error:
+                print(f"Ошибка уведомления о сбое задачи: {notify_error}")
+
+    def _execute(self, job, run_date):
+        try:
+            self._attempt(job, run_date)
+        except Exception as e:
+            print(f"Ошибка выполнения задачи {job.name}: {e}")
+        finally:
+            with self._cond:
+                self._running.discard(job.name)
+
+    def _attempt(self, job, run_date):
+        now = self.now()
+        run = self.runs.get(job.name, run_date) or self.runs.update(job.name, run_date, scheduled_at=now.isoformat())
+        if run['status'] in ('succeeded', 'failed'):
+            print(f"⏸ {job.name} ({run_date}): уже {run['status']}, повторно не запускаем")
+            return
+        if (now - datetime.fromisoformat(run['scheduled_at'])).total_seconds() > job.retry_window:
+            self._fail(job, run_date, f"Не выполнено за отведённое время ({run.get('error') or 'ожидание'})")
+            return
+
+        # Зависимости за ту же дату
+        for dependency in job.depends_on:
+            dependency_run = self.runs.get(dependency, run_date)
+            status = dependency_run['status'] if dependency_run else None
+            if status == 'failed':
+                self._fail(job, run_date, f"Зависимость {dependency} завершилась ошибкой")
+                return
+            if status != 'succeeded':
+                if run.get('waiting_for') != dependency:
+                    print(f"⏳ {job.name} ({run_date}): ждёт {dependency}")
+                    self.runs.update(job.name, run_date, waiting_for=dependency)
+                self._schedule_retry(job.name, run_date, self.DEPENDENCY_POLL)
+                return
+
+        attempt = run['attempts'] + 1
+        started = self.now()
+        print(f"*** ЗАДАЧА {job.name} ({run_date}), попытка {attempt} ***")
+        self.runs.update(job.name, run_date, status='running', attempts=attempt, owner=self.runs.owner,
+                         started_at=started.isoformat(), waiting_for=None,
+                         lease_until=(started + timedelta(seconds=job.lease)).isoformat())
+        try:
+            job.action(run_date)
+        except Exception as e:
+            self._finished(job, 'error', started)
+            error = str(e)[:200]
+            if attempt >= job.max_attempts:
+                self._fail(job, run_date, error)
+                return
+            delay = job.retry_delay(attempt)
+            self.runs.update(job.name, run_date, status='pending', error=error,
+                             next_attempt=(self.now() + timedelta(seconds=delay)).isoformat())
+            print(f"⚠️ {job.name} ({run_date}): {error}; повтор через {delay:.0f} с")
+            self._schedule_retry(job.name, run_date, delay)
+            return
+        self._finished(job, 'success', started)
+        self.runs.update(job.name, run_date, status='succeeded', finished_at=self.now().isoformat(),
+                         error=None, next_attempt=None)
+        print(f"✅ {job.name}: выполнено за {(self.now() - started).total_seconds():.1f} с")
+
+    def _finished(self, job, outcome, started):
+        if self.on_finish:
+            try:
+                self.on_finish(job.name, outcome, (self.now() - started).total_seconds())
+            except Exception as e:
+                print(f"Ошибка учёта длительности задачи: {e}")
+
+    def upcoming(self):
+        """Список (время, задача) ближайших запусков по порядку"""
+        with self._cond:
+            return [(fire_at, name) for fire_at, _, name, _ in sorted(self._heap)]
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import fcntl
+import sqlite3
+import threading
+
+
+class MemoryConversationStore:
+    """Состояние диалогов в памяти процесса (один воркер)"""
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, kind, user_id):
+        key = (kind, str(user_id))
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at < time.time():
+            with self._lock:
+                self._data.pop(key, None)
+            return None
+        return value
+
+    def set(self, kind, user_id, value):
+        with self._lock:
+            self._data[(kind, str(user_id))] = (value, time.time() + self.ttl)
+
+    def set_many(self, kind, items):
+        """Записать пары (user_id, value) разом"""
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            for user_id, value in items:
+                self._data[(kind, str(user_id))] = (value, expires_at)
+
+    def delete(self, kind, user_id):
+        with self._lock:
+            self._data.pop((kind, str(user_id)), None)
+
+
+class SqliteConversationStore:
+    """Состояние диалогов в общем файле SQLite — видно всем воркерам gunicorn"""
+
+    PURGE_EVERY = 100
+
+    def __init__(self, db_path, ttl=3600):
+        self.db_path = db_path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._writes = 0
+        self._conn().execute(
+            'CREATE TABLE IF NOT EXISTS conversations ('
+            'kind TEXT NOT NULL, user_id TEXT NOT NULL, value TEXT NOT NULL, '
+            'expires_at REAL NOT NULL, PRIMARY KEY (kind, user_id))')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, kind, user_id):
+        row = self._conn().execute(
+            'SELECT value FROM conversations WHERE kind = ? AND user_id = ? AND expires_at > ?',
+            (kind, str(user_id), time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, kind, user_id, value):
+        conn = self._conn()
+        conn.execute(
+            'INSERT OR REPLACE INTO conversations (kind, user_id, value, expires_at) VALUES (?, ?, ?, ?)',
+            (kind, str(user_id), json.dumps(value, ensure_ascii=False), time.time() + self.ttl))
+        # Просроченные записи чистим изредка, а не на каждом запросе
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            conn.execute('DELETE FROM conversations WHERE expires_at <= ?', (time.time(),))
+
+    def set_many(self, kind, items):
+        """Записать пары (user_id, value) одной транзакцией"""
+        expires_at = time.time() + self.ttl
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                'INSERT OR REPLACE INTO conversations (kind, user_id, value, expires_at) VALUES (?, ?, ?, ?)',
+                [(kind, str(user_id), json.dumps(value, ensure_ascii=False), expires_at) for user_id, value in items])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def delete(self, kind, user_id):
+        self._conn().execute('DELETE FROM conversations WHERE kind = ? AND user_id = ?', (kind, str(user_id)))
+
+
+def create_conversation_store(kind, data_dir, ttl=3600):
+    """Создать хранилище диалогов по имени: memory или sqlite"""
+    if kind == 'memory':
+        return MemoryConversationStore(ttl=ttl)
+    if kind == 'sqlite':
+        return SqliteConversationStore(os.path.join(data_dir, 'conversations.db'), ttl=ttl)
+    raise ValueError(f"Неизвестное хранилище диалогов: {kind}")
+
+
+class LeaderLock:
+    """Выбор ведущего процесса через flock на общем файле
+
+    Блокировку держит ровно один процесс; ОС снимает её, когда процесс
+    умирает, и тогда её получает следующий ожидающий.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self, blocking=True):
+        """Стать ведущим; без blocking — вернуть False, если занято"""
+        lock_file = open(self.path, 'a')
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(lock_file.fileno(), flags)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._file = lock_file
+        return True
+
+    @property
+    def is_leader(self):
+        return self._file is not None
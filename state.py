@@ -0,0 +1,350 @@
+import bisect
+import itertools
+import threading
+
+
+def copy_user(user_data):
+    """Копия данных клиента, не разделяющая вложенный словарь заказов"""
+    return {**user_data, 'orders': dict(user_data['orders'])}
+
+
+class OrderAggregates:
+    """Итоги текущих заказов, обновляемые при каждом изменении клиента
+
+    Держит суммы по позициям и отсортированный по названию точки список
+    активных клиентов (зарегистрирован и есть заказы), так что сводки
+    и статистика не пересчитывают всю базу на каждый клик.
+    """
+
+    def __init__(self):
+        self.position_totals = {}
+        self._sort_keys = {}
+        self._sorted = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _is_active(user_data):
+        return bool(user_data and user_data.get('registered') and user_data.get('orders'))
+
+    def update(self, user_id_str, before, after):
+        """Учесть изменение клиента: before/after — данные до и после (или None)"""
+        with self._lock:
+            if self._is_active(before):
+                for pos, qty in before['orders'].items():
+                    self.position_totals[pos] -= qty
+                    if not self.position_totals[pos]:
+                        del self.position_totals[pos]
+                sort_key = self._sort_keys.pop(user_id_str)
+                del self._sorted[bisect.bisect_left(self._sorted, sort_key)]
+            if self._is_active(after):
+                for pos, qty in after['orders'].items():
+                    self.position_totals[pos] = self.position_totals.get(pos, 0) + qty
+                sort_key = (after['location_name'], user_id_str)
+                self._sort_keys[user_id_str] = sort_key
+                bisect.insort(self._sorted, sort_key)
+
+    def rebuild(self, users):
+        with self._lock:
+            self.position_totals = {}
+            self._sort_keys = {}
+            self._sorted = []
+        for user_id_str, user_data in users.items():
+            self.update(user_id_str, None, user_data)
+
+    def active_count(self):
+        return len(self._sorted)
+
+    def total_items(self):
+        with self._lock:
+            return sum(self.position_totals.values())
+
+    def totals(self):
+        """Копия сумм по позициям"""
+        with self._lock:
+            return dict(self.position_totals)
+
+    def active_user_ids(self):
+        """id активных клиентов в порядке названия точки"""
+        with self._lock:
+            return [user_id_str for _, user_id_str in self._sorted]
+
+
+def _normalize(text):
+    return ' '.join(text.lower().replace('ё', 'е').split())
+
+
+class ClientDirectory:
+    """Поисковый индекс зарегистрированных клиентов по названию точки и адресу
+
+    Запрос от трёх символов ищется как подстрока через триграммный индекс
+    (пересечение списков клиентов по каждой триграмме запроса и проверка
+    совпадения), короткий запрос — как начало любого слова. Список без
+    запроса отдаётся постранично из отсортированного по названию массива.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._texts = {}
+        self._sort_keys = {}
+        self._sorted = []
+        self._grams = {}
+        self._words = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _entry(user_data):
+        if not user_data or not user_data.get('registered'):
+            return None
+        return user_data['location_name'], user_data['address']
+
+    @staticmethod
+    def _trigrams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def update(self, user_id_str, before, after):
+        """Учесть изменение клиента: before/after — данные до и после (или None)"""
+        entry = self._entry(after)
+        if entry == self._entry(before) and (entry is None) == (user_id_str not in self._entries):
+            return
+        with self._lock:
+            old_text = self._texts.pop(user_id_str, None)
+            if old_text is not None:
+                del self._entries[user_id_str]
+                del self._sorted[bisect.bisect_left(self._sorted, self._sort_keys.pop(user_id_str))]
+                for gram in self._trigrams(old_text):
+                    ids = self._grams[gram]
+                    ids.discard(user_id_str)
+                    if not ids:
+                        del self._grams[gram]
+                for word in set(old_text.split()):
+                    del self._words[bisect.bisect_left(self._words, (word, user_id_str))]
+            if entry is not None:
+                text = _normalize(f"{entry[0]} {entry[1]}")
+                self._entries[user_id_str] = entry
+                self._texts[user_id_str] = text
+                sort_key = (_normalize(entry[0]), user_id_str)
+                self._sort_keys[user_id_str] = sort_key
+                bisect.insort(self._sorted, sort_key)
+                for gram in self._trigrams(text):
+                    self._grams.setdefault(gram, set()).add(user_id_str)
+                for word in set(text.split()):
+                    bisect.insort(self._words, (word, user_id_str))
+
+    def rebuild(self, users):
+        # Массивы сортируются один раз в конце, а не вставкой по одному
+        entries, texts, sort_keys, grams, words = {}, {}, {}, {}, []
+        for user_id_str, user_data in users.items():
+            entry = self._entry(user_data)
+            if entry is None:
+                continue
+            text = _normalize(f"{entry[0]} {entry[1]}")
+            entries[user_id_str] = entry
+            texts[user_id_str] = text
+            sort_keys[user_id_str] = (_normalize(entry[0]), user_id_str)
+            for gram in self._trigrams(text):
+                grams.setdefault(gram, set()).add(user_id_str)
+            words.extend((word, user_id_str) for word in set(text.split()))
+        with self._lock:
+            self._entries, self._texts, self._sort_keys, self._grams = entries, texts, sort_keys, grams
+            self._sorted = sorted(sort_keys.values())
+            self._words = sorted(words)
+
+    def _match_ids(self, query):
+        if len(query) >= 3:
+            grams = sorted(self._trigrams(query), key=lambda gram: len(self._grams.get(gram, ())))
+            ids = set(self._grams.get(grams[0], ()))
+            for gram in grams[1:]:
+                ids &= self._grams.get(gram, set())
+                if not ids:
+                    break
+            return {user_id_str for user_id_str in ids if query in self._texts[user_id_str]}
+        start = bisect.bisect_left(self._words, (query,))
+        ids = set()
+        for word, user_id_str in self._words[start:]:
+            if not word.startswith(query):
+                break
+            ids.add(user_id_str)
+        return ids
+
+    def search(self, query='', offset=0, limit=10):
+        """(всего найдено, [(user_id, точка, адрес)]) — страница результатов по названию"""
+        query = _normalize(query)
+        with self._lock:
+            if not query:
+                total = len(self._sorted)
+                page = [user_id_str for _, user_id_str in self._sorted[offset:offset + limit]]
+            else:
+                found = sorted(self._match_ids(query), key=self._sort_keys.__getitem__)
+                total = len(found)
+                page = found[offset:offset + limit]
+            return total, [(user_id_str,) + self._entries[user_id_str] for user_id_str in page]
+
+    def __len__(self):
+        return len(self._sorted)
+
+
+class StateManager:
+    """Состояние бота в памяти с блокировками по пользователям
+
+    Клиенты защищены таблицей из shards блокировок: пользователь попадает
+    в шард по хешу id, поэтому разные клиенты почти никогда не ждут друг
+    друга. Добавление и удаление ключей идёт под отдельной структурной
+    блокировкой, а обходы делаются по снимкам, а не по живым словарям.
+    Выбранные позиции и шаги регистрации хранятся в conversations —
+    в памяти процесса или в общем хранилище для нескольких воркеров.
+    Все изменения клиентов идут через методы менеджера, чтобы итоги
+    в aggregates и поисковый индекс directory оставались согласованными;
+    version растёт при каждом изменении и служит ключом кэша отчётов.
+    """
+
+    def __init__(self, users, conversations, shards=64):
+        self.users = users
+        self.conversations = conversations
+        self.aggregates = OrderAggregates()
+        self.aggregates.rebuild(users)
+        self.directory = ClientDirectory()
+        self.directory.rebuild(users)
+        self._shards = [threading.RLock() for _ in range(shards)]
+        self._structure_lock = threading.RLock()
+        self._versions = itertools.count(1)
+        self.version = 0
+
+    def _changed(self, user_id_str, before, after):
+        self.aggregates.update(user_id_str, before, after)
+        self.directory.update(user_id_str, before, after)
+        # next() у count атомарен — версии не теряются при изменениях из разных потоков
+        self.version = next(self._versions)
+
+    def _shard(self, user_id):
+        return self._shards[hash(str(user_id)) % len(self._shards)]
+
+    # === КЛИЕНТЫ ===
+
+    def get_user(self, user_id_str):
+        return self.users.get(user_id_str)
+
+    def get_or_create_user(self, user_id_str, factory):
+        """Вернуть клиента и признак того, что он только что создан"""
+        user_data = self.users.get(user_id_str)
+        if user_data is not None:
+            return user_data, False
+        with self._structure_lock:
+            if user_id_str in self.users:
+                return self.users[user_id_str], False
+            self.users[user_id_str] = factory()
+            self._changed(user_id_str, None, self.users[user_id_str])
+            return self.users[user_id_str], True
+
+    def refresh_user(self, user_id_str, user_data):
+        """Заменить закешированного клиента данными из общего хранилища"""
+        with self._structure_lock, self._shard(user_id_str):
+            before = self.users.get(user_id_str)
+            if user_data is None:
+                self.users.pop(user_id_str, None)
+            else:
+                self.users[user_id_str] = user_data
+            self._changed(user_id_str, before, user_data)
+
+    def delete_user(self, user_id_str):
+        """Удалить клиента, вернуть его данные или None"""
+        with self._structure_lock, self._shard(user_id_str):
+            removed = self.users.pop(user_id_str, None)
+            self._changed(user_id_str, removed, None)
+            return removed
+
+    def _modify(self, user_id_str, change):
+        """Изменить клиента под блокировкой и обновить итоги"""
+        with self._shard(user_id_str):
+            user_data = self.users[user_id_str]
+            before = copy_user(user_data)
+            change(user_data)
+            self._changed(user_id_str, before, user_data)
+            return user_data
+
+    def update_user(self, user_id_str, **fields):
+        """Изменить поля профиля клиента (точка, адрес, регистрация)"""
+        return self._modify(user_id_str, lambda user_data: user_data.update(fields))
+
+    def set_order_quantity(self, user_id_str, position, quantity):
+        """Задать количество позиции в заказе; 0 — удалить позицию"""
+        def change(user_data):
+            if quantity:
+                user_data['orders'][position] = quantity
+            else:
+                user_data['orders'].pop(position, None)
+        return self._modify(user_id_str, change)
+
+    def clear_user_orders(self, user_id_str):
+        return self._modify(user_id_str, lambda user_data: user_data.update(orders={}))
+
+    def copy_user(self, user_id_str):
+        """Согласованная копия данных клиента"""
+        with self._shard(user_id_str):
+            user_data = self.users.get(user_id_str)
+            return copy_user(user_data) if user_data is not None else None
+
+    def user_count(self):
+        return len(self.users)
+
+    def snapshot_dict(self, predicate=None):
+        """Копия базы клиентов user_id -> данные (опционально отфильтрованная)"""
+        with self._structure_lock:
+            items = list(self.users.items())
+        result = {}
+        for user_id_str, user_data in items:
+            with self._shard(user_id_str):
+                if predicate is None or predicate(user_data):
+                    result[user_id_str] = copy_user(user_data)
+        return result
+
+    def clear_all_orders(self):
+        """Очистить заказы у всех клиентов, вернуть число очищенных"""
+        with self._structure_lock:
+            items = list(self.users.items())
+        cleared_count = 0
+        for user_id_str, user_data in items:
+            with self._shard(user_id_str):
+                if user_data['orders']:
+                    before = copy_user(user_data)
+                    user_data['orders'] = {}
+                    self._changed(user_id_str, before, user_data)
+                    cleared_count += 1
+        return cleared_count
+
+    def active_users_sorted(self):
+        """Копии активных клиентов в порядке названия точки — без обхода всей базы"""
+        result = []
+        for user_id_str in self.aggregates.active_user_ids():
+            user_data = self.copy_user(user_id_str)
+            if user_data is not None:
+                result.append(user_data)
+        return result
+
+    # === ДИАЛОГИ ===
+
+    def get_step(self, user_id):
+        return self.conversations.get('registration_step', user_id)
+
+    def set_step(self, user_id, step):
+        self.conversations.set('registration_step', user_id, step)
+
+    def clear_step(self, user_id):
+        self.conversations.delete('registration_step', user_id)
+
+    def get_pending_order(self, user_id):
+        return self.conversations.get('current_order', user_id)
+
+    def set_pending_order(self, user_id, position_data):
+        self.conversations.set('current_order', user_id, position_data)
+
+    def clear_pending_order(self, user_id):
+        self.conversations.delete('current_order', user_id)
+
+    def get_client_search(self, user_id):
+        return self.conversations.get('client_search', user_id)
+
+    def set_client_search(self, user_id, search):
+        self.conversations.set('client_search', user_id, search)
+
+    def clear_client_search(self, user_id):
+        self.conversations.delete('client_search', user_id)
@@ -0,0 +1,908 @@
+import os
+import gzip
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+
+
+def atomic_write_json(path, data, indent=None):
+    """Атомарная запись JSON: временный файл + fsync + os.replace"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class Flusher:
+    """Фоновая запись изменённых («грязных») хранилищ
+
+    Хранилища регистрируют функцию записи и помечают себя грязными при каждом
+    изменении. Поток ждёт паузы в изменениях (debounce), но не дольше interval
+    с первого изменения, и записывает всё накопленное разом — так сотни
+    правок превращаются в несколько записей на диск. on_flush(name, seconds)
+    получает длительность каждой записи (для метрик).
+    """
+
+    def __init__(self, interval=1.0, debounce=0.2, on_flush=None):
+        self.interval = interval
+        self.debounce = debounce
+        self.on_flush = on_flush
+        self._stores = {}
+        self._dirty = set()
+        self._first_dirty_at = None
+        self._last_dirty_at = None
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+    def register(self, name, flush_fn):
+        self._stores[name] = flush_fn
+
+    def mark_dirty(self, name):
+        with self._cond:
+            now = time.monotonic()
+            if not self._dirty:
+                self._first_dirty_at = now
+            self._last_dirty_at = now
+            self._dirty.add(name)
+            self._cond.notify()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._dirty and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                while not self._stopping:
+                    deadline = min(self._last_dirty_at + self.debounce,
+                                   self._first_dirty_at + self.interval)
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            self.flush()
+
+    def flush(self):
+        """Записать все грязные хранилища (синхронно)"""
+        with self._cond:
+            names, self._dirty = self._dirty, set()
+        for name in names:
+            try:
+                started = time.perf_counter()
+                self._stores[name]()
+                if self.on_flush:
+                    self.on_flush(name, time.perf_counter() - started)
+            except Exception as e:
+                print(f"Ошибка записи {name}: {e}")
+                self.mark_dirty(name)
+
+    def stop(self):
+        """Остановить поток и выполнить финальную запись"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout=10)
+        self.flush()
+
+
+class JournaledStore:
+    """Словарь на диске: снапшот + журнал изменений (append-only)
+
+    Каждое изменение дописывает в журнал одну строку JSON, поэтому запись
+    стоит O(1) независимо от размера базы. При старте журнал проигрывается
+    поверх снапшота, а когда он разрастается — сжимается в новый снапшот
+    в фоновом потоке. С Flusher записи копятся в памяти (последняя по
+    каждому ключу) и сбрасываются в журнал пачкой с одним fsync.
+    """
+
+    def __init__(self, snapshot_path, compact_every=1000, flusher=None):
+        self.snapshot_path = snapshot_path
+        self.log_path = f"{snapshot_path}.log"
+        self.compacting_path = f"{snapshot_path}.log.compacting"
+        self.compact_every = compact_every
+        self.flusher = flusher
+        # Функция, возвращающая согласованную копию данных для снапшота
+        self.snapshot_source = None
+        self._pending = {}
+        self._data = {}
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._log = None
+        self._log_records = 0
+        self._compact_thread = None
+
+    # === ЗАГРУЗКА ===
+
+    def load(self):
+        """Загрузка снапшота и проигрывание журнала"""
+        data = {}
+        if os.path.exists(self.snapshot_path):
+            try:
+                with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except ValueError as e:
+                # Не перезаписываем повреждённый снапшот — откладываем его в сторону
+                print(f"Повреждён снапшот {self.snapshot_path}: {e}")
+                os.replace(self.snapshot_path, f"{self.snapshot_path}.corrupt")
+
+        # Журнал, оставшийся от прерванного сжатия, старше текущего журнала
+        self._replay(self.compacting_path, data)
+        self._log_records = self._replay(self.log_path, data)
+
+        self._data = data
+        self._log = open(self.log_path, 'a', encoding='utf-8')
+        if self.flusher:
+            self.flusher.register(self.log_path, self.flush)
+        return data
+
+    def read(self):
+        """Снапшот с проигранными журналами без изменения файлов (для импорта)"""
+        data = {}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        self._replay(self.compacting_path, data, repair=False)
+        self._replay(self.log_path, data, repair=False)
+        return data
+
+    def _replay(self, path, data, repair=True):
+        """Применить записи журнала к словарю, вернуть число записей
+
+        Оборванный хвост (запись без перевода строки после падения процесса)
+        при repair отрезается: иначе новые записи допишутся в ту же строку и
+        при следующем старте пропадут вместе с ней.
+        """
+        if not os.path.exists(path):
+            return 0
+
+        applied = 0
+        offset = complete_offset = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                offset += len(line)
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError("запись без конца строки")
+                    record = json.loads(line)
+                except ValueError:
+                    # Повреждённую строку пропускаем, следующие записи целы
+                    print(f"Пропущена повреждённая запись журнала {path}")
+                    continue
+                if record['op'] == 'put':
+                    data[record['key']] = record['value']
+                elif record['op'] == 'del':
+                    data.pop(record['key'], None)
+                applied += 1
+                complete_offset = offset
+        if repair and complete_offset < offset:
+            with open(path, 'r+b') as f:
+                f.truncate(complete_offset)
+                f.flush()
+                os.fsync(f.fileno())
+        return applied
+
+    # === ЗАПИСЬ ===
+
+    def put(self, key, value):
+        """Записать значение ключа в журнал"""
+        self._append({'op': 'put', 'key': key, 'value': value})
+
+    def delete(self, key):
+        """Записать удаление ключа в журнал"""
+        self._append({'op': 'del', 'key': key})
+
+    def put_many(self, items):
+        """Записать пары (ключ, значение) пачкой с одним fsync"""
+        records = [{'op': 'put', 'key': key, 'value': value} for key, value in items]
+        if self.flusher:
+            with self._lock:
+                self._pending.update((record['key'], record) for record in records)
+            self.flusher.mark_dirty(self.log_path)
+            return
+        with self._lock:
+            self._write_records_locked(records)
+        self._maybe_compact()
+
+    def _append(self, record):
+        if self.flusher:
+            with self._lock:
+                self._pending[record['key']] = record
+            self.flusher.mark_dirty(self.log_path)
+            return
+        with self._lock:
+            self._write_records_locked([record])
+        self._maybe_compact()
+
+    def flush(self):
+        """Сбросить накопленные записи в журнал"""
+        with self._lock:
+            records = list(self._pending.values())
+            self._pending = {}
+            self._write_records_locked(records)
+        self._maybe_compact()
+
+    def _write_records_locked(self, records):
+        """Дописать записи в журнал с одним fsync (вызывается под self._lock)"""
+        if not records:
+            return
+        self._log.write(''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records))
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        self._log_records += len(records)
+
+    def _maybe_compact(self):
+        if self._log_records >= self.compact_every:
+            self.compact_in_background()
+
+    # === СЖАТИЕ ===
+
+    def compact(self):
+        """Записать полный снапшот и начать журнал заново"""
+        with self._compact_lock:
+            with self._lock:
+                self._write_records_locked(list(self._pending.values()))
+                self._pending = {}
+                # Текущий журнал откладываем до записи снапшота
+                self._log.close()
+                if os.path.exists(self.log_path):
+                    self._merge_into_compacting()
+                self._log = open(self.log_path, 'a', encoding='utf-8')
+                self._log_records = 0
+
+            # Снапшот берётся после ротации и без self._lock (иначе возможна
+            # взаимоблокировка с потоками, пишущими под блокировкой клиента)
+            data = self.snapshot_source() if self.snapshot_source else self._data
+            snapshot = json.loads(json.dumps(data, ensure_ascii=False))
+            atomic_write_json(self.snapshot_path, snapshot, indent=2)
+            if os.path.exists(self.compacting_path):
+                os.remove(self.compacting_path)
+
+    def _merge_into_compacting(self):
+        """Перенести текущий журнал в журнал сжатия"""
+        if not os.path.exists(self.compacting_path):
+            os.replace(self.log_path, self.compacting_path)
+            return
+        # Предыдущее сжатие не завершилось — дописываем журнал в конец
+        with open(self.log_path, 'r', encoding='utf-8') as src, \
+                open(self.compacting_path, 'a', encoding='utf-8') as dst:
+            dst.write(src.read())
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.remove(self.log_path)
+
+    def compact_in_background(self):
+        """Запустить сжатие в фоновом потоке, если оно ещё не идёт"""
+        with self._lock:
+            if self._compact_thread and self._compact_thread.is_alive():
+                return
+            self._compact_thread = threading.Thread(target=self._compact_safe, daemon=True)
+            self._compact_thread.start()
+
+    def _compact_safe(self):
+        try:
+            self.compact()
+        except Exception as e:
+            print(f"Ошибка сжатия журнала {self.log_path}: {e}")
+
+
+# === ИСТОРИЯ ПО МЕСЯЦАМ ===
+
+MANIFEST_VERSION = 1
+
+
+def _month_of(date_str):
+    return date_str[:7]
+
+
+class PartitionedHistory:
+    """История заказов, разбитая на файлы по месяцам
+
+    history/manifest.json — маленький индекс: для каждого дня число заказов,
+    товаров и месяц-сегмент. Сегмент history/ГГГГ-ММ.json с записями
+    загружается только когда нужен конкретный день (просмотр даты, экспорт),
+    и в памяти держится не больше max_loaded сегментов. Запись нового заказа
+    меняет только текущий месяц и манифест. Сегменты старше retention_months
+    сжимаются в history/archive/ГГГГ-ММ.json.gz и остаются доступными для чтения.
+    """
+
+    def __init__(self, history_dir, flusher=None, max_loaded=3, retention_months=0):
+        self.history_dir = history_dir
+        self.archive_dir = os.path.join(history_dir, 'archive')
+        self.manifest_path = os.path.join(history_dir, 'manifest.json')
+        self.flusher = flusher
+        self.max_loaded = max_loaded
+        self.retention_months = retention_months
+        self.days = {}
+        self.archived = set()
+        self._segments = OrderedDict()
+        self._dirty = set()
+        self._lock = threading.RLock()
+
+    # --- Файлы ---
+
+    def _segment_path(self, month):
+        if month in self.archived:
+            return os.path.join(self.archive_dir, f"{month}.json.gz")
+        return os.path.join(self.history_dir, f"{month}.json")
+
+    def _read_segment(self, month):
+        path = self._segment_path(month)
+        if not os.path.exists(path):
+            return {}
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _segment(self, month):
+        """Сегмент месяца из кеша или с диска (под self._lock)"""
+        segment = self._segments.get(month)
+        if segment is None:
+            segment = self._segments[month] = self._read_segment(month)
+        self._segments.move_to_end(month)
+        self._trim_locked()
+        return segment
+
+    def _trim_locked(self):
+        # Вытесняем давно не нужные сегменты, несохранённые не трогаем
+        for old_month in list(self._segments)[:-1]:
+            if len(self._segments) <= self.max_loaded:
+                break
+            if old_month not in self._dirty:
+                del self._segments[old_month]
+
+    def load(self, legacy_path=None):
+        """Прочитать манифест; при первом запуске разложить старый файл истории"""
+        os.makedirs(self.history_dir, exist_ok=True)
+        if os.path.exists(self.manifest_path):
+            self._read_manifest()
+        elif legacy_path and os.path.exists(legacy_path):
+            self._migrate(legacy_path)
+        if self.flusher:
+            self.flusher.register(self.manifest_path, self.flush)
+        self.apply_retention()
+
+    def _read_manifest(self):
+        with open(self.manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        self.days = manifest['days']
+        self.archived = set(manifest.get('archived', []))
+
+    def read_days(self, legacy_path=None):
+        """Обход истории (дата, записи) без записи на диск: сегменты или старый файл"""
+        if os.path.exists(self.manifest_path):
+            self._read_manifest()
+            yield from self.iter_days()
+        elif legacy_path and os.path.exists(legacy_path):
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                history = json.load(f)
+            for date_str in sorted(history):
+                yield date_str, history[date_str]
+
+    def _migrate(self, legacy_path):
+        with open(legacy_path, 'r', encoding='utf-8') as f:
+            history = json.load(f)
+        with self._lock:
+            for date_str in sorted(history):
+                for entry in history[date_str]:
+                    self._add_locked(date_str, entry)
+            self._write_dirty_locked()
+        os.replace(legacy_path, legacy_path + '.migrated')
+        print(f"История разложена по месяцам: {len(history)} дней")
+
+    def _write_dirty_locked(self):
+        for month in sorted(self._dirty):
+            atomic_write_json(self._segment_path(month), self._segments[month])
+        self._dirty.clear()
+        self._trim_locked()
+        atomic_write_json(self.manifest_path, {'version': MANIFEST_VERSION, 'days': self.days,
+                                               'archived': sorted(self.archived)})
+
+    def flush(self):
+        with self._lock:
+            if self._dirty:
+                self._write_dirty_locked()
+
+    # --- Запись ---
+
+    def _add_locked(self, date_str, entry):
+        month = _month_of(date_str)
+        self._segment(month).setdefault(date_str, []).append(entry)
+        day = self.days.setdefault(date_str, {'orders': 0, 'items': 0})
+        day['orders'] += 1
+        day['items'] += entry['total_items']
+        self._dirty.add(month)
+
+    def replace_day(self, date_str, entries):
+        """Записать все заказы дня одним коммитом, заменив прежние записи этой даты
+
+        Сегмент и манифест пишутся сразу, минуя отложенную запись: повтор
+        после сбоя просто перезаписывает день и не создаёт дублей.
+        """
+        month = _month_of(date_str)
+        with self._lock:
+            segment = self._segment(month)
+            if entries:
+                segment[date_str] = list(entries)
+                self.days[date_str] = {'orders': len(entries),
+                                       'items': sum(entry['total_items'] for entry in entries)}
+            else:
+                segment.pop(date_str, None)
+                self.days.pop(date_str, None)
+            self._dirty.add(month)
+            self._write_dirty_locked()
+
+    # --- Хранение старых сегментов ---
+
+    def apply_retention(self, today=None):
+        """Сжать в архив сегменты старше retention_months месяцев"""
+        if not self.retention_months:
+            return 0
+        today = today or date.today()
+        index = today.year * 12 + today.month - 1 - self.retention_months
+        cutoff = f"{index // 12:04d}-{index % 12 + 1:02d}"
+        archived = 0
+        with self._lock:
+            self.flush()
+            months = {_month_of(d) for d in self.days}
+            for month in sorted(m for m in months if m < cutoff and m not in self.archived):
+                plain_path = self._segment_path(month)
+                os.makedirs(self.archive_dir, exist_ok=True)
+                archive_path = os.path.join(self.archive_dir, f"{month}.json.gz")
+                with open(plain_path, 'rb') as src, gzip.open(archive_path + '.tmp', 'wb') as dst:
+                    dst.write(src.read())
+                os.replace(archive_path + '.tmp', archive_path)
+                self.archived.add(month)
+                self._segments.pop(month, None)
+                self._write_dirty_locked()
+                os.remove(plain_path)
+                archived += 1
+        if archived:
+            print(f"В архив истории перенесено месяцев: {archived}")
+        return archived
+
+    # --- Чтение ---
+
+    def days_count(self):
+        return len(self.days)
+
+    def orders_count(self):
+        with self._lock:
+            return sum(day['orders'] for day in self.days.values())
+
+    def day_totals(self, limit=None):
+        """Список (дата, клиентов, товаров) от новых к старым — только из манифеста"""
+        with self._lock:
+            dates = sorted(self.days, reverse=True)[:limit]
+            return [(d, self.days[d]['orders'], self.days[d]['items']) for d in dates]
+
+    def for_date(self, date_str):
+        with self._lock:
+            if date_str not in self.days:
+                return None
+            return list(self._segment(_month_of(date_str)).get(date_str, []))
+
+    def iter_days(self):
+        """Обход всей истории по дням (дата, записи), сегмент за сегментом"""
+        with self._lock:
+            months = sorted({_month_of(d) for d in self.days})
+        for month in months:
+            with self._lock:
+                if month in self._segments:
+                    segment = self._segments[month]
+                else:
+                    # Полный обход не засоряет кеш старыми месяцами
+                    segment = self._read_segment(month)
+                items = [(d, list(segment[d])) for d in sorted(segment)]
+            yield from items
+
+
+# === БЭКЕНДЫ ХРАНЕНИЯ ===
+
+def make_history_entry(user_data, timestamp):
+    """Запись истории по текущему заказу клиента"""
+    return {
+        'user_id': user_data.get('user_id'),
+        'location_name': user_data['location_name'],
+        'address': user_data['address'],
+        'orders': user_data['orders'].copy(),
+        'total_items': sum(user_data['orders'].values()),
+        'timestamp': timestamp
+    }
+
+
+class JsonBackend:
+    """Хранение в JSON-файлах: клиенты — снапшот + журнал, история — сегменты по месяцам"""
+
+    def __init__(self, data_dir, users_compact_every=1000, flusher=None, history_retention_months=0):
+        self.users_store = JournaledStore(os.path.join(data_dir, 'users_data.json'),
+                                          compact_every=users_compact_every, flusher=flusher)
+        self.legacy_history_path = os.path.join(data_dir, 'orders_history.json')
+        self.history = PartitionedHistory(os.path.join(data_dir, 'history'), flusher=flusher,
+                                          retention_months=history_retention_months)
+        self.flusher = flusher
+        self.snapshot_source = None
+        self.users = {}
+
+    def set_snapshot_source(self, snapshot_source):
+        """Источник согласованных копий клиентов (для обходов и снапшотов)"""
+        self.snapshot_source = snapshot_source
+        self.users_store.snapshot_source = snapshot_source
+
+    def _users_snapshot(self):
+        return self.snapshot_source() if self.snapshot_source else self.users
+
+    def load_users(self):
+        self.users = self.users_store.load()
+        # Загружается только манифест истории, сами записи — по требованию
+        self.history.load(legacy_path=self.legacy_history_path)
+        return self.users
+
+    # --- Клиенты ---
+
+    def save_user(self, user_id_str, user_data):
+        self.users_store.put(user_id_str, user_data)
+
+    def delete_user(self, user_id_str):
+        self.users_store.delete(user_id_str)
+
+    def save_all_users(self):
+        self.users_store.compact()
+
+    def clear_all_orders(self):
+        """Сохранить очистку заказов у всех клиентов
+
+        Клиенты дописываются в журнал одной пачкой; снапшот пересоберётся
+        фоновым сжатием, а не на потоке запроса.
+        """
+        self.users_store.put_many(self._users_snapshot().items())
+
+    def active_users(self):
+        return [data for data in self._users_snapshot().values() if data.get('orders') and data.get('registered')]
+
+    def registered_users(self):
+        return [data for data in self._users_snapshot().values() if data.get('registered')]
+
+    def users_without_orders(self):
+        return [data for data in self._users_snapshot().values() if data.get('registered') and not data.get('orders')]
+
+    def all_users(self):
+        return dict(self._users_snapshot())
+
+    def user_count(self):
+        return len(self._users_snapshot())
+
+    # --- История ---
+
+    def commit_history_day(self, date_str, entries):
+        self.history.replace_day(date_str, entries)
+
+    def apply_history_retention(self):
+        return self.history.apply_retention()
+
+    def history_days_count(self):
+        return self.history.days_count()
+
+    def history_orders_count(self):
+        return self.history.orders_count()
+
+    def history_days(self, limit=None):
+        """Список (дата, клиентов, товаров) от новых к старым"""
+        return self.history.day_totals(limit)
+
+    def history_for_date(self, date_str):
+        return self.history.for_date(date_str)
+
+    def export_history(self):
+        return dict(self.history.iter_days())
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    location_name TEXT NOT NULL DEFAULT '',
+    address TEXT NOT NULL DEFAULT '',
+    registered INTEGER NOT NULL DEFAULT 0,
+    registration_date TEXT
+);
+CREATE TABLE IF NOT EXISTS order_lines (
+    user_id TEXT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+    position TEXT NOT NULL,
+    quantity INTEGER NOT NULL,
+    PRIMARY KEY (user_id, position)
+);
+CREATE INDEX IF NOT EXISTS idx_order_lines_position ON order_lines(position);
+CREATE TABLE IF NOT EXISTS history_orders (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    date TEXT NOT NULL,
+    user_id TEXT,
+    location_name TEXT NOT NULL,
+    address TEXT NOT NULL,
+    total_items INTEGER NOT NULL,
+    timestamp TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_history_orders_date ON history_orders(date);
+CREATE INDEX IF NOT EXISTS idx_history_orders_user_id ON history_orders(user_id);
+CREATE TABLE IF NOT EXISTS history_lines (
+    order_id INTEGER NOT NULL REFERENCES history_orders(id) ON DELETE CASCADE,
+    position TEXT NOT NULL,
+    quantity INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_history_lines_order_id ON history_lines(order_id);
+CREATE INDEX IF NOT EXISTS idx_history_lines_position ON history_lines(position);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+-- Журнал изменений профилей: воркеры догоняют по нему свои индексы клиентов
+CREATE TABLE IF NOT EXISTS user_changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS users_changed_insert AFTER INSERT ON users BEGIN
+    INSERT INTO user_changes (user_id) VALUES (NEW.user_id);
+END;
+CREATE TRIGGER IF NOT EXISTS users_changed_update AFTER UPDATE ON users
+WHEN OLD.location_name IS NOT NEW.location_name OR OLD.address IS NOT NEW.address
+    OR OLD.registered IS NOT NEW.registered BEGIN
+    INSERT INTO user_changes (user_id) VALUES (NEW.user_id);
+END;
+CREATE TRIGGER IF NOT EXISTS users_changed_delete AFTER DELETE ON users BEGIN
+    INSERT INTO user_changes (user_id) VALUES (OLD.user_id);
+END;
+CREATE TRIGGER IF NOT EXISTS user_changes_trim AFTER INSERT ON user_changes BEGIN
+    DELETE FROM user_changes WHERE seq <= NEW.seq - 10000;
+END;
+"""
+
+
+class SqliteBackend:
+    """Хранение в SQLite (режим WAL): клиенты, текущие заказы и история в таблицах"""
+
+    def __init__(self, data_dir):
+        self.db_path = os.path.join(data_dir, 'bot.db')
+        self.data_dir = data_dir
+        self._local = threading.local()
+        self.snapshot_source = None
+        self.users = {}
+
+    def set_snapshot_source(self, snapshot_source):
+        """Источник согласованных копий клиентов (для массовой записи)"""
+        self.snapshot_source = snapshot_source
+
+    def _conn(self):
+        """Отдельное соединение на поток"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA foreign_keys=ON')
+            self._local.conn = conn
+        return conn
+
+    def load_users(self):
+        conn = self._conn()
+        conn.executescript(SQLITE_SCHEMA)
+        self._migrate_json()
+        self.users = self._select_users('SELECT * FROM users')
+        return self.users
+
+    def _migrate_json(self):
+        """Однократный перенос данных из JSON-файлов прежнего формата
+
+        Факт переноса отмечается в таблице meta: база без клиентов, но с
+        историей, при перезапуске не импортирует историю повторно. Проверка
+        и перенос идут в одной транзакции с блокировкой записи, поэтому
+        одновременно стартующие воркеры не импортируют данные дважды.
+        """
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone() is None:
+                # База, заполненная до появления отметки, уже перенесена
+                has_data = conn.execute(
+                    'SELECT EXISTS(SELECT 1 FROM users) OR EXISTS(SELECT 1 FROM history_orders)').fetchone()[0]
+                if not has_data:
+                    self._import_json(conn)
+                conn.execute("INSERT INTO meta (key, value) VALUES ('json_imported', ?)",
+                             (time.strftime('%Y-%m-%d %H:%M:%S'),))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _import_json(self, conn):
+        """Перенос данных JSON-бэкенда; его файлы только читаются"""
+        users = JournaledStore(os.path.join(self.data_dir, 'users_data.json')).read()
+        history = PartitionedHistory(os.path.join(self.data_dir, 'history'))
+        for user_id_str, user_data in users.items():
+            self._write_user(conn, user_id_str, user_data)
+        days = 0
+        for date_str, date_orders in history.read_days(os.path.join(self.data_dir, 'orders_history.json')):
+            for entry in date_orders:
+                self._write_history_entry(conn, date_str, entry)
+            days += 1
+        if users or days:
+            print(f"Импортировано из JSON: {len(users)} клиентов, {days} дней истории")
+
+    def _select_users(self, query, params=()):
+        conn = self._conn()
+        users = {}
+        for row in conn.execute(query, params):
+            users[row['user_id']] = {
+                'user_id': row['user_id'],
+                'address': row['address'],
+                'location_name': row['location_name'],
+                'orders': {},
+                'registered': bool(row['registered']),
+                'registration_date': row['registration_date']
+            }
+        if users:
+            placeholders = ','.join('?' * len(users))
+            for row in conn.execute(
+                    f'SELECT user_id, position, quantity FROM order_lines '
+                    f'WHERE user_id IN ({placeholders}) ORDER BY rowid', list(users)):
+                users[row['user_id']]['orders'][row['position']] = row['quantity']
+        return users
+
+    # --- Клиенты ---
+
+    def _write_user(self, conn, user_id_str, user_data):
+        conn.execute(
+            'INSERT INTO users (user_id, location_name, address, registered, registration_date) '
+            'VALUES (?, ?, ?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET '
+            'location_name=excluded.location_name, address=excluded.address, '
+            'registered=excluded.registered, registration_date=excluded.registration_date',
+            (user_id_str, user_data['location_name'], user_data['address'],
+             int(bool(user_data['registered'])), user_data.get('registration_date')))
+        conn.execute('DELETE FROM order_lines WHERE user_id = ?', (user_id_str,))
+        conn.executemany(
+            'INSERT INTO order_lines (user_id, position, quantity) VALUES (?, ?, ?)',
+            [(user_id_str, pos, qty) for pos, qty in user_data['orders'].items()])
+
+    def save_user(self, user_id_str, user_data):
+        with self._conn() as conn:
+            self._write_user(conn, user_id_str, user_data)
+
+    def delete_user(self, user_id_str):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM users WHERE user_id = ?', (user_id_str,))
+
+    def save_all_users(self):
+        with self._conn() as conn:
+            users = self.snapshot_source() if self.snapshot_source else dict(self.users)
+            for user_id_str, user_data in users.items():
+                self._write_user(conn, user_id_str, user_data)
+
+    def user_changes(self, since):
+        """(отметка, {user_id: данные или None для удалённого}) — профили, изменённые после since
+
+        Вместо словаря None, если since не задан или журнал уже обрезан
+        дальше него: тогда нужна полная выборка клиентов. Отметка берётся
+        до выборки, поэтому изменения во время неё придут в следующий раз.
+        """
+        conn = self._conn()
+        first, last = conn.execute('SELECT MIN(seq), MAX(seq) FROM user_changes').fetchone()
+        if since is None or (first is not None and first > since + 1):
+            return last or 0, None
+        if last is None or last <= since:
+            return since, {}
+        user_ids = [row[0] for row in conn.execute(
+            'SELECT DISTINCT user_id FROM user_changes WHERE seq > ? AND seq <= ?', (since, last))]
+        placeholders = ','.join('?' * len(user_ids))
+        users = self._select_users(f'SELECT * FROM users WHERE user_id IN ({placeholders})', user_ids)
+        return last, {user_id_str: users.get(user_id_str) for user_id_str in user_ids}
+
+    def load_user(self, user_id_str):
+        """Свежие данные одного клиента из базы или None"""
+        return self._select_users('SELECT * FROM users WHERE user_id = ?', (user_id_str,)).get(user_id_str)
+
+    def clear_all_orders(self):
+        """Очистка заказов одним запросом — не перезаписывает клиентов из кеша процесса"""
+        with self._conn() as conn:
+            conn.execute('DELETE FROM order_lines')
+
+    def active_users(self):
+        return list(self._select_users(
+            'SELECT * FROM users WHERE registered = 1 AND user_id IN '
+            '(SELECT DISTINCT user_id FROM order_lines)').values())
+
+    def registered_users(self):
+        return list(self._select_users('SELECT * FROM users WHERE registered = 1').values())
+
+    def users_without_orders(self):
+        return list(self._select_users(
+            'SELECT * FROM users WHERE registered = 1 AND user_id NOT IN '
+            '(SELECT DISTINCT user_id FROM order_lines)').values())
+
+    def all_users(self):
+        return self._select_users('SELECT * FROM users')
+
+    def user_count(self):
+        return self._conn().execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    # --- История ---
+
+    def _write_history_entry(self, conn, date_str, entry):
+        cursor = conn.execute(
+            'INSERT INTO history_orders (date, user_id, location_name, address, total_items, timestamp) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (date_str, entry.get('user_id'), entry['location_name'], entry['address'],
+             entry['total_items'], entry.get('timestamp')))
+        conn.executemany(
+            'INSERT INTO history_lines (order_id, position, quantity) VALUES (?, ?, ?)',
+            [(cursor.lastrowid, pos, qty) for pos, qty in entry['orders'].items()])
+
+    def commit_history_day(self, date_str, entries):
+        """Заменить записи дня в одной транзакции"""
+        with self._conn() as conn:
+            conn.execute('DELETE FROM history_orders WHERE date = ?', (date_str,))
+            for entry in entries:
+                self._write_history_entry(conn, date_str, entry)
+
+    def apply_history_retention(self):
+        # История в SQLite уже проиндексирована по дате, архивирование не нужно
+        return 0
+
+    def history_days_count(self):
+        return self._conn().execute('SELECT COUNT(DISTINCT date) FROM history_orders').fetchone()[0]
+
+    def history_orders_count(self):
+        return self._conn().execute('SELECT COUNT(*) FROM history_orders').fetchone()[0]
+
+    def history_days(self, limit=None):
+        """Список (дата, клиентов, товаров) от новых к старым"""
+        rows = self._conn().execute(
+            'SELECT date, COUNT(*), SUM(total_items) FROM history_orders '
+            'GROUP BY date ORDER BY date DESC LIMIT ?', (limit if limit is not None else -1,))
+        return [(row[0], row[1], row[2] or 0) for row in rows]
+
+    def _select_history(self, where, params):
+        conn = self._conn()
+        orders = {}
+        for row in conn.execute(f'SELECT * FROM history_orders WHERE {where} ORDER BY id', params):
+            orders[row['id']] = (row['date'], {
+                'user_id': row['user_id'],
+                'location_name': row['location_name'],
+                'address': row['address'],
+                'orders': {},
+                'total_items': row['total_items'],
+                'timestamp': row['timestamp']
+            })
+        for row in conn.execute(
+                f'SELECT order_id, position, quantity FROM history_lines WHERE order_id IN '
+                f'(SELECT id FROM history_orders WHERE {where}) ORDER BY rowid', params):
+            orders[row['order_id']][1]['orders'][row['position']] = row['quantity']
+        return list(orders.values())
+
+    def history_for_date(self, date_str):
+        entries = [entry for _, entry in self._select_history('date = ?', (date_str,))]
+        return entries or None
+
+    def export_history(self):
+        history = {}
+        for date_str, entry in self._select_history('1 = 1', ()):
+            history.setdefault(date_str, []).append(entry)
+        return history
+
+
+def create_backend(kind, data_dir, users_compact_every=1000, flusher=None, history_retention_months=0):
+    """Создать бэкенд хранения по имени: json или sqlite"""
+    if kind == 'json':
+        return JsonBackend(data_dir, users_compact_every=users_compact_every, flusher=flusher,
+                           history_retention_months=history_retention_months)
+    if kind == 'sqlite':
+        return SqliteBackend(data_dir)
+    raise ValueError(f"Неизвестный бэкенд хранения: {kind}")
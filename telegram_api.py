@@ -0,0 +1,188 @@
+import time
+import random
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+# Таймауты (соединение, чтение) по методам Bot API, секунды
+DEFAULT_TIMEOUTS = {
+    'sendDocument': (5, 60),
+    'sendPhoto': (5, 60),
+    'answerCallbackQuery': (3, 5),
+    'deleteMessage': (3, 5),
+}
+DEFAULT_TIMEOUT = (5, 15)
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Bot API недоступен: вызовы отклоняются без обращения к сети
+
+    retry_after — сколько секунд осталось до пробного вызова; запрос не
+    отправлялся, его можно безопасно повторить позже.
+    """
+
+    def __init__(self, message, retry_after=1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Размыкатель: после threshold ошибок подряд вызовы отклоняются на cooldown секунд
+
+    По истечении cooldown пропускается один пробный вызов: успех замыкает
+    цепь, ошибка снова размыкает её.
+    """
+
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at < self.cooldown:
+                return 'open'
+            return 'half_open'
+
+    def remaining(self):
+        """Секунд до пробного вызова (не меньше секунды, пока цепь разомкнута)"""
+        with self._lock:
+            if self._opened_at is None:
+                return 0
+            return max(1.0, self.cooldown - (time.monotonic() - self._opened_at))
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.cooldown or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record(self, ok):
+        with self._lock:
+            self._probing = False
+            if ok:
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._opened_at is not None or self._failures >= self.threshold:
+                self._opened_at = time.monotonic()
+
+
+class TelegramApiClient:
+    """HTTP-клиент Bot API для apihelper.CUSTOM_REQUEST_SENDER
+
+    Один пул keep-alive соединений на процесс (pool_size — по числу потоков,
+    которые ходят в API), таймауты по методам. Сетевые ошибки и 5xx
+    повторяются с экспоненциальной задержкой и случайным разбросом; send*
+    после отправленного запроса (в том числе с ответом 5xx — запрос дошёл до
+    Telegram) не повторяются, чтобы не задвоить сообщение.
+    На 429 с retry_after не больше max_retry_after все вызовы клиента ждут
+    указанное время и повторяют запрос, более долгие паузы возвращаются
+    вызывающему (рассылка сама притормаживает). Серия ошибок размыкает
+    CircuitBreaker, и вызовы сразу падают с CircuitOpenError.
+    """
+
+    def __init__(self, pool_size=10, timeouts=None, default_timeout=DEFAULT_TIMEOUT, max_retries=3,
+                 backoff=0.5, max_retry_after=5, breaker=None, on_retry=None):
+        self.timeouts = dict(DEFAULT_TIMEOUTS, **(timeouts or {}))
+        self.default_timeout = default_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_retry_after = max_retry_after
+        self.breaker = breaker or CircuitBreaker()
+        self.on_retry = on_retry
+        self._paused_until = 0
+        self._lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _wait_flood_pause(self):
+        with self._lock:
+            wait = self._paused_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    def _delay(self, attempt):
+        return random.uniform(0.5, 1.5) * self.backoff * 2 ** attempt
+
+    def _retry(self, method_name, reason, delay):
+        if self.on_retry:
+            self.on_retry(method_name, reason)
+        time.sleep(delay)
+
+    def request(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        """Сигнатура CUSTOM_REQUEST_SENDER; возвращает requests.Response"""
+        method_name = url.rsplit('/', 1)[-1]
+        timeout = self.timeouts.get(method_name, self.default_timeout)
+        # Файлы при повторе отправляются заново с той же позиции
+        streams = [value[1] if isinstance(value, tuple) else value for value in (files or {}).values()]
+        positions = [(s, s.tell()) for s in streams if hasattr(s, 'seek') and hasattr(s, 'tell')]
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpenError(f"Bot API недоступен, {method_name} не отправлен",
+                                       retry_after=self.breaker.remaining())
+            self._wait_flood_pause()
+            for stream, position in positions:
+                stream.seek(position)
+            try:
+                response = self.session.request(method, url, params=params, files=files,
+                                                timeout=timeout, proxies=proxies)
+            except Exception as e:
+                self.breaker.record(False)
+                if not isinstance(e, requests.exceptions.RequestException) or attempt >= self.max_retries:
+                    raise
+                # Запрос мог дойти: send* повторяем, только если соединение не установилось
+                if method_name.startswith('send') and not _not_sent(e):
+                    raise
+                self._retry(method_name, type(e).__name__, self._delay(attempt))
+                attempt += 1
+                continue
+
+            if response.status_code >= 500:
+                self.breaker.record(False)
+                if attempt >= self.max_retries or method_name.startswith('send'):
+                    return response
+                self._retry(method_name, str(response.status_code), self._delay(attempt))
+                attempt += 1
+                continue
+
+            self.breaker.record(True)
+            if response.status_code == 429 and attempt < self.max_retries:
+                retry_after = _retry_after(response)
+                if retry_after <= self.max_retry_after:
+                    with self._lock:
+                        self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                    self._retry(method_name, '429', random.uniform(0, 0.2 * self.backoff))
+                    attempt += 1
+                    continue
+            return response
+
+
+def _not_sent(error):
+    """Соединение не установилось — запрос точно не дошёл до Telegram"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    return isinstance(getattr(reason, 'reason', reason), NewConnectionError)
+
+
+def _retry_after(response):
+    try:
+        return float(response.json().get('parameters', {}).get('retry_after', 1))
+    except (ValueError, AttributeError):
+        return 1.0
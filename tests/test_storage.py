@@ -0,0 +1,57 @@
+import os
+import sys
+import json
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import JournaledStore
+
+
+class JournaledStoreTornTailTest(unittest.TestCase):
+    """Оборванная запись журнала не должна съедать записи после рестарта"""
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'users_data.json')
+
+    def open_store(self):
+        store = JournaledStore(self.path)
+        return store, store.load()
+
+    def test_writes_after_torn_tail_survive_restarts(self):
+        store, _ = self.open_store()
+        for key in 'abc':
+            store.put(key, {'name': key})
+        store._log.close()
+        # Падение посреди записи: строка без конца
+        with open(store.log_path, 'a', encoding='utf-8') as f:
+            f.write('{"op": "put", "key": "x", "val')
+
+        store, data = self.open_store()
+        self.assertEqual(sorted(data), ['a', 'b', 'c'])
+        store.put('d', {'name': 'd'})
+        store.put('e', {'name': 'e'})
+        store._log.close()
+
+        store, data = self.open_store()
+        self.assertEqual(sorted(data), ['a', 'b', 'c', 'd', 'e'])
+        store._log.close()
+        store, data = self.open_store()
+        self.assertEqual(sorted(data), ['a', 'b', 'c', 'd', 'e'])
+        store._log.close()
+
+    def test_broken_line_inside_log_is_skipped(self):
+        # Испорченная строка посреди журнала не прячет записи после неё
+        log_path = f"{self.path}.log"
+        with open(log_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'op': 'put', 'key': 'a', 'value': 1}) + '\n')
+            f.write('{"op": "put", "key": "x", "val\n')
+            f.write(json.dumps({'op': 'put', 'key': 'd', 'value': 4}) + '\n')
+        store, data = self.open_store()
+        self.assertEqual(data, {'a': 1, 'd': 4})
+        store._log.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import json
+import time
+import random
+import logging
+import threading
+import functools
+from collections import deque
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+
+
+class Tracer:
+    """Выборочная трассировка обработки обновлений
+
+    trace() открывает трассу для доли sample_rate обновлений, span() внутри
+    неё замеряет отдельные шаги (обработчик, запись в хранилище, вызов
+    Bot API). Вне трассы span() ничего не делает, поэтому при sample_rate=0
+    трассировка почти бесплатна. Завершённые трассы хранятся в кольцевом
+    буфере последних keep штук и передаются хукам из add_hook — например,
+    запись медленных трасс в файл (slow_log).
+    """
+
+    def __init__(self, sample_rate=0.0, keep=500):
+        self.sample_rate = sample_rate
+        self._recent = deque(maxlen=keep)
+        self._hooks = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0
+
+    def add_hook(self, hook):
+        """hook(trace) вызывается для каждой завершённой трассы"""
+        self._hooks.append(hook)
+
+    @contextmanager
+    def trace(self, name, **attrs):
+        """Корневая трасса одного обновления (с учётом выборки)"""
+        if getattr(self._local, 'trace', None) is not None or not self.enabled \
+                or random.random() >= self.sample_rate:
+            yield
+            return
+        started = time.perf_counter()
+        trace = {'name': name, 'attrs': attrs, 'started_at': time.time(), 'spans': []}
+        self._local.trace = trace
+        self._local.depth = 0
+        try:
+            yield
+        finally:
+            self._local.trace = None
+            trace['duration_ms'] = (time.perf_counter() - started) * 1000
+            with self._lock:
+                self._recent.append(trace)
+            for hook in self._hooks:
+                try:
+                    hook(trace)
+                except Exception as e:
+                    print(f"Ошибка хука трассировки: {e}")
+
+    @contextmanager
+    def span(self, name):
+        """Шаг внутри текущей трассы; без активной трассы — ничего не делает"""
+        trace = getattr(self._local, 'trace', None)
+        if trace is None:
+            yield
+            return
+        depth = self._local.depth
+        self._local.depth = depth + 1
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            trace['spans'].append({'name': name, 'depth': depth,
+                                   'duration_ms': (time.perf_counter() - started) * 1000})
+
+    def traced(self, name=None):
+        """Декоратор: выполнение функции как span"""
+        def decorator(fn):
+            span_name = name or fn.__name__
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(span_name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def slowest(self, limit=10):
+        """Самые долгие из последних трасс"""
+        with self._lock:
+            traces = list(self._recent)
+        return sorted(traces, key=lambda t: t['duration_ms'], reverse=True)[:limit]
+
+
+def slow_log(path, threshold_ms, max_bytes=5 * 1024 * 1024, backups=3):
+    """Хук: трассы дольше threshold_ms дописываются JSON-строками в ротируемый файл"""
+    logger = logging.getLogger(f"traces.{path}")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    if not logger.handlers:
+        logger.addHandler(RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8'))
+
+    def hook(trace):
+        if trace['duration_ms'] >= threshold_ms:
+            logger.info(json.dumps(trace, ensure_ascii=False))
+    return hook
+
+
+def format_trace(trace, max_spans=5):
+    """Строки отчёта по трассе: корень и самые долгие шаги"""
+    started = time.strftime('%d.%m %H:%M:%S', time.localtime(trace['started_at']))
+    lines = [f"{trace['duration_ms']:.0f} мс — {trace['name']} ({started})"]
+    for span in sorted(trace['spans'], key=lambda s: s['duration_ms'], reverse=True)[:max_spans]:
+        lines.append(f"   {span['name']}: {span['duration_ms']:.0f} мс")
+    return lines
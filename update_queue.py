@@ -0,0 +1,91 @@
+import queue
+import threading
+
+_STOP = object()
+
+
+def update_chat_id(update):
+    """Чат, к которому относится обновление (для сохранения порядка)"""
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    return update.update_id
+
+
+class UpdateDispatcher:
+    """Очередь входящих обновлений с пулом воркеров
+
+    Каждый воркер разбирает свою очередь, а чат всегда попадает к одному
+    и тому же воркеру — поэтому сообщения одного клиента обрабатываются
+    строго по порядку, а разные клиенты — параллельно. Очереди ограничены:
+    при переполнении submit возвращает False, и вебхук отвечает 503, чтобы
+    Telegram повторил доставку позже.
+    """
+
+    def __init__(self, handler, workers=4, max_size=1000):
+        self.handler = handler
+        per_worker = max(1, max_size // workers)
+        self._queues = [queue.Queue(maxsize=per_worker) for _ in range(workers)]
+        self._threads = []
+        self._stats_lock = threading.Lock()
+        self._stats = {'accepted': 0, 'rejected': 0, 'processed': 0, 'failed': 0, 'max_depth': 0}
+
+    def start(self):
+        for i, q in enumerate(self._queues):
+            thread = threading.Thread(target=self._worker, args=(q,), name=f"update-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, chat_id, update):
+        """Поставить обновление в очередь; False — очередь переполнена"""
+        q = self._queues[hash(chat_id) % len(self._queues)]
+        try:
+            q.put_nowait(update)
+        except queue.Full:
+            self._count('rejected')
+            return False
+        with self._stats_lock:
+            self._stats['accepted'] += 1
+            self._stats['max_depth'] = max(self._stats['max_depth'], self.depth())
+        return True
+
+    def _worker(self, q):
+        while True:
+            update = q.get()
+            try:
+                if update is _STOP:
+                    return
+                self.handler(update)
+                self._count('processed')
+            except Exception as e:
+                self._count('failed')
+                print(f"Ошибка обработки обновления: {e}")
+            finally:
+                q.task_done()
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def depth(self):
+        """Сколько обновлений ждёт обработки"""
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self):
+        with self._stats_lock:
+            return {**self._stats, 'depth': self.depth(), 'workers': len(self._queues)}
+
+    def join(self):
+        """Дождаться обработки всех принятых обновлений"""
+        for q in self._queues:
+            q.join()
+
+    def stop(self, timeout=30):
+        """Остановка: дообработать очередь и завершить воркеры"""
+        for q in self._queues:
+            q.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout=timeout)